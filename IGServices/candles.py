@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+OHLC bars built incrementally from the L1 and CHART:TICK price updates.
+"""
+
+import collections
+import logging
+import threading
+from datetime import datetime, timezone
+
+from IGServices.utils import RESOLUTIONS, conv_resol, is_price_update, item_epic, tick_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Length in seconds of the fixed IG resolutions, by conv_resol name
+RESOLUTION_SECONDS = dict((name, seconds) for seconds, name in RESOLUTIONS.items())
+
+# Weeks start on Monday, the epoch was a Thursday
+WEEK_OFFSET = 4 * 86400
+
+
+def resolution_seconds(resolution):
+    """Returns the IG name and the length in seconds of a resolution given
+    as an IG name ("MINUTE_5") or a pandas frequency ("5min", or the old
+    "5Min" alias)
+    """
+    name = resolution if resolution in RESOLUTION_SECONDS else conv_resol(resolution)
+    try:
+        return name, RESOLUTION_SECONDS[name]
+    except KeyError:
+        raise ValueError(
+            "Unsupported resolution %r, expected one of %s" % (resolution, sorted(RESOLUTION_SECONDS))
+        )
+
+
+def bar_start(timestamp, seconds):
+    """Returns the start (epoch seconds) of the bar of the given length
+    holding timestamp
+    """
+    offset = WEEK_OFFSET if seconds == RESOLUTION_SECONDS["WEEK"] else 0
+    return timestamp - (timestamp - offset) % seconds
+
+
+class Candle(object):
+    """Bid, ask and mid OHLC of an epic over one bar"""
+
+    __slots__ = (
+        "epic", "resolution", "start", "end", "ticks",
+        "bid_open", "bid_high", "bid_low", "bid_close",
+        "ask_open", "ask_high", "ask_low", "ask_close",
+        "mid_open", "mid_high", "mid_low", "mid_close",
+    )
+
+    def __init__(self, epic, resolution, start, seconds, bid, ask):
+        mid = (bid + ask) / 2.0
+        self.epic = epic
+        self.resolution = resolution
+        self.start = start
+        self.end = start + seconds
+        self.ticks = 1
+        self.bid_open = self.bid_high = self.bid_low = self.bid_close = bid
+        self.ask_open = self.ask_high = self.ask_low = self.ask_close = ask
+        self.mid_open = self.mid_high = self.mid_low = self.mid_close = mid
+
+    def update(self, bid, ask):
+        mid = (bid + ask) / 2.0
+        self.ticks += 1
+        self.bid_close = bid
+        if bid > self.bid_high:
+            self.bid_high = bid
+        elif bid < self.bid_low:
+            self.bid_low = bid
+        self.ask_close = ask
+        if ask > self.ask_high:
+            self.ask_high = ask
+        elif ask < self.ask_low:
+            self.ask_low = ask
+        self.mid_close = mid
+        if mid > self.mid_high:
+            self.mid_high = mid
+        elif mid < self.mid_low:
+            self.mid_low = mid
+
+    def as_dict(self):
+        bar = dict((name, getattr(self, name)) for name in self.__slots__)
+        bar["start"] = datetime.fromtimestamp(self.start, tz=timezone.utc)
+        bar["end"] = datetime.fromtimestamp(self.end, tz=timezone.utc)
+        return bar
+
+    def __repr__(self):
+        return "Candle(%s %s %s mid %s/%s/%s/%s, %d ticks)" % (
+            self.epic, self.resolution, self.start,
+            self.mid_open, self.mid_high, self.mid_low, self.mid_close, self.ticks,
+        )
+
+
+def _to_number(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return float(value)
+    return value
+
+
+class CandleAggregator(object):
+    """Listener building bars of the given resolutions (IG names such as
+    "SECOND", "MINUTE_5", "HOUR" or pandas frequencies such as "1s",
+    "5min", "1h") for each epic of the L1:<epic>, MARKET:<epic> and
+    CHART:<epic>:TICK items it is added to, with Subscription.addlistener.
+
+    Each tick updates the open bars in constant time. When a tick falls
+    in a later bar, the completed bar is passed to on_bar (or kept in
+    history without on_bar). Ticks are timed by UTM when present, else by
+    the local clock; ticks older than the open bar are counted as late
+    and ignored. Updates changing no price (e.g. only UPDATE_TIME or the
+    market state) are not ticks.
+    """
+
+    def __init__(self, resolutions=("SECOND", "MINUTE"), on_bar=None, history=10000):
+        self.resolutions = [resolution_seconds(r) for r in resolutions]
+        self.on_bar = on_bar
+        self.history = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        # (epic, resolution) -> open Candle
+        self._bars = {}
+        self.tick_count = 0
+        self.late_count = 0
+
+    def __call__(self, item_info):
+        if not is_price_update(item_info):
+            return
+        values = item_info["values"]
+        offer = values.get("OFFER")
+        if offer is None:
+            offer = values.get("OFR")
+        try:
+            bid = _to_number(values.get("BID"))
+            ask = _to_number(offer)
+        except ValueError:
+            return
+        if bid is None or ask is None:
+            return
+        self.tick(item_epic(item_info["name"]), bid, ask, tick_timestamp(values))
+
+    def tick(self, epic, bid, ask, timestamp):
+        """Adds a bid/ask tick of an epic at timestamp (epoch seconds)"""
+        completed = []
+        with self._lock:
+            self.tick_count += 1
+            for resolution, seconds in self.resolutions:
+                key = (epic, resolution)
+                bar = self._bars.get(key)
+                if bar is not None and timestamp < bar.end:
+                    if timestamp >= bar.start:
+                        bar.update(bid, ask)
+                    else:
+                        self.late_count += 1
+                    continue
+                if bar is not None:
+                    completed.append(bar)
+                self._bars[key] = Candle(
+                    epic, resolution, bar_start(int(timestamp), seconds), seconds, bid, ask
+                )
+        for bar in completed:
+            self._emit(bar)
+
+    def _emit(self, bar):
+        if self.on_bar is None:
+            self.history.append(bar)
+            return
+        try:
+            self.on_bar(bar)
+        except Exception:
+            logger.exception("Bar listener error on %s" % bar.epic)
+
+    def current(self, epic, resolution):
+        """Returns the open bar of an epic, None if no tick yet"""
+        return self._bars.get((epic, resolution_seconds(resolution)[0]))
+
+    def flush(self):
+        """Emits and closes all the open bars, e.g. when unsubscribing"""
+        with self._lock:
+            completed = list(self._bars.values())
+            self._bars.clear()
+        for bar in completed:
+            self._emit(bar)
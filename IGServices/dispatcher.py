@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Delivery of Lightstreamer item updates to the Subscription listeners
+away from the stream reader thread.
+"""
+
+import collections
+import functools
+import logging
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies applied when the dispatch queue is full
+# Wait for the listeners to free a slot (the stream reader is paused).
+POLICY_BLOCK = "block"
+# Discard the oldest queued update to make room for the new one.
+POLICY_DROP_OLDEST = "drop_oldest"
+# Keep a single pending update per item, replaced by the newest one: the
+# queue holds at most one entry per item and never blocks.
+POLICY_CONFLATE = "conflate"
+
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_CONFLATE)
+
+# Executors running the listeners
+# Listeners run on the DISPATCHER threads of this process.
+EXECUTOR_THREAD = "thread"
+# Listeners run in one worker process per DISPATCHER thread.
+EXECUTOR_PROCESS = "process"
+
+EXECUTORS = (EXECUTOR_THREAD, EXECUTOR_PROCESS)
+
+# Updates handed to a worker process and not processed yet, per shard
+PROCESS_INFLIGHT = 100
+
+# Listeners installed in a pool worker process, by Subscription key
+_worker_listeners = {}
+
+
+def merge_item_info(pending, item_info):
+    """Merge a newer update of an item into the pending one: the values
+    are the latest ones and the changed fields are the union of both.
+    """
+    changed = list(pending.get("changed", ()))
+    changed.extend(k for k in item_info.get("changed", ()) if k not in changed)
+    merged = dict(item_info)
+    merged["changed"] = changed
+    return merged
+
+
+def _install_listeners(key, listeners):
+    """Keep the listeners of a Subscription in the pool worker process, so
+    that their state persists from one update to the next.
+    """
+    _worker_listeners[key] = listeners
+
+
+def _invoke_listeners(key, item_info):
+    """Run the installed listeners of an item update, in a pool worker
+    process.
+    """
+    for on_item_update in _worker_listeners[key]:
+        on_item_update(item_info)
+
+
+class _DispatchQueue(object):
+    """Bounded queue of item updates served, in order, by a single
+    DISPATCHER thread.
+    """
+
+    def __init__(self, index, maxsize, policy, executor):
+        self.index = index
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue = collections.deque()
+        # Conflation: (subscription id, item position) -> latest item update
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._process_pool = None
+        # Subscription key -> ids of the listeners installed in the worker
+        self._installed = {}
+        self._inflight = 0
+        # Updates delivered at once: one on the thread, a window of
+        # asynchronous tasks in the worker process
+        self._window = PROCESS_INFLIGHT if executor == EXECUTOR_PROCESS else 1
+        self.executor = executor
+        self.dispatched_count = 0
+        self.dropped_count = 0
+        self.conflated_count = 0
+        self.max_depth = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        if self.executor == EXECUTOR_PROCESS:
+            # A single worker process per shard keeps the item order
+            self._process_pool = ProcessPoolExecutor(max_workers=1)
+            self._installed = {}
+        self._thread = threading.Thread(
+            name="DISPATCHER-THREAD-{0}".format(self.index), target=self._run
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, drain=True, timeout=None):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            if not drain:
+                self.dropped_count += len(self._queue)
+                self._queue.clear()
+                self._pending.clear()
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=drain)
+            self._process_pool = None
+
+    def put(self, subscription, item_info):
+        with self._cond:
+            if not self._running:
+                # Stopped: never delivered
+                self.dropped_count += 1
+                return
+            if self.policy == POLICY_CONFLATE:
+                key = (id(subscription), item_info["pos"])
+                if key in self._pending:
+                    pending = self._pending[key][1]
+                    self._pending[key] = (subscription, merge_item_info(pending, item_info))
+                    self.conflated_count += 1
+                    return
+                # One entry per item: the depth is bounded by the number
+                # of items, not by maxsize, so the stream is never held
+                entry = key
+                self._pending[entry] = (subscription, item_info)
+            else:
+                entry = (subscription, item_info)
+                while self._running and len(self._queue) >= self.maxsize:
+                    if self.policy == POLICY_DROP_OLDEST:
+                        self._discard_oldest()
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    self.dropped_count += 1
+                    return
+
+            self._queue.append(entry)
+            depth = len(self._queue)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self._cond.notify_all()
+
+    def _discard_oldest(self):
+        self._queue.popleft()
+        self.dropped_count += 1
+
+    def _next(self):
+        """Wait for the next queued update, None once stopped and drained."""
+        with self._cond:
+            while (self._running and not self._queue) or self._inflight >= self._window:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            entry = self._queue.popleft()
+            if self.policy == POLICY_CONFLATE:
+                entry = self._pending.pop(entry)
+            self._inflight += 1
+            self._cond.notify_all()
+            return entry
+
+    def _done(self):
+        with self._cond:
+            self._inflight -= 1
+            self.dispatched_count += 1
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every queued update has been delivered."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._running and (self._queue or self._inflight):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                break
+            subscription, item_info = entry
+            if self._process_pool is not None:
+                try:
+                    subscription._deliver(item_info, [functools.partial(self._submit, subscription)])
+                except Exception:
+                    logger.error("Unable to hand %s to the worker process" % item_info.get("name"))
+                    logger.error(traceback.format_exc())
+                    self._done()
+                continue
+            try:
+                subscription._deliver(item_info)
+            except Exception:
+                logger.error("Listener error on %s" % item_info.get("name"))
+                logger.error(traceback.format_exc())
+            self._done()
+        logger.debug("Dispatcher %s terminated" % self.index)
+
+    def _submit(self, subscription, item_info):
+        """Run the listeners of an update in the worker process, installing
+        them first when new or changed. The worker runs its tasks in order.
+        """
+        key = id(subscription)
+        listeners = list(subscription._listeners)
+        installed = tuple(id(listener) for listener in listeners)
+        if self._installed.get(key) != installed:
+            self._process_pool.submit(_install_listeners, key, listeners).result()
+            self._installed[key] = installed
+        future = self._process_pool.submit(_invoke_listeners, key, item_info)
+        future.add_done_callback(functools.partial(self._processed, item_info.get("name")))
+
+    def _processed(self, name, future):
+        if future.exception() is not None:
+            logger.error("Listener error on %s: %r" % (name, future.exception()))
+        self._done()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "dispatched": self.dispatched_count,
+                "dropped": self.dropped_count,
+                "conflated": self.conflated_count,
+            }
+
+
+class Dispatcher(object):
+    """Bounded queue between the stream reader thread and the Subscription
+    listeners, which are invoked on dedicated DISPATCHER threads.
+
+    With several workers the updates are sharded by item name: the
+    updates of one item are always delivered in order by the same
+    worker, while different items are processed in parallel. With the
+    process executor the listeners run in one worker process per shard,
+    asynchronously: they must be picklable, are installed once in the
+    worker (again if the listeners of the Subscription change) and keep
+    their state there, but their side effects stay in that process.
+    """
+
+    def __init__(self, maxsize=10000, policy=POLICY_BLOCK, workers=1, executor=EXECUTOR_THREAD):
+        if policy not in POLICIES:
+            raise ValueError("Invalid dispatch policy %r, expected one of %s" % (policy, POLICIES))
+        if executor not in EXECUTORS:
+            raise ValueError("Invalid executor %r, expected one of %s" % (executor, EXECUTORS))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.workers = max(1, int(workers))
+        self.executor = executor
+        shard_size = max(1, maxsize // self.workers)
+        self._shards = [
+            _DispatchQueue(index, shard_size, policy, executor) for index in range(self.workers)
+        ]
+
+    def start(self):
+        """Start the DISPATCHER threads, if not already running."""
+        for shard in self._shards:
+            shard.start()
+
+    def stop(self, drain=True, timeout=None):
+        """Stop the DISPATCHER threads, delivering the queued updates
+        first unless drain is False.
+        """
+        for shard in self._shards:
+            shard.stop(drain, timeout)
+
+    def _shard(self, item_name):
+        if self.workers == 1:
+            return self._shards[0]
+        return self._shards[zlib.crc32(item_name.encode("utf-8")) % self.workers]
+
+    def put(self, subscription, item_info):
+        """Queue an item update for the listeners of the given
+        Subscription, applying the overflow policy when full. Updates put
+        once stopped are dropped.
+        """
+        self._shard(item_info["name"]).put(subscription, item_info)
+
+    def join(self, timeout=None):
+        """Wait until every queued update has been delivered, returns
+        False if the timeout expired first.
+        """
+        return all([shard.join(timeout) for shard in self._shards])
+
+    def depth(self):
+        """Return the number of updates waiting for delivery."""
+        return sum(len(shard._queue) for shard in self._shards)
+
+    def metrics(self):
+        """Return a snapshot of the dispatch queue metrics."""
+        shards = [shard.metrics() for shard in self._shards]
+        return {
+            "policy": self.policy,
+            "maxsize": self.maxsize,
+            "workers": self.workers,
+            "executor": self.executor,
+            "depth": sum(s["depth"] for s in shards),
+            "max_depth": max(s["max_depth"] for s in shards),
+            "dispatched": sum(s["dispatched"] for s in shards),
+            "dropped": sum(s["dropped"] for s in shards),
+            "conflated": sum(s["conflated"] for s in shards),
+            "shards": shards,
+        }
+
+
+class Conflator(object):
+    """Keeps, for each item of a Subscription, a single pending update
+    merging all the ones received since the last delivery, and hands the
+    pending updates to the listeners at most every interval milliseconds,
+    or as soon as the listeners are free when the interval is 0.
+    """
+
+    def __init__(self, subscription, interval=0):
+        self.subscription = subscription
+        self.interval = interval / 1000.0
+        # item position -> pending update, in order of first arrival
+        self._pending = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.delivered_count = 0
+        self.conflated_count = 0
+
+    def start(self):
+        """Start the CONFLATOR thread, if not already running."""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(name="CONFLATOR-THREAD", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, drain=True, timeout=None):
+        """Stop the CONFLATOR thread, delivering the pending updates
+        first unless drain is False.
+        """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            if not drain:
+                self._pending.clear()
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def put(self, item_info):
+        """Merge an item update into the pending map."""
+        if not self._running:
+            self.start()
+        with self._cond:
+            pos = item_info["pos"]
+            pending = self._pending.get(pos)
+            if pending is None:
+                self._pending[pos] = item_info
+            else:
+                self._pending[pos] = merge_item_info(pending, item_info)
+                self.conflated_count += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                batch = list(self._pending.values())
+                self._pending.clear()
+
+            started = time.time()
+            for item_info in batch:
+                try:
+                    self.subscription._deliver(item_info)
+                except Exception:
+                    logger.error("Listener error on %s" % item_info.get("name"))
+                    logger.error(traceback.format_exc())
+                self.delivered_count += 1
+
+            # Hold the next delivery until the interval has elapsed
+            remaining = started + self.interval - time.time()
+            if remaining > 0:
+                with self._cond:
+                    if self._running:
+                        self._cond.wait(remaining)
+        logger.debug("Conflator terminated")
+
+    def metrics(self):
+        """Return a snapshot of the conflation metrics."""
+        with self._cond:
+            return {
+                "interval": self.interval * 1000.0,
+                "pending": len(self._pending),
+                "delivered": self.delivered_count,
+                "conflated": self.conflated_count,
+            }
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Typed decoding of the Lightstreamer field values pushed by IG, with
+field schemas for the L1, CHART, ACCOUNT and TRADE items.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def to_float(value):
+    return float(value)
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def to_millis(value):
+    """Converts epoch milliseconds to a UTC datetime"""
+    return datetime.fromtimestamp(int(value) / 1000.0, tz=timezone.utc)
+
+
+def to_bool(value):
+    return value in ("1", "true", "TRUE", "True")
+
+
+def to_str(value):
+    return value
+
+
+def to_json(value):
+    return json.loads(value)
+
+
+CONVERTERS = {
+    "float": to_float,
+    "int": to_int,
+    "millis": to_millis,
+    "bool": to_bool,
+    "str": to_str,
+    "json": to_json,
+}
+
+# MARKET:/L1: items
+L1_SCHEMA = {
+    "MID_OPEN": "float",
+    "HIGH": "float",
+    "LOW": "float",
+    "CHANGE": "float",
+    "CHANGE_PCT": "float",
+    "UPDATE_TIME": "str",
+    "MARKET_DELAY": "bool",
+    "MARKET_STATE": "str",
+    "BID": "float",
+    "OFFER": "float",
+    "STRIKE_PRICE": "float",
+    "ODDS": "float",
+}
+
+# CHART:<epic>:TICK and CHART:<epic>:<scale> items
+CHART_SCHEMA = {
+    "BID": "float",
+    "OFR": "float",
+    "LTP": "float",
+    "LTV": "float",
+    "TTV": "float",
+    "UTM": "millis",
+    "DAY_OPEN_MID": "float",
+    "DAY_NET_CHG_MID": "float",
+    "DAY_PERC_CHG_MID": "float",
+    "DAY_HIGH": "float",
+    "DAY_LOW": "float",
+    "OFR_OPEN": "float",
+    "OFR_HIGH": "float",
+    "OFR_LOW": "float",
+    "OFR_CLOSE": "float",
+    "BID_OPEN": "float",
+    "BID_HIGH": "float",
+    "BID_LOW": "float",
+    "BID_CLOSE": "float",
+    "LTP_OPEN": "float",
+    "LTP_HIGH": "float",
+    "LTP_LOW": "float",
+    "LTP_CLOSE": "float",
+    "CONS_END": "bool",
+    "CONS_TICK_COUNT": "int",
+}
+
+# ACCOUNT:<accountId> items
+ACCOUNT_SCHEMA = {
+    "PNL": "float",
+    "PNL_LR": "float",
+    "PNL_NLR": "float",
+    "DEPOSIT": "float",
+    "AVAILABLE_CASH": "float",
+    "FUNDS": "float",
+    "MARGIN": "float",
+    "MARGIN_LR": "float",
+    "MARGIN_NLR": "float",
+    "AVAILABLE_TO_DEAL": "float",
+    "EQUITY": "float",
+    "EQUITY_USED": "float",
+}
+
+# TRADE:<accountId> items, whose fields carry JSON documents
+TRADE_SCHEMA = {
+    "CONFIRMS": "json",
+    "OPU": "json",
+    "WOU": "json",
+}
+
+SCHEMAS = {
+    "L1": L1_SCHEMA,
+    "MARKET": L1_SCHEMA,
+    "CHART": CHART_SCHEMA,
+    "ACCOUNT": ACCOUNT_SCHEMA,
+    "TRADE": TRADE_SCHEMA,
+}
+
+
+def compile_schema(field_names, schema):
+    """Returns the list of converters for the given fields, in the same
+    order, from a schema given as a preset name ("L1", "CHART", "ACCOUNT",
+    "TRADE") or as a dict of field name -> type name or callable.
+    Fields missing from the schema get None and are left as strings.
+    """
+    if schema is None:
+        return [None] * len(field_names)
+    if isinstance(schema, str):
+        try:
+            schema = SCHEMAS[schema.upper()]
+        except KeyError:
+            raise ValueError("Unknown schema %r, expected one of %s" % (schema, sorted(SCHEMAS)))
+
+    converters = []
+    for field_name in field_names:
+        converter = schema.get(field_name)
+        if converter is not None and not callable(converter):
+            try:
+                converter = CONVERTERS[converter]
+            except KeyError:
+                raise ValueError("Unknown type %r for field %s" % (converter, field_name))
+        if converter is to_str:
+            converter = None
+        converters.append(converter)
+    return converters
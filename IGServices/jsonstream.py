@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental parsing of large JSON responses.
+
+JSONStreamParser reads a JSON object from an iterable of text or bytes
+chunks (e.g. a requests response opened with stream=True) and yields the
+elements of its top-level arrays of the given keys one at a time, without
+holding the whole text or object tree. ColumnBuilder collects such
+elements into columns and builds the DataFrame from them, so the peak
+memory is close to the size of the frame.
+"""
+
+import codecs
+import json
+import logging
+
+from IGServices.utils import _HAS_PANDAS
+
+if _HAS_PANDAS:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks read from a response
+CHUNK_SIZE = 65536
+
+# Parsed text kept in the buffer before it is dropped
+_TRIM_SIZE = 1 << 20
+
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = ",:]}" + _WHITESPACE
+
+
+class JSONStreamParser(object):
+    """Iterates over the (key, element) of the top-level arrays of the given
+    keys of a JSON object read from chunks. The other top-level values are
+    parsed whole into fields, complete once the iteration is over.
+    """
+
+    def __init__(self, chunks, keys):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.keys = frozenset(keys)
+        self.fields = {}
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """Appends the next chunk to the buffer, returns False at the end"""
+        if self._eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            self._buffer += self._utf8.decode(b"", final=True)
+            return False
+        if isinstance(chunk, bytes):
+            chunk = self._utf8.decode(chunk)
+        if self._pos > _TRIM_SIZE:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += chunk
+        return True
+
+    def _peek(self):
+        """Skips the whitespace, returns the next character ('' at the end)"""
+        while True:
+            buffer = self._buffer
+            while self._pos < len(buffer) and buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(buffer):
+                return buffer[self._pos]
+            if not self._read():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected %r at %d, found %r" % (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decodes the next value, reading chunks until it is complete"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # A number ending the buffer may go on in the next chunk
+            if (end == len(self._buffer) or self._buffer[end] not in _DELIMITERS) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key in self.keys and self._peek() == "[":
+                self._pos += 1
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.fields[key] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def iter_response_chunks(response, chunk_size=CHUNK_SIZE):
+    """Returns the raw chunks of a response opened with stream=True"""
+    return response.iter_content(chunk_size=chunk_size)
+
+
+class ColumnBuilder(object):
+    """Collects dict elements into columns, one list per key. Nested dicts
+    are flattened into dotted columns ("openPrice.bid") when flatten is
+    True. Keys missing from an element are None, as in pd.DataFrame.
+    """
+
+    def __init__(self, flatten=False):
+        self.flatten = flatten
+        self._columns = {}
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def _flatten(self, element, prefix, flat):
+        for key, value in element.items():
+            if isinstance(value, dict):
+                self._flatten(value, prefix + key + ".", flat)
+            else:
+                flat[prefix + key] = value
+        return flat
+
+    def append(self, element):
+        if self.flatten:
+            element = self._flatten(element, "", {})
+        columns = self._columns
+        for key, value in element.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * self._rows
+            column.append(value)
+        self._rows += 1
+        if len(element) < len(columns):
+            for column in columns.values():
+                if len(column) < self._rows:
+                    column.append(None)
+
+    def frame(self):
+        """Returns the DataFrame of the elements (the dict of columns
+        without pandas)
+        """
+        columns, self._columns = self._columns, {}
+        if not _HAS_PANDAS:
+            return columns
+        return pd.DataFrame(columns)
+
+
+def parse_columns(chunks, builders):
+    """Feeds the elements of the top-level arrays of a JSON object read
+    from chunks into the ColumnBuilders, by key, and returns the other
+    top-level values
+    """
+    parser = JSONStreamParser(chunks, builders)
+    for key, element in parser:
+        builders[key].append(element)
+    return parser.fields
@@ -14,11 +14,19 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import collections
 import logging
+import random
+import socket
 import threading
+import time
 import traceback
 import sys
 
+from IGServices.dispatcher import Conflator
+from IGServices.fields import compile_schema
+from IGServices.metrics import StreamMetrics
+
 from six.moves.urllib.request import urlopen as _urlopen
 from six.moves.urllib.parse import urlparse as parse_url, urljoin, urlencode
 
@@ -52,21 +60,105 @@ LOOP_CMD = "LOOP"
 ERROR_CMD = "ERROR"
 SYNC_ERROR_CMD = "SYNC ERROR"
 OK_CMD = "OK"
+# Subscription modes
+MODE_MERGE = "MERGE"
+MODE_DISTINCT = "DISTINCT"
+MODE_COMMAND = "COMMAND"
+MODE_RAW = "RAW"
+# Commands of the COMMAND mode updates
+COMMAND_ADD = "ADD"
+COMMAND_UPDATE = "UPDATE"
+COMMAND_DELETE = "DELETE"
+# Connection status values notified to the connection listeners
+STATUS_CONNECTED = "CONNECTED"
+STATUS_REBOUND = "REBOUND"
+STATUS_RECOVERING = "RECOVERING"
+STATUS_RECOVERED = "RECOVERED"
+STATUS_DISCONNECTED = "DISCONNECTED"
 
 log = logging.getLogger(__name__)
 
 
 class Subscription(object):
-    """Represents a Subscription to be submitted to a Lightstreamer Server."""
-
-    def __init__(self, mode, items, fields, adapter=""):
+    """Represents a Subscription to be submitted to a Lightstreamer Server.
+
+    When conflate_interval (milliseconds) is given, the updates of each
+    item are merged while the listeners are busy and delivered at most
+    once per interval, with "changed" holding every field updated since
+    the previous delivery.
+
+    When a schema is given (a preset name such as "L1", "CHART",
+    "ACCOUNT", "TRADE", or a dict of field name -> "float", "int",
+    "millis", "bool", "str", "json" or a callable), the field values
+    are converted once when decoded and listeners get native types.
+
+    max_frequency (updates per second per item, or "unlimited") and
+    buffer_size (updates queued per item on the server, or "unlimited")
+    let Lightstreamer Server filter the updates before they are sent.
+    snapshot turns the initial snapshot on or off (on by default, never
+    requested in RAW mode), snapshot_length limits it to the last events
+    in DISTINCT mode. Invalid combinations raise a ValueError.
+
+    In COMMAND mode each item keeps a table of rows by key (the key_field
+    value), updated in place by the ADD, UPDATE and DELETE commands (the
+    command_field value) and read with getcommandtable/getcommandvalue.
+    In DISTINCT mode each item keeps its last distinct_length events,
+    read with getevents.
+    """
+
+    def __init__(self, mode, items, fields, adapter="", conflate_interval=None, schema=None,
+                 max_frequency=None, buffer_size=None, snapshot=None, snapshot_length=None,
+                 key_field="key", command_field="command", distinct_length=100):
         self.item_names = items
         self._items_map = {}
+        # Guards the updates of the item maps, read by other threads
+        self._lock = threading.Lock()
+        self._items_pos = dict((name, pos) for pos, name in enumerate(items, 1))
+        # COMMAND mode: item position -> {key: row values}
+        self._command_tables = None
+        self.key_field = key_field
+        self.command_field = command_field
+        if mode == MODE_COMMAND:
+            if key_field not in fields or command_field not in fields:
+                raise ValueError(
+                    "COMMAND mode requires the %r and %r fields" % (key_field, command_field)
+                )
+            self._command_tables = {}
+            self._key_index = fields.index(key_field)
+        # DISTINCT mode: item position -> bounded ring of the last events
+        self._events = None
+        self.distinct_length = distinct_length
+        if mode == MODE_DISTINCT:
+            self._events = {}
         self.field_names = fields
+        # Per-field converters, aligned with field_names
+        self._converters = compile_schema(fields, schema)
         self.adapter = adapter
         self.mode = mode
-        self.snapshot = "true"
+        if mode == MODE_RAW:
+            if snapshot or snapshot_length is not None:
+                raise ValueError("RAW mode does not support the snapshot")
+            # LS_snapshot is not sent at all
+            self.snapshot = None
+        elif snapshot_length is not None:
+            if mode != MODE_DISTINCT:
+                raise ValueError("snapshot_length is only valid in DISTINCT mode")
+            if snapshot is False:
+                raise ValueError("snapshot_length requires the snapshot")
+            self.snapshot = str(int(snapshot_length))
+        else:
+            self.snapshot = "false" if snapshot is False else "true"
+        self.max_frequency = max_frequency
+        self.buffer_size = buffer_size
         self._listeners = []
+        # Optional Dispatcher delivering updates away from the stream thread
+        self._dispatcher = None
+        # StreamMetrics of the LSClient and key this Subscription is registered with
+        self._metrics = None
+        self._subscription_key = None
+        self._conflator = None
+        if conflate_interval is not None:
+            self._conflator = Conflator(self, conflate_interval)
 
     def _decode(self, value, last):
         """Decode the field value according to
@@ -92,36 +184,146 @@ class Subscription(object):
         """
         # Tokenize the item line as sent by Lightstreamer
         toks = item_line.rstrip("\r\n").split("|")
-        undecoded_item = dict(list(zip(self.field_names, toks[1:])))
 
         # Retrieve the previous item stored into the map, if present.
         # Otherwise create a new empty dict.
         item_pos = int(toks[0])
         curr_item = self._items_map.get(item_pos, {})
+        previous = curr_item
+        if self._command_tables is not None:
+            # COMMAND mode: the fields of a row are merged with the
+            # previous values of the same key
+            key = self._decode(toks[self._key_index + 1], curr_item.get(self.key_field))
+            previous = dict(self._command_tables.get(item_pos, {}).get(key, ()))
+            previous[self.key_field] = curr_item.get(self.key_field)
+            previous[self.command_field] = curr_item.get(self.command_field)
         # Update the map with new values, merging with the
-        # previous ones if any.
-        self._items_map[item_pos] = dict(
-            [
-                (k, self._decode(v, curr_item.get(k)))
-                for k, v in list(undecoded_item.items())
-            ]
-        )
+        # previous ones if any: unchanged fields keep the value
+        # already converted, new ones are decoded and converted once.
+        values = {}
+        changed = []
+        for k, convert, v in zip(self.field_names, self._converters, toks[1:]):
+            if not v:
+                values[k] = previous.get(k)
+                continue
+            changed.append(k)
+            value = self._decode(v, None)
+            if convert is not None and value:
+                try:
+                    value = convert(value)
+                except (ValueError, TypeError):
+                    log.warning("Unable to convert {0}={1!r}".format(k, value))
+            values[k] = value
         # Make an item info as a new event to be passed to listeners
         item_info = {
             "pos": item_pos,
             "name": self.item_names[item_pos - 1],
-            "values": self._items_map[item_pos],
+            "values": values,
+            "changed": changed,
+            "received": time.perf_counter(),
         }
-
-        # Update each registered listener with new event
-        for on_item_update in self._listeners:
+        with self._lock:
+            self._items_map[item_pos] = values
+            if self._command_tables is not None:
+                key = values.get(self.key_field)
+                command = values.get(self.command_field)
+                table = self._command_tables.setdefault(item_pos, {})
+                if command == COMMAND_DELETE:
+                    table.pop(key, None)
+                else:
+                    table[key] = values
+                item_info["key"] = key
+                item_info["command"] = command
+            elif self._events is not None:
+                events = self._events.get(item_pos)
+                if events is None:
+                    events = self._events[item_pos] = collections.deque(maxlen=self.distinct_length)
+                events.append(values)
+        if self._metrics is not None:
+            self._metrics.on_update(self._subscription_key, item_info["name"])
+            self._metrics.on_values(values, changed)
+
+        if self._conflator is not None:
+            self._conflator.put(item_info)
+        elif self._dispatcher is not None:
+            self._dispatcher.put(self, item_info)
+        else:
+            self._deliver(item_info)
+
+    def _deliver(self, item_info, listeners=None):
+        """Update each registered listener (or the given ones, e.g. the
+        hand-off to a worker process) with new event"""
+        if self._metrics is not None:
+            self._metrics.on_dispatch(item_info["received"])
+        for on_item_update in self._listeners if listeners is None else listeners:
             on_item_update(item_info)
 
+    def _item_pos(self, item):
+        """Return the position of an item given by name or position."""
+        if isinstance(item, int):
+            return item
+        return self._items_pos[item]
+
+    def getcommandtable(self, item):
+        """Return a copy of the rows by key of an item in COMMAND mode."""
+        with self._lock:
+            return dict(self._command_tables.get(self._item_pos(item), ()))
+
+    def getcommandvalue(self, item, key, field=None):
+        """Return the row of a key of an item in COMMAND mode, or the
+        value of one of its fields; None if the key is not in the table.
+        """
+        with self._lock:
+            row = self._command_tables.get(self._item_pos(item), {}).get(key)
+        if row is None or field is None:
+            return row
+        return row.get(field)
+
+    def getevents(self, item):
+        """Return the last events of an item in DISTINCT mode, oldest first."""
+        with self._lock:
+            return list(self._events.get(self._item_pos(item), ()))
+
+    def _clear_snapshot(self):
+        """Drop the COMMAND tables and DISTINCT events before a new
+        snapshot replaces them.
+        """
+        with self._lock:
+            if self._command_tables is not None:
+                self._command_tables.clear()
+            if self._events is not None:
+                self._events.clear()
+
+    def getstate(self):
+        """Return the (item position, values) rebuilding the current state
+        of the items: the rows of the COMMAND tables, the DISTINCT events
+        or the last values of each item.
+        """
+        with self._lock:
+            state = []
+            for pos in sorted(self._items_map):
+                if self._command_tables is not None:
+                    rows = self._command_tables.get(pos, {}).values()
+                elif self._events is not None:
+                    rows = self._events.get(pos, ())
+                else:
+                    rows = [self._items_map[pos]]
+                state.extend((pos, values) for values in rows)
+            return state
+
+    def close(self, drain=True):
+        """Stop the delivery of conflated updates, if enabled."""
+        if self._conflator is not None:
+            self._conflator.stop(drain)
+
 
 class LSClient(object):
     """Manages the communication with Lightstreamer Server"""
 
-    def __init__(self, base_url, adapter_set="", user="", password=""):
+    def __init__(self, base_url, adapter_set="", user="", password="",
+                 auto_reconnect=True, reconnect_delay=1.0, max_reconnect_delay=60.0,
+                 max_reconnect_attempts=None, dispatcher=None, recorder=None,
+                 keepalive_millis=None, stall_timeout=None):
         self._base_url = parse_url(base_url)
         self._adapter_set = adapter_set
         self._user = user
@@ -132,7 +334,34 @@ class LSClient(object):
         self._stream_connection = None
         self._stream_connection_thread = None
         self._bind_counter = 0
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        # Set when the session is being destroyed or disconnected: an END
+        # or a broken stream must then not trigger a recovery
+        self._closing = False
+        self._connection_listeners = []
         self.content_length = 1000000000
+        # Session recovery settings: on SYNC ERROR, END or a broken
+        # stream a new session is created after a jittered exponential
+        # backoff and all the registered Subscriptions are replayed.
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self.recovery_counter = 0
+        self.metrics = StreamMetrics()
+        # Optional Dispatcher shared by all the Subscriptions, so that
+        # slow listeners never hold up the reads from the stream.
+        self.dispatcher = dispatcher
+        # Optional StreamRecorder capturing every raw line received
+        self.recorder = recorder
+        # Keepalive interval requested to the server (LS_keepalive_millis)
+        # and seconds without any byte after which the watchdog considers
+        # the stream dead, closes it and triggers the session recovery.
+        self.keepalive_millis = keepalive_millis
+        self.stall_timeout = stall_timeout
+        self._last_read = time.monotonic()
+        self._watchdog_thread = None
 
     def _encode_params(self, params):
         """Encode the parameter for HTTP POST submissions, but
@@ -146,7 +375,9 @@ class LSClient(object):
         # Combines the "base_url" with the
         # required "url" to be used for the specific request.
         url = urljoin(base_url.geturl(), url)
-        return _urlopen(url, data=self._encode_params(body))
+        if not isinstance(body, bytes):
+            body = self._encode_params(body)
+        return _urlopen(url, data=body)
 
     def _set_control_link_url(self, custom_address=None):
         """Set the address to use for the Control Connection
@@ -166,10 +397,57 @@ class LSClient(object):
         response = self._call(self._control_url, CONTROL_URL_PATH, params)
         return response.readline().decode("utf-8").rstrip()
 
+    def _control_many(self, params_list):
+        """Create a single Control Connection carrying a batch of control
+        commands, one per line, and return the server response to each
+        of them in the same order.
+        """
+        body = b"\r\n".join(
+            self._encode_params(dict(params, LS_session=self._session["SessionId"]))
+            for params in params_list
+        )
+        response = self._call(self._control_url, CONTROL_URL_PATH, body)
+        server_responses = []
+        for _ in params_list:
+            server_response = response.readline().decode("utf-8").rstrip()
+            if server_response == ERROR_CMD:
+                # An ERROR response is followed by the error code and message
+                error_code = response.readline().decode("utf-8").rstrip()
+                error_message = response.readline().decode("utf-8").rstrip()
+                server_response = "{0} {1} {2}".format(
+                    ERROR_CMD, error_code, error_message
+                )
+            server_responses.append(server_response)
+        return server_responses
+
     def _read_from_stream(self):
-        """Read a single line of content of the Stream Connection."""
-        line = self._stream_connection.readline().decode("utf-8").rstrip()
-        return line
+        """Read a single line of content of the Stream Connection,
+        None once the connection has been closed.
+        """
+        line = self._stream_connection.readline()
+        self._last_read = time.monotonic()
+        if not line:
+            return None
+        if self.recorder is not None:
+            self.recorder.record(line)
+        self.metrics.on_line(line)
+        return line.decode("utf-8").rstrip()
+
+    def addconnectionlistener(self, listener):
+        """Register a callable notified with the connection status
+        (STATUS_CONNECTED, STATUS_REBOUND, STATUS_RECOVERING,
+        STATUS_RECOVERED, STATUS_DISCONNECTED) each time it changes.
+        """
+        self._connection_listeners.append(listener)
+
+    def _notify_status(self, status):
+        log.debug("Connection status ---> <{0}>".format(status))
+        for on_status_change in self._connection_listeners:
+            try:
+                on_status_change(status)
+            except Exception:
+                log.error("Connection listener error")
+                log.error(traceback.format_exc())
 
     def connect(self):
         """Establish a connection to Lightstreamer Server to create
@@ -182,6 +460,68 @@ class LSClient(object):
                 "no watchdog notifications will be sent."
             )
 
+        self._closing = False
+        self._create_session()
+
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+
+        # Start a new thread to handle real time updates sent
+        # by Lightstreamer Server on the stream connection.
+        self._stop_event.clear()
+        self._stream_connection_thread = threading.Thread(
+            name="STREAM-CONN-THREAD", target=self._supervise,
+        )
+        self._stream_connection_thread.daemon = True
+        # Add "active connection" attribute to running thread
+        setattr(self._stream_connection_thread, "active_connection", True)
+        self._notify_status(STATUS_CONNECTED)
+        self._stream_connection_thread.start()
+
+        if self.stall_timeout:
+            self._watchdog_thread = threading.Thread(
+                name="STREAM-WATCHDOG-THREAD", target=self._watchdog,
+            )
+            self._watchdog_thread.daemon = True
+            self._watchdog_thread.start()
+
+    def _abort_stream(self):
+        """Force-close the socket of the Stream Connection, so that a read
+        blocked on it returns immediately.
+        """
+        connection = self._stream_connection
+        if connection is None:
+            return
+        try:
+            # urlopen response -> buffered reader -> SocketIO -> socket
+            sock = connection.fp.raw._sock
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            log.debug("Unable to shut the stream socket down, closing it")
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _watchdog(self):
+        """Body of the STREAM-WATCHDOG-THREAD: abort the Stream Connection
+        when nothing has been read for longer than stall_timeout, which
+        makes the STREAM-CONN-THREAD recover the session.
+        """
+        interval = min(1.0, self.stall_timeout / 4.0)
+        while not self._stop_event.wait(interval):
+            if self._stream_connection is None:
+                continue
+            stalled = time.monotonic() - self._last_read
+            if stalled > self.stall_timeout:
+                log.warning("No data from the stream for {0:.1f}s, reconnecting".format(stalled))
+                self.metrics.stalls += 1
+                self._abort_stream()
+                self._last_read = time.monotonic()
+
+    def _create_session(self):
+        """Open the Stream Connection of a brand new session."""
+        self._last_read = time.monotonic()
         self._stream_connection = self._call(
             self._base_url,
             CONNECTION_URL_PATH,
@@ -192,25 +532,31 @@ class LSClient(object):
                 "LS_user": self._user,
                 "LS_password": self._password,
                 "LS_content_length": self.content_length,
+                "LS_keepalive_millis": self.keepalive_millis,
             },
         )
         stream_line = self._read_from_stream()
         self._handle_stream(stream_line)
+        self.metrics.sessions += 1
 
     def bind(self):
         """Replace a completely consumed connection in listening for an active
-        Session.
+        Session. Invoked by the STREAM-CONN-THREAD upon a LOOP message.
         """
+        self._close_stream_connection()
+        self._last_read = time.monotonic()
         self._stream_connection = self._call(
             self._control_url,
             BIND_URL_PATH,
             {
                 "LS_session": self._session["SessionId"],
                 "LS_content_length": self.content_length,
+                "LS_keepalive_millis": self.keepalive_millis,
             },
         )
 
         self._bind_counter += 1
+        self.metrics.binds += 1
         stream_line = self._read_from_stream()
         self._handle_stream(stream_line)
 
@@ -227,39 +573,52 @@ class LSClient(object):
 
             # Setup of the control link url
             self._set_control_link_url(self._session.get("ControlAddress"))
-
-            # Start a new thread to handle real time updates sent
-            # by Lightstreamer Server on the stream connection.
-            self._stream_connection_thread = threading.Thread(
-                name="STREAM-CONN-THREAD-{0}".format(self._bind_counter),
-                target=self._receive,
-            )
-            self._stream_connection_thread.setDaemon(True)
-            # Add "active connection" attribute to running thread
-            setattr(self._stream_connection_thread, "active_connection", True)
-            self._stream_connection_thread.start()
         else:
-            lines = self._stream_connection.readlines()
-            lines.insert(0, stream_line)
+            lines = [line.decode("utf-8") for line in self._stream_connection.readlines()]
+            lines.insert(0, "{0}\n".format(stream_line))
             log.error("Server response error: \n{0}".format("".join(lines)))
             raise IOError()
 
+    def _close_stream_connection(self):
+        """Close the current Stream Connection, if any."""
+        if self._stream_connection is not None:
+            try:
+                self._stream_connection.close()
+            except Exception:
+                log.debug("Error while closing the stream connection")
+            self._stream_connection = None
+
     def _join(self):
         """Await the natural STREAM-CONN-THREAD termination."""
         if self._stream_connection_thread:
             log.debug("Waiting for thread to terminate")
+            self._closing = True
             self._stream_connection_thread.active_connection = False
+            self._stop_event.set()
+            # Unblock the read the thread may be waiting on
+            self._abort_stream()
             self._stream_connection_thread.join()
             self._stream_connection_thread = None
+            if self._watchdog_thread is not None:
+                self._watchdog_thread.join()
+                self._watchdog_thread = None
             log.debug("Thread terminated")
 
-    def disconnect(self):
+    def disconnect(self, drain=True, timeout=None):
         """Request to close the session previously opened with
-        the connect() invocation.
+        the connect() invocation. The updates still queued in the
+        Dispatcher are delivered first unless drain is False. The
+        Dispatcher, which may be shared by several clients, is left
+        running: its owner stops it.
         """
-        if self._stream_connection is not None:
+        if self._stream_connection is not None or self._stream_connection_thread is not None:
             # Exits stream thread loop, joins and exits stream thread, closes connection
             self._join()
+            if self.dispatcher is not None and drain:
+                # Deliver the updates still queued before leaving
+                self.dispatcher.join(timeout)
+            if self.recorder is not None:
+                self.recorder.flush()
             log.debug("Connection closed")
             print("DISCONNECTED FROM LIGHTSTREAMER")
         else:
@@ -270,51 +629,141 @@ class LSClient(object):
         the connect() invocation.
         """
         if self._stream_connection is not None:
+            # The END sent by the server must not start a recovery
+            self._closing = True
             server_response = self._control({"LS_op": OP_DESTROY})
             if server_response == OK_CMD:
                 # There is no need to explicitly close the connection,
                 # since it is handled by thread completion.
                 self._join()
             else:
+                self._closing = False
                 log.warning("No connection to Lightstreamer")
 
-    def subscribe(self, subscription):
-        """"Perform a subscription request to Lightstreamer Server."""
-        # Register the Subscription with a new subscription key
+    def _subscription_params(self, subscription_key, subscription):
+        """Build the control request parameters that create the Table
+        for the given Subscription.
+        """
+        params = {
+            "LS_Table": subscription_key,
+            "LS_op": OP_ADD,
+            "LS_data_adapter": subscription.adapter,
+            "LS_mode": subscription.mode,
+            "LS_schema": " ".join(subscription.field_names),
+            "LS_id": " ".join(subscription.item_names),
+            "LS_requested_max_frequency": subscription.max_frequency,
+            "LS_requested_buffer_size": subscription.buffer_size,
+        }
+        # No snapshot in RAW mode, a snapshot length only in DISTINCT mode
+        if subscription.mode != MODE_RAW:
+            params["LS_snapshot"] = subscription.snapshot
+        return params
+
+    def _register(self, subscription):
+        """Register the Subscription with a new subscription key."""
+        if subscription._dispatcher is None:
+            subscription._dispatcher = self.dispatcher
         self._current_subscription_key += 1
         self._subscriptions[self._current_subscription_key] = subscription
+        subscription._metrics = self.metrics
+        subscription._subscription_key = self._current_subscription_key
+        return self._current_subscription_key
 
-        # Send the control request to perform the subscription
-        server_response = self._control(
-            {
-                "LS_Table": self._current_subscription_key,
-                "LS_op": OP_ADD,
-                "LS_data_adapter": subscription.adapter,
-                "LS_mode": subscription.mode,
-                "LS_schema": " ".join(subscription.field_names),
-                "LS_id": " ".join(subscription.item_names),
-            }
-        )
+    def subscribe(self, subscription):
+        """"Perform a subscription request to Lightstreamer Server."""
+        with self._lock:
+            subscription_key = self._register(subscription)
+
+            # Send the control request to perform the subscription
+            server_response = self._control(
+                self._subscription_params(subscription_key, subscription)
+            )
         log.debug("Server response ---> <{0}>".format(server_response))
-        return self._current_subscription_key
+        return subscription_key
+
+    def subscribe_many(self, subscriptions):
+        """Perform the subscription requests for all the given Subscriptions
+        through a single batched control request to Lightstreamer Server.
+        Returns the list of subscription keys, in the same order.
+        """
+        subscription_keys = []
+        params_list = []
+        with self._lock:
+            for subscription in subscriptions:
+                subscription_key = self._register(subscription)
+                subscription_keys.append(subscription_key)
+                params_list.append(
+                    self._subscription_params(subscription_key, subscription)
+                )
+
+            if not params_list:
+                return subscription_keys
+
+            server_responses = self._control_many(params_list)
+        for subscription_key, server_response in zip(subscription_keys, server_responses):
+            log.debug(
+                "Server response for table {0} ---> <{1}>".format(
+                    subscription_key, server_response
+                )
+            )
+            if server_response != OK_CMD:
+                log.warning(
+                    "Subscription {0} failed: {1}".format(subscription_key, server_response)
+                )
+        return subscription_keys
 
     def unsubscribe(self, subcription_key):
         """Unregister the Subscription associated to the
         specified subscription_key.
         """
-        if subcription_key in self._subscriptions:
-            server_response = self._control(
-                {"LS_Table": subcription_key, "LS_op": OP_DELETE}
-            )
-            log.debug("Server response ---> <{0}>".format(server_response))
-
-            if server_response == OK_CMD:
-                del self._subscriptions[subcription_key]
-                log.info("Unsubscribed successfully")
+        with self._lock:
+            if subcription_key in self._subscriptions:
+                server_response = self._control(
+                    {"LS_Table": subcription_key, "LS_op": OP_DELETE}
+                )
+                log.debug("Server response ---> <{0}>".format(server_response))
+
+                if server_response == OK_CMD:
+                    self._subscriptions.pop(subcription_key).close()
+                    self.metrics.forget(subcription_key)
+                    log.info("Unsubscribed successfully")
+                else:
+                    log.warning("Server error")
             else:
-                log.warning("Server error")
-        else:
-            log.warning("No subscription key {0} found!".format(subcription_key))
+                log.warning("No subscription key {0} found!".format(subcription_key))
+
+    def unsubscribe_many(self, subscription_keys):
+        """Unregister all the Subscriptions associated to the specified
+        subscription keys through a single batched control request.
+        """
+        with self._lock:
+            known_keys = []
+            for subscription_key in subscription_keys:
+                if subscription_key in self._subscriptions:
+                    known_keys.append(subscription_key)
+                else:
+                    log.warning("No subscription key {0} found!".format(subscription_key))
+
+            if not known_keys:
+                return
+
+            server_responses = self._control_many(
+                [{"LS_Table": key, "LS_op": OP_DELETE} for key in known_keys]
+            )
+            for subscription_key, server_response in zip(known_keys, server_responses):
+                log.debug(
+                    "Server response for table {0} ---> <{1}>".format(
+                        subscription_key, server_response
+                    )
+                )
+                if server_response == OK_CMD:
+                    self._subscriptions.pop(subscription_key).close()
+                    self.metrics.forget(subscription_key)
+                else:
+                    log.warning(
+                        "Unsubscription {0} failed: {1}".format(subscription_key, server_response)
+                    )
+        log.info("Unsubscribed {0} subscriptions".format(len(known_keys)))
 
     def _forward_update_message(self, update_message):
         """Forwards the real time update to the relative
@@ -328,8 +777,126 @@ class LSClient(object):
         else:
             log.warning("No subscription found!")
 
+    def _resubscribe(self):
+        """Replay every registered Subscription, with its original
+        subscription key, on the current session through a single
+        batched control request. The last values of the items are kept,
+        so the new snapshot is merged onto them, while the COMMAND tables
+        and DISTINCT events are rebuilt from the new snapshot: rows deleted
+        and events received meanwhile would be stale or repeated.
+        """
+        with self._lock:
+            subscription_keys = sorted(self._subscriptions)
+            if not subscription_keys:
+                return
+            for key in subscription_keys:
+                subscription = self._subscriptions[key]
+                if subscription.snapshot not in (None, "false"):
+                    subscription._clear_snapshot()
+            server_responses = self._control_many(
+                [
+                    self._subscription_params(key, self._subscriptions[key])
+                    for key in subscription_keys
+                ]
+            )
+        failed = [
+            key for key, server_response in zip(subscription_keys, server_responses)
+            if server_response != OK_CMD
+        ]
+        if failed:
+            log.warning("Resubscription failed for tables {0}".format(failed))
+        log.info(
+            "Resubscribed {0} subscriptions".format(len(subscription_keys) - len(failed))
+        )
+
+    def _reconnect_backoff(self, attempt):
+        """Return the delay before the given recovery attempt: an
+        exponential backoff, capped and randomized to avoid many
+        clients hitting the server in lockstep.
+        """
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * (2 ** attempt))
+        return random.uniform(delay / 2.0, delay)
+
+    def _recover(self):
+        """Create a new session and resubscribe all the registered
+        Subscriptions, retrying with backoff until it succeeds, the
+        attempts are exhausted or the client is disconnected.
+        """
+        self._notify_status(STATUS_RECOVERING)
+        self._close_stream_connection()
+        attempt = 0
+        while self._stream_connection_thread.active_connection and not self._closing:
+            if (self.max_reconnect_attempts is not None
+                    and attempt >= self.max_reconnect_attempts):
+                log.error("Session recovery failed after {0} attempts".format(attempt))
+                return False
+
+            delay = self._reconnect_backoff(attempt)
+            log.info("Recovering the session in {0:.2f}s".format(delay))
+            if self._stop_event.wait(delay):
+                return False
+            attempt += 1
+
+            try:
+                self._session.clear()
+                self._create_session()
+                self._resubscribe()
+            except Exception:
+                log.warning("Session recovery attempt {0} failed".format(attempt))
+                log.debug(traceback.format_exc())
+                self._close_stream_connection()
+                continue
+
+            self.recovery_counter += 1
+            self.metrics.recoveries += 1
+            log.info("Session recovered")
+            self._notify_status(STATUS_RECOVERED)
+            return True
+        return False
+
+    def _supervise(self):
+        """Body of the STREAM-CONN-THREAD: keep receiving messages,
+        rebinding the session on LOOP and recovering a new session
+        on SYNC ERROR, END or stream failures.
+        """
+        while self._stream_connection_thread.active_connection:
+            outcome = self._receive()
+            if not self._stream_connection_thread.active_connection or self._closing:
+                break
+
+            if outcome == LOOP_CMD:
+                log.debug("Binding to this active session")
+                try:
+                    self.bind()
+                    self._notify_status(STATUS_REBOUND)
+                    continue
+                except Exception:
+                    log.warning("Rebind failed, creating a new session")
+                    log.debug(traceback.format_exc())
+            elif outcome == ERROR_CMD:
+                break
+
+            if not self.auto_reconnect or not self._recover():
+                break
+
+        log.debug("Closing connection")
+        # Clear internal data structures for session
+        # and subscriptions management.
+        self._close_stream_connection()
+        self._session.clear()
+        with self._lock:
+            for subscription in list(self._subscriptions.values()):
+                subscription.close()
+            self._subscriptions.clear()
+            self._current_subscription_key = 0
+        self._notify_status(STATUS_DISCONNECTED)
+
     def _receive(self):
-        rebind = False
+        """Receive messages from the Stream Connection until it has to be
+        left, returning the reason: LOOP_CMD, SYNC_ERROR_CMD, END_CMD,
+        ERROR_CMD, or None for a broken connection or a disconnection.
+        """
+        outcome = None
         receive = True
         while receive and self._stream_connection_thread.active_connection:
             log.debug("Waiting for a new message")
@@ -350,49 +917,42 @@ class LSClient(object):
             elif message == PROBE_CMD:
                 # Skipping the PROBE message, keep on receiving messages.
                 log.debug("PROBE message")
+                self.metrics.on_probe()
             elif message.startswith(ERROR_CMD):
                 # Terminate the receiving loop on ERROR message
                 receive = False
+                outcome = ERROR_CMD
                 log.error("ERROR")
             elif message.startswith(LOOP_CMD):
-                # Terminate the the receiving loop on LOOP message.
-                # A complete implementation should proceed with
-                # a rebind of the session.
+                # Terminate the the receiving loop on LOOP message,
+                # the session is then rebound by the supervisor.
                 log.debug("LOOP")
-                rebind = True
+                outcome = LOOP_CMD
                 receive = False
             elif message.startswith(SYNC_ERROR_CMD):
-                # Terminate the receiving loop on SYNC ERROR message.
-                # A complete implementation should create a new session
-                # and re-subscribe to all the old items and relative fields.
+                # Terminate the receiving loop on SYNC ERROR message,
+                # the supervisor creates a new session and re-subscribes
+                # to all the old items and relative fields.
                 log.error("SYNC ERROR")
+                outcome = SYNC_ERROR_CMD
                 receive = False
             elif message.startswith(END_CMD):
                 # Terminate the receiving loop on END message.
                 # The session has been forcibly closed on the server side.
-                # A complete implementation should handle the
-                # "cause_code" if present.
-                log.info("Connection closed by the server")
+                log.info("Connection closed by the server: {0}".format(message))
+                outcome = END_CMD
                 receive = False
             elif message.startswith("Preamble"):
                 # Skipping Preamble message, keep on receiving messages.
                 log.debug("Preamble")
             else:
-                self._forward_update_message(message)
+                try:
+                    self._forward_update_message(message)
+                except Exception:
+                    log.error("Unable to dispatch message <{0}>".format(message))
+                    log.error(traceback.format_exc())
 
-        if not rebind:
-            log.debug("Closing connection")
-            # Clear internal data structures for session
-            # and subscriptions management.
-            self._stream_connection.close()
-            self._stream_connection = None
-            self._session.clear()
-            self._subscriptions.clear()
-            self._current_subscription_key = 0
-        else:
-            log.debug("Binding to this active session")
-            self._stream_connection = None
-            self.bind()
+        return outcome
 
 
 if __name__ == "__main__":
@@ -452,4 +1012,4 @@ if __name__ == "__main__":
 
     import atexit
 
-    atexit.register(handler)
\ No newline at end of file
+    atexit.register(handler)
\ No newline at end of file
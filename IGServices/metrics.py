@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms measuring the health of the Lightstreamer stream.
+"""
+
+import math
+import threading
+import time
+from datetime import datetime
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+# IG streams UPDATE_TIME as a London wall clock time
+IG_TIMEZONE = "Europe/London"
+
+
+class Meter(object):
+    """Counts events and measures their rate per second over the last
+    window seconds, using one bucket per second.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.count = 0
+        self._buckets = [0] * window
+        self._seconds = [0] * window
+        self._started = time.monotonic()
+
+    def mark(self, n=1):
+        second = int(time.monotonic())
+        index = second % self.window
+        if self._seconds[index] != second:
+            self._seconds[index] = second
+            self._buckets[index] = 0
+        self._buckets[index] += n
+        self.count += n
+
+    def rate(self):
+        """Returns the events per second over the completed seconds of
+        the window.
+        """
+        now = time.monotonic()
+        second = int(now)
+        total = sum(
+            n for n, s in zip(self._buckets, self._seconds)
+            if second - self.window < s < second
+        )
+        span = min(self.window - 1, int(now - self._started))
+        return total / float(span) if span > 0 else 0.0
+
+    def snapshot(self):
+        return {"count": self.count, "rate": self.rate()}
+
+
+class Histogram(object):
+    """Distribution of positive values in logarithmic buckets (4 per
+    power of 2), giving percentiles within about 12% without keeping
+    the samples.
+    """
+
+    SUB_BUCKETS = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        mantissa, exponent = math.frexp(value)
+        return exponent * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+
+    def _midpoint(self, index):
+        exponent, sub = divmod(index, self.SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 0.5) / (2.0 * self.SUB_BUCKETS), exponent)
+
+    def update(self, value):
+        if value < 0:
+            value = 0.0
+        with self._lock:
+            index = self._index(value) if value > 0 else None
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            zero = self._buckets.get(None, 0)
+            if zero >= rank:
+                return 0.0
+            seen = zero
+            for index in sorted(k for k in self._buckets if k is not None):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return min(max(self._midpoint(index), self.min), self.max)
+            return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+        }
+
+
+class StreamMetrics(object):
+    """Metrics of an LSClient and of its Subscriptions: message and byte
+    rates, PROBE intervals, bind/rebind/recovery counts, per subscription
+    and per item update rates, reader-to-listener dispatch latency and
+    server-to-local feed lag, all in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_probe = None
+        self.messages = Meter()
+        self.bytes_read = Meter()
+        self.updates = Meter()
+        self.probe_interval = Histogram()
+        self.dispatch_latency = Histogram()
+        self.feed_lag = Histogram()
+        self.sessions = 0
+        self.binds = 0
+        self.recoveries = 0
+        self.stalls = 0
+        self._subscription_meters = {}
+        self._item_meters = {}
+        self._timezone = None
+        if ZoneInfo is not None:
+            try:
+                self._timezone = ZoneInfo(IG_TIMEZONE)
+            except Exception:
+                # No time zone database (e.g. Windows without tzdata)
+                pass
+
+    def on_line(self, line):
+        self.messages.mark()
+        self.bytes_read.mark(len(line))
+
+    def on_probe(self):
+        now = time.monotonic()
+        if self._last_probe is not None:
+            self.probe_interval.update(now - self._last_probe)
+        self._last_probe = now
+
+    def on_update(self, subscription_key, item_name):
+        self.updates.mark()
+        meter = self._subscription_meters.get(subscription_key)
+        if meter is None:
+            with self._lock:
+                meter = self._subscription_meters.setdefault(subscription_key, Meter())
+        meter.mark()
+        key = (subscription_key, item_name)
+        meter = self._item_meters.get(key)
+        if meter is None:
+            with self._lock:
+                meter = self._item_meters.setdefault(key, Meter())
+        meter.mark()
+
+    def on_dispatch(self, received):
+        """Record the delay between the read of an update, at the
+        perf_counter() time received, and its delivery to the listeners.
+        """
+        self.dispatch_latency.update(time.perf_counter() - received)
+
+    def on_values(self, values, changed):
+        """Record the feed lag from the server timestamp of an update:
+        UTM (epoch milliseconds) when updated, otherwise UPDATE_TIME.
+        """
+        utm = values.get("UTM") if "UTM" in changed else None
+        if utm:
+            if isinstance(utm, datetime):
+                server_time = utm.timestamp()
+            else:
+                try:
+                    server_time = int(utm) / 1000.0
+                except ValueError:
+                    return
+            self.feed_lag.update(time.time() - server_time)
+            return
+
+        update_time = values.get("UPDATE_TIME") if "UPDATE_TIME" in changed else None
+        if update_time and self._timezone is not None:
+            try:
+                hours, minutes, seconds = [int(t) for t in update_time.split(":")]
+            except ValueError:
+                return
+            now = datetime.now(self._timezone)
+            lag = (now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+                   - (hours * 3600 + minutes * 60 + seconds))
+            # Wrap around midnight; small negative lags are clock skew
+            if lag < -43200:
+                lag += 86400
+            elif lag > 43200:
+                lag -= 86400
+            self.feed_lag.update(max(lag, 0.0))
+
+    def forget(self, subscription_key):
+        """Drop the meters of an unsubscribed subscription."""
+        with self._lock:
+            self._subscription_meters.pop(subscription_key, None)
+            for key in [k for k in self._item_meters if k[0] == subscription_key]:
+                del self._item_meters[key]
+
+    def snapshot(self):
+        """Returns all the metrics as a dict."""
+        with self._lock:
+            subscription_meters = list(self._subscription_meters.items())
+            item_meters = list(self._item_meters.items())
+        return {
+            "messages": self.messages.snapshot(),
+            "bytes_read": self.bytes_read.snapshot(),
+            "updates": self.updates.snapshot(),
+            "probe_interval": self.probe_interval.snapshot(),
+            "dispatch_latency": self.dispatch_latency.snapshot(),
+            "feed_lag": self.feed_lag.snapshot(),
+            "sessions": self.sessions,
+            "binds": self.binds,
+            "recoveries": self.recoveries,
+            "stalls": self.stalls,
+            "subscriptions": dict((k, m.snapshot()) for k, m in subscription_meters),
+            "items": dict(("%s:%s" % k, m.snapshot()) for k, m in item_meters),
+        }
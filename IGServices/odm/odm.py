@@ -11,6 +11,7 @@ from bson import json_util
 from rest import IGService
 from stream import IGStreamService
 from lightstreamer import Subscription
+from dispatcher import Dispatcher, POLICY_BLOCK
 from pymongo import MongoClient
 from datetime import datetime
 
@@ -36,7 +37,8 @@ ig_service = IGService(
     config.username, config.password, config.api_key, config.acc_type, acc_id=config.acc_id
 )
 
-ig_stream_service = IGStreamService(ig_service)
+'''Listeners run on the dispatcher thread, not on the stream reader'''
+ig_stream_service = IGStreamService(ig_service, dispatcher=Dispatcher(maxsize=10000, policy=POLICY_BLOCK))
 ig_stream_service.create_session()
 dlist = ['CHART:CS.D.GBPUSD.CFD.IP:SECOND',
          'CHART:CS.D.USDJPY.CFD.IP:SECOND',
@@ -50,16 +52,14 @@ def on_item_update(item_update):
 
     now = datetime.now()
     dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+    '''Values are already floats, decoded once with the CHART schema'''
+    values = item_update["values"]
     jmsg = {'Date': dt_string, 'ID': ('{stock_name:<19}'.format(
-        stock_name=item_update["name"], **item_update["values"])),
-            'Bid Open': float ("{BID_OPEN:>5}".format(
-                stock_name=item_update["name"], **item_update["values"])),
-            'Bid high': float ('{BID_HIGH:>5}'.format(
-                stock_name=item_update["name"], **item_update["values"])),
-            'Bid low': float ('{BID_LOW:>5}'.format(
-                stock_name=item_update["name"], **item_update["values"])),
-            'Bid close': float ('{BID_CLOSE:>5}'.format(
-                stock_name=item_update["name"], **item_update["values"]))
+        stock_name=item_update["name"])),
+            'Bid Open': values["BID_OPEN"],
+            'Bid high': values["BID_HIGH"],
+            'Bid low': values["BID_LOW"],
+            'Bid close': values["BID_CLOSE"]
             }
     '''BSON Verification  - expected output must be binary'''
     bmsg = bson.BSON.encode(jmsg)
@@ -67,16 +67,20 @@ def on_item_update(item_update):
     print(jmsg)
 
 def ig_dump():
+    subscriptions = []
     for i in dlist:
         subscription = Subscription(
             mode="MERGE",
             items=[i], # sample CFD epics
             #items=["L1:CS.D.GB'PUSD.TODAY.IP", "L1:IX.D.FTSE.DAILY.IP"], # sample spreadbet epics
             fields=['BID_OPEN','BID_HIGH','BID_LOW','BID_CLOSE'],
+            schema="CHART",
         )
         '''Subscriber settings & end calls'''
         subscription.addlistener(on_item_update)
-        sub_key = ig_stream_service.ls_client.subscribe(subscription)
+        subscriptions.append(subscription)
+    '''One control round trip for the whole list'''
+    sub_keys = ig_stream_service.ls_client.subscribe_many(subscriptions)
 
 '''kick start dumping process'''
 ig_dump()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Historical prices allowance and planning of the downloads within it.
+
+The IG price responses carry an allowance block: the data points still
+available (remainingAllowance) out of the weekly ones (totalAllowance)
+and the seconds before it is reset (allowanceExpiry). DownloadPlanner
+splits (epic, resolution, start, end) jobs into requests, estimates their
+cost in points and runs them across the allowance windows, saving its
+progress to a JSON file so that a download resumes where it stopped.
+"""
+
+import collections
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime, timedelta
+
+from IGServices.candles import resolution_seconds
+from IGServices.utils import conv_datetime
+
+logger = logging.getLogger(__name__)
+
+# Default IG historical data allowance, in points per week
+DEFAULT_ALLOWANCE = 10000
+ALLOWANCE_PERIOD = 7 * 86400
+
+# Share of the intraday and daily bars the markets are open for (closed at
+# the week-end)
+TRADING_WEEK = 5 / 7.0
+
+Allowance = collections.namedtuple("Allowance", ["remaining", "total", "expiry", "updated"])
+Allowance.__doc__ = """Historical prices allowance: points remaining and total, time of
+the reset and of the response (epoch seconds)"""
+
+DownloadJob = collections.namedtuple("DownloadJob", ["epic", "resolution", "start", "end"])
+
+# Requests of a job: [start, end] of the bars and estimated cost
+DownloadChunk = collections.namedtuple("DownloadChunk", ["job", "start", "end", "points"])
+
+
+def parse_allowance(data, updated=None):
+    """Returns the Allowance of a price response (v1/v2 allowance block or
+    v3 metadata), None if it has none
+    """
+    block = data.get("allowance")
+    if block is None:
+        block = (data.get("metadata") or {}).get("allowance")
+    if not block:
+        return None
+    updated = updated or time.time()
+    return Allowance(
+        remaining=int(block["remainingAllowance"]),
+        total=int(block["totalAllowance"]),
+        expiry=updated + float(block["allowanceExpiry"]),
+        updated=updated,
+    )
+
+
+def _bar_seconds(resolution):
+    if resolution == "MONTH":
+        return resolution, 30 * 86400
+    return resolution_seconds(resolution)
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).replace("/", "-"))
+
+
+def estimate_points(resolution, start, end):
+    """Returns the estimated number of bars (points of allowance) of a
+    resolution between start and end
+    """
+    _, seconds = _bar_seconds(resolution)
+    points = (_to_datetime(end) - _to_datetime(start)).total_seconds() / seconds
+    if seconds <= 86400:
+        points *= TRADING_WEEK
+    return int(math.ceil(max(points, 0)))
+
+
+def _job_key(job):
+    return "%s|%s|%s|%s" % (job.epic, job.resolution, job.start.isoformat(), job.end.isoformat())
+
+
+class DownloadPlanner(object):
+    """Downloads the historical prices of a list of jobs within the price
+    allowance.
+
+    Each job is split into requests of about max_points bars. run() sends
+    them in order until the allowance left (ig_service.allowance, updated
+    by each price response) is short of the next request, then waits for
+    the reset or returns. The end of the last downloaded request of each
+    job is saved to the JSON file path after each request, so a new planner
+    given the same jobs and path skips what was already downloaded.
+    on_prices(job, chunk, data) receives each response.
+    """
+
+    def __init__(self, ig_service, jobs=(), path=None, max_points=1000, on_prices=None,
+                 default_allowance=DEFAULT_ALLOWANCE):
+        self.ig_service = ig_service
+        self.path = path
+        self.max_points = max_points
+        self.on_prices = on_prices
+        self.default_allowance = default_allowance
+        self.jobs = []
+        # job key -> end (ISO) of the last downloaded request
+        self.progress = {}
+        self.points_downloaded = 0
+        self.load()
+        for job in jobs:
+            self.add(*job)
+
+    def add(self, epic, resolution, start, end):
+        """Adds a job, returns its DownloadJob"""
+        name, _ = _bar_seconds(resolution)
+        job = DownloadJob(epic, name, _to_datetime(start), _to_datetime(end))
+        self.jobs.append(job)
+        return job
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            state = json.load(f)
+        self.progress = state.get("progress", {})
+        self.points_downloaded = state.get("points_downloaded", 0)
+
+    def save(self):
+        if self.path is None:
+            return
+        state = {"progress": self.progress, "points_downloaded": self.points_downloaded}
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(temp, self.path)
+
+    def chunks(self, job=None):
+        """Returns the DownloadChunks still to download, of a job or all.
+        The date ranges of the API include both ends, so each chunk starts
+        one bar after the end of the previous one
+        """
+        chunks = []
+        for job in [job] if job is not None else self.jobs:
+            _, seconds = _bar_seconds(job.resolution)
+            bar = timedelta(seconds=seconds)
+            done = self.progress.get(_job_key(job))
+            start = _to_datetime(done) + bar if done else job.start
+            step = timedelta(seconds=seconds * self.max_points)
+            while start <= job.end:
+                end = min(start + step - bar, job.end)
+                chunks.append(DownloadChunk(job, start, end, estimate_points(job.resolution, start, end + bar)))
+                start = end + bar
+        return chunks
+
+    def cost(self):
+        """Returns the estimated points left to download"""
+        return sum(chunk.points for chunk in self.chunks())
+
+    def _allowance(self):
+        allowance = self.ig_service.allowance
+        if allowance is None:
+            now = time.time()
+            return Allowance(self.default_allowance, self.default_allowance, now + ALLOWANCE_PERIOD, now)
+        if allowance.expiry <= time.time():
+            # Reset since the last response
+            return allowance._replace(remaining=allowance.total, expiry=allowance.expiry + ALLOWANCE_PERIOD)
+        return allowance
+
+    def plan(self):
+        """Returns the schedule of the remaining requests as a list of
+        (window start, [DownloadChunk]): the current allowance window then
+        the following ones, each holding the requests it has the points
+        for
+        """
+        allowance = self._allowance()
+        windows = [(datetime.fromtimestamp(time.time()), [])]
+        budget = allowance.remaining
+        for chunk in self.chunks():
+            if chunk.points > budget and windows[-1][1]:
+                reset = allowance.expiry + (len(windows) - 1) * ALLOWANCE_PERIOD
+                windows.append((datetime.fromtimestamp(reset), []))
+                budget = allowance.total
+            windows[-1][1].append(chunk)
+            budget -= chunk.points
+        return [window for window in windows if window[1]]
+
+    def run(self, wait=False):
+        """Downloads the remaining requests, returns True when all the jobs
+        are complete and False if it stopped on the allowance (wait=False)
+        """
+        for chunk in self.chunks():
+            allowance = self._allowance()
+            while chunk.points > allowance.remaining and allowance.remaining < allowance.total:
+                if not wait:
+                    logger.info(
+                        "Price allowance left %d points, %d needed: stopping until %s"
+                        % (allowance.remaining, chunk.points, datetime.fromtimestamp(allowance.expiry))
+                    )
+                    return False
+                logger.info("Waiting for the price allowance reset at %s" % datetime.fromtimestamp(allowance.expiry))
+                time.sleep(max(allowance.expiry - time.time(), 0) + 1)
+                allowance = self._allowance()
+            data = self.ig_service.fetch_historical_prices_by_epic_and_date_range(
+                chunk.job.epic, chunk.job.resolution,
+                conv_datetime(chunk.start, 1), conv_datetime(chunk.end, 1)
+            )
+            if self.on_prices is not None:
+                self.on_prices(chunk.job, chunk, data)
+            self.progress[_job_key(chunk.job)] = chunk.end.isoformat()
+            self.points_downloaded += len(data["prices"])
+            self.save()
+        return True
+
+    def status(self):
+        allowance = self.ig_service.allowance
+        return {
+            "jobs": len(self.jobs),
+            "requests_left": len(self.chunks()),
+            "points_left": self.cost(),
+            "points_downloaded": self.points_downloaded,
+            "allowance": allowance._asdict() if allowance is not None else None,
+        }
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of Lightstreamer sessions sharing the Subscriptions of a large
+universe of items.
+"""
+
+import functools
+import logging
+import threading
+import traceback
+
+from IGServices.lightstreamer import Subscription, STATUS_RECOVERED, STATUS_DISCONNECTED
+
+logger = logging.getLogger(__name__)
+
+
+class _Chunk(object):
+    """Part of a pooled Subscription, subscribed on a single session."""
+
+    def __init__(self, subscription):
+        self.subscription = subscription
+        self.client = None
+        self.key = None
+
+    @property
+    def size(self):
+        return len(self.subscription.item_names)
+
+
+def _forwarder(parent, offset):
+    """Returns the listener of a chunk, delivering its updates to the
+    parent Subscription with the item positions of the parent.
+    """
+    def on_item_update(item_info):
+        item_info = dict(item_info)
+        item_info["pos"] += offset
+        if parent._conflator is not None:
+            parent._conflator.put(item_info)
+        else:
+            parent._deliver(item_info)
+    return on_item_update
+
+
+def split_subscription(subscription, max_items):
+    """Returns the Subscriptions covering the items of the given one in
+    chunks of at most max_items, which forward their updates to it. A
+    Subscription already within the limit is returned alone.
+    """
+    items = subscription.item_names
+    if max_items is None or len(items) <= max_items:
+        return [subscription]
+
+    chunks = []
+    for offset in range(0, len(items), max_items):
+        chunk = Subscription(
+            mode=subscription.mode,
+            items=items[offset:offset + max_items],
+            fields=subscription.field_names,
+            adapter=subscription.adapter,
+            max_frequency=subscription.max_frequency,
+            buffer_size=subscription.buffer_size,
+            key_field=subscription.key_field,
+            command_field=subscription.command_field,
+            distinct_length=subscription.distinct_length,
+        )
+        chunk.snapshot = subscription.snapshot
+        chunk._converters = subscription._converters
+        chunk.addlistener(_forwarder(subscription, offset))
+        chunks.append(chunk)
+    return chunks
+
+
+class StreamPool(object):
+    """Spreads Subscriptions over several Lightstreamer sessions.
+
+    Subscriptions with more than max_items items are split into chunks,
+    each subscribed on the session with the fewest items (and less than
+    max_subscriptions Subscriptions), while the listeners of the original
+    Subscription get every update with its own item positions. The item
+    state of a split Subscription (COMMAND tables, DISTINCT events) is
+    kept by its chunks, see chunks().
+
+    When a session recovers, chunks are moved from the busiest sessions
+    to the idlest ones; when a session is lost for good, its chunks are
+    moved to the remaining ones.
+    """
+
+    def __init__(self, client_factory, connections=2, max_items=40, max_subscriptions=None):
+        self.client_factory = client_factory
+        self.connections = max(1, int(connections))
+        self.max_items = max_items
+        self.max_subscriptions = max_subscriptions
+        self.clients = []
+        self._status = {}
+        self._live = set()
+        self._lock = threading.RLock()
+        self._closing = False
+        # pool key -> (Subscription, [_Chunk])
+        self._entries = {}
+        self._current_key = 0
+        self.rebalance_counter = 0
+
+    def connect(self):
+        """Open the Lightstreamer sessions of the pool."""
+        self._closing = False
+        for index in range(len(self.clients), self.connections):
+            client = self.client_factory()
+            client.addconnectionlistener(functools.partial(self._on_status, index))
+            client.connect()
+            self.clients.append(client)
+            self._live.add(index)
+        logger.info("Stream pool connected with %d sessions" % len(self.clients))
+
+    def _on_status(self, index, status):
+        self._status[index] = status
+        if self._closing:
+            return
+        if status == STATUS_DISCONNECTED:
+            with self._lock:
+                self._live.discard(index)
+            logger.warning("Stream pool session %d lost, moving its subscriptions" % index)
+            self._rebalance_async()
+        elif status == STATUS_RECOVERED:
+            self._rebalance_async()
+
+    def _rebalance_async(self):
+        # The status is notified on the STREAM-CONN-THREAD of the session,
+        # which must go on reading its stream.
+        thread = threading.Thread(name="STREAM-POOL-REBALANCE", target=self.rebalance)
+        thread.daemon = True
+        thread.start()
+
+    def _all_chunks(self):
+        for _, chunks in self._entries.values():
+            for chunk in chunks:
+                yield chunk
+
+    def _loads(self):
+        """Returns {client index: [item count, subscription count]} of
+        the live sessions.
+        """
+        loads = dict((index, [0, 0]) for index in self._live)
+        for chunk in self._all_chunks():
+            if chunk.client in loads:
+                loads[chunk.client][0] += chunk.size
+                loads[chunk.client][1] += 1
+        return loads
+
+    def _place(self, chunks, loads):
+        """Assign each chunk to the live session with the fewest items
+        and room for one more Subscription, updating loads.
+        """
+        for chunk in chunks:
+            candidates = [
+                index for index, (_, count) in loads.items()
+                if self.max_subscriptions is None or count < self.max_subscriptions
+            ]
+            if not candidates:
+                raise RuntimeError("No stream pool session can take more subscriptions")
+            index = min(candidates, key=lambda i: (loads[i][0], loads[i][1], i))
+            chunk.client = index
+            loads[index][0] += chunk.size
+            loads[index][1] += 1
+
+    def _subscribe_chunks(self, chunks):
+        """Subscribe the placed chunks, one batched request per session."""
+        by_client = {}
+        for chunk in chunks:
+            by_client.setdefault(chunk.client, []).append(chunk)
+        for index, client_chunks in by_client.items():
+            keys = self.clients[index].subscribe_many([c.subscription for c in client_chunks])
+            for chunk, key in zip(client_chunks, keys):
+                chunk.key = key
+
+    def _unsubscribe_chunks(self, chunks):
+        """Unsubscribe the chunks from their live sessions, one batched
+        request per session.
+        """
+        by_client = {}
+        for chunk in chunks:
+            if chunk.client in self._live and chunk.key is not None:
+                by_client.setdefault(chunk.client, []).append(chunk.key)
+            chunk.client = None
+            chunk.key = None
+        for index, keys in by_client.items():
+            self.clients[index].unsubscribe_many(keys)
+
+    def subscribe(self, subscription):
+        """Subscribe a Subscription on the pool and return its pool key."""
+        return self.subscribe_many([subscription])[0]
+
+    def subscribe_many(self, subscriptions):
+        """Subscribe the given Subscriptions on the pool, with a single
+        batched request per session. Returns the list of pool keys.
+        """
+        with self._lock:
+            pool_keys = []
+            placed = []
+            loads = self._loads()
+            for subscription in subscriptions:
+                chunks = [_Chunk(s) for s in split_subscription(subscription, self.max_items)]
+                self._place(chunks, loads)
+                placed.extend(chunks)
+                self._current_key += 1
+                self._entries[self._current_key] = (subscription, chunks)
+                pool_keys.append(self._current_key)
+            self._subscribe_chunks(placed)
+        return pool_keys
+
+    def unsubscribe(self, pool_key):
+        """Unsubscribe the Subscription of the given pool key."""
+        self.unsubscribe_many([pool_key])
+
+    def unsubscribe_many(self, pool_keys):
+        """Unsubscribe the Subscriptions of the given pool keys, with a
+        single batched request per session.
+        """
+        with self._lock:
+            chunks = []
+            for pool_key in pool_keys:
+                entry = self._entries.pop(pool_key, None)
+                if entry is None:
+                    logger.warning("No pool key %s found!" % pool_key)
+                    continue
+                subscription, entry_chunks = entry
+                chunks.extend(entry_chunks)
+                if entry_chunks[0].subscription is not subscription:
+                    # Parent of split chunks, never subscribed itself
+                    subscription.close()
+            self._unsubscribe_chunks(chunks)
+
+    def unsubscribe_all(self):
+        with self._lock:
+            self.unsubscribe_many(list(self._entries))
+
+    def subscription(self, pool_key):
+        """Return the Subscription of a pool key."""
+        return self._entries[pool_key][0]
+
+    def chunks(self, pool_key):
+        """Return the Subscriptions actually subscribed for a pool key."""
+        return [chunk.subscription for chunk in self._entries[pool_key][1]]
+
+    def rebalance(self):
+        """Subscribe the chunks of lost sessions on the live ones, then
+        move chunks from the busiest to the idlest sessions until their
+        item counts are within max_items of each other.
+        """
+        with self._lock:
+            if self._closing or not self._live:
+                return
+            try:
+                orphans = [c for c in self._all_chunks() if c.client not in self._live]
+                for chunk in orphans:
+                    chunk.client = None
+                    chunk.key = None
+                loads = self._loads()
+                self._place(orphans, loads)
+
+                # chunk -> target session
+                moves = {}
+                for _ in range(sum(1 for _ in self._all_chunks())):
+                    busiest = max(loads, key=lambda i: loads[i][0])
+                    idlest = min(loads, key=lambda i: loads[i][0])
+                    gap = loads[busiest][0] - loads[idlest][0]
+                    if (self.max_subscriptions is not None
+                            and loads[idlest][1] >= self.max_subscriptions):
+                        break
+                    candidates = [
+                        c for c in self._all_chunks()
+                        if c.client == busiest and c not in moves and c.size < gap
+                    ]
+                    if gap <= (self.max_items or 0) or not candidates:
+                        break
+                    chunk = max(candidates, key=lambda c: c.size)
+                    moves[chunk] = idlest
+                    loads[busiest][0] -= chunk.size
+                    loads[busiest][1] -= 1
+                    loads[idlest][0] += chunk.size
+                    loads[idlest][1] += 1
+
+                if not orphans and not moves:
+                    return
+                self._unsubscribe_chunks(list(moves))
+                for chunk, target in moves.items():
+                    chunk.client = target
+                self._subscribe_chunks(orphans + list(moves))
+                self.rebalance_counter += 1
+                logger.info(
+                    "Stream pool rebalanced: %d subscriptions resubscribed, %d moved"
+                    % (len(orphans), len(moves))
+                )
+            except Exception:
+                logger.error("Stream pool rebalance failed")
+                logger.error(traceback.format_exc())
+
+    def stats(self):
+        """Return the status, load and stream metrics of each session."""
+        with self._lock:
+            loads = self._loads()
+        return {
+            "connections": len(self.clients),
+            "live": len(self._live),
+            "rebalances": self.rebalance_counter,
+            "sessions": [
+                {
+                    "status": self._status.get(index),
+                    "items": loads.get(index, [0, 0])[0],
+                    "subscriptions": loads.get(index, [0, 0])[1],
+                    "metrics": client.metrics.snapshot(),
+                }
+                for index, client in enumerate(self.clients)
+            ],
+        }
+
+    def disconnect(self, drain=True, timeout=None):
+        """Unsubscribe everything and close all the sessions, then stop
+        their Dispatchers, delivering the queued updates first unless
+        drain is False.
+        """
+        self.unsubscribe_all()
+        self._closing = True
+        dispatchers = []
+        for client in self.clients:
+            client.disconnect(drain=False)
+            if client.dispatcher is not None and client.dispatcher not in dispatchers:
+                dispatchers.append(client.dispatcher)
+        # The sessions usually share one Dispatcher, stopped once they
+        # are all closed
+        for dispatcher in dispatchers:
+            dispatcher.stop(drain, timeout)
+        self.clients = []
+        self._live.clear()
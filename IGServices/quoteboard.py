@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Board of the latest quotes in shared memory, written by the process
+holding the stream and read by any number of local processes.
+
+The shared memory block holds a header (magic, capacity, row count) and
+a structured array with one row per epic. Each row has a sequence number
+(seqlock): the writer makes it odd before changing the row and even
+again after, so a reader retries any row whose sequence was odd or has
+changed while it was copied. Python offers no memory barrier: this relies
+on stores becoming visible in program order, as on x86-64.
+"""
+
+import logging
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from IGServices.utils import _HAS_PANDAS, item_epic, tick_timestamp
+
+if _HAS_PANDAS:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+BOARD_MAGIC = b"IGQUOTE1"
+BOARD_HEADER = struct.Struct("<8sQQ")
+# The rows start on a cache line
+BOARD_OFFSET = 64
+
+QUOTE_DTYPE = np.dtype([
+    ("seq", "<u8"),
+    ("epic", "S40"),
+    ("bid", "<f8"),
+    ("offer", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("change", "<f8"),
+    ("change_pct", "<f8"),
+    # Server time of the quote and local time of the write, epoch seconds
+    ("timestamp", "<f8"),
+    ("updated", "<f8"),
+])
+
+# Row field -> L1 or CHART fields
+QUOTE_FIELDS = {
+    "bid": ("BID",),
+    "offer": ("OFFER", "OFR"),
+    "high": ("HIGH", "DAY_HIGH"),
+    "low": ("LOW", "DAY_LOW"),
+    "change": ("CHANGE", "DAY_NET_CHG_MID"),
+    "change_pct": ("CHANGE_PCT", "DAY_PERC_CHG_MID"),
+}
+
+# Seconds a reader keeps retrying a row before giving up (a publisher
+# which died in the middle of a write leaves the row odd)
+READ_TIMEOUT = 1.0
+
+
+def _board_size(capacity):
+    return BOARD_OFFSET + capacity * QUOTE_DTYPE.itemsize
+
+
+def _to_float(value):
+    if value is None or value == "":
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class QuoteBoardPublisher(object):
+    """Creates the shared memory quote board of the given name, with room
+    for capacity epics, and writes to it the quotes of the L1:, MARKET: or
+    CHART: items it is added to with Subscription.addlistener.
+    """
+
+    def __init__(self, name="ig_quotes", capacity=1024):
+        self.name = name
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=_board_size(capacity))
+        self._rows = np.ndarray(
+            (capacity,), dtype=QUOTE_DTYPE, buffer=self._shm.buf, offset=BOARD_OFFSET
+        )
+        # The fields never published read as NaN
+        empty = np.zeros(1, dtype=QUOTE_DTYPE)
+        for field in QUOTE_DTYPE.names[2:]:
+            empty[field] = np.nan
+        self._rows[:] = empty
+        self._index = {}
+        self._lock = threading.Lock()
+        self._write_header()
+        self.update_count = 0
+        self.dropped_count = 0
+
+    def _write_header(self):
+        BOARD_HEADER.pack_into(self._shm.buf, 0, BOARD_MAGIC, self.capacity, len(self._index))
+
+    def _row(self, epic):
+        row = self._index.get(epic)
+        if row is None:
+            if len(self._index) >= self.capacity:
+                return None
+            row = len(self._index)
+            self._rows["epic"][row] = epic.encode("utf-8")
+            self._index[epic] = row
+            self._write_header()
+        return row
+
+    def __call__(self, item_info):
+        values = item_info["values"]
+        quote = {}
+        for field, names in QUOTE_FIELDS.items():
+            for name in names:
+                if values.get(name) is not None:
+                    quote[field] = _to_float(values[name])
+                    break
+        self.publish(item_epic(item_info["name"]), tick_timestamp(values), **quote)
+
+    def publish(self, epic, timestamp=None, **quote):
+        """Writes the given quote fields (bid, offer, high, low, change,
+        change_pct) of an epic, the others keep their last value
+        """
+        with self._lock:
+            row = self._row(epic)
+            if row is None:
+                self.dropped_count += 1
+                if self.dropped_count == 1:
+                    logger.warning("Quote board %s is full (%d epics)" % (self.name, self.capacity))
+                return
+            rows = self._rows
+            seq = rows["seq"][row]
+            rows["seq"][row] = seq + 1
+            for field, value in quote.items():
+                rows[field][row] = value
+            rows["timestamp"][row] = timestamp if timestamp is not None else time.time()
+            rows["updated"][row] = time.time()
+            rows["seq"][row] = seq + 2
+            self.update_count += 1
+
+    def close(self):
+        """Releases and removes the shared memory block"""
+        self._rows = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class QuoteBoardReader(object):
+    """Attaches to the quote board of the given name, created by a
+    QuoteBoardPublisher in another process, and reads consistent quotes
+    without any lock or message from the publisher. Meant for the other
+    processes: before Python 3.13 a reader in the publisher process makes
+    the resource tracker complain when the board is removed.
+    """
+
+    def __init__(self, name="ig_quotes"):
+        self.name = name
+        # The publisher owns the block: the resource tracker of this
+        # process must not remove it when the reader exits.
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13
+            from multiprocessing import resource_tracker
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        magic, self.capacity, _ = BOARD_HEADER.unpack_from(self._shm.buf, 0)
+        if magic != BOARD_MAGIC:
+            self._shm.close()
+            raise IOError("%s is not a quote board" % name)
+        self._rows = np.ndarray(
+            (self.capacity,), dtype=QUOTE_DTYPE, buffer=self._shm.buf, offset=BOARD_OFFSET
+        )
+        self._index = {}
+
+    def __len__(self):
+        return BOARD_HEADER.unpack_from(self._shm.buf, 0)[2]
+
+    def epics(self):
+        self._refresh()
+        return list(self._index)
+
+    def _refresh(self):
+        count = len(self)
+        if count != len(self._index):
+            for row in range(len(self._index), count):
+                self._index[self._rows["epic"][row].decode("utf-8")] = row
+
+    def _read_row(self, row):
+        rows = self._rows
+        deadline = None
+        attempt = 0
+        while True:
+            seq = rows["seq"][row]
+            if not seq & 1:
+                quote = rows[row].copy()
+                if rows["seq"][row] == seq:
+                    return quote
+            attempt += 1
+            if attempt % 100 == 0:
+                # Let the publisher finish its write
+                time.sleep(0)
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + READ_TIMEOUT
+                elif now > deadline:
+                    break
+        raise IOError("Quote board %s row %d is not stable" % (self.name, row))
+
+    def get(self, epic):
+        """Returns the quote of an epic as a dict, None if unknown"""
+        row = self._index.get(epic)
+        if row is None:
+            self._refresh()
+            row = self._index.get(epic)
+            if row is None:
+                return None
+        quote = self._read_row(row)
+        return dict(
+            (name, quote[name].decode("utf-8") if name == "epic" else float(quote[name]))
+            for name in QUOTE_DTYPE.names if name != "seq"
+        )
+
+    def snapshot(self):
+        """Returns the quotes of all the epics as a DataFrame indexed by
+        epic (a NumPy structured array without pandas)
+        """
+        count = len(self)
+        rows = self._rows[:count]
+        quotes = rows.copy()
+        # Read again the rows written during the copy
+        for row in np.nonzero((quotes["seq"] & 1) | (quotes["seq"] != rows["seq"]))[0]:
+            quotes[row] = self._read_row(row)
+        if not _HAS_PANDAS:
+            return quotes
+        frame = pd.DataFrame(quotes[list(QUOTE_DTYPE.names[2:])])
+        frame.index = pd.Index([e.decode("utf-8") for e in quotes["epic"]], name="epic")
+        return frame
+
+    def close(self):
+        self._rows = None
+        self._shm.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the latest quote of each epic, filled from the L1 stream.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+from IGServices.utils import _HAS_PANDAS, item_epic
+
+if _HAS_PANDAS:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+Quote = collections.namedtuple(
+    "Quote",
+    ["epic", "bid", "offer", "high", "low", "change", "change_pct",
+     "update_time", "market_state", "updated"],
+)
+
+# L1 field -> Quote field
+L1_FIELDS = {
+    "BID": "bid",
+    "OFFER": "offer",
+    "HIGH": "high",
+    "LOW": "low",
+    "CHANGE": "change",
+    "CHANGE_PCT": "change_pct",
+    "UPDATE_TIME": "update_time",
+    "MARKET_STATE": "market_state",
+}
+
+# Market details snapshot key (REST /markets) -> Quote field
+SNAPSHOT_FIELDS = {
+    "bid": "bid",
+    "offer": "offer",
+    "high": "high",
+    "low": "low",
+    "netChange": "change",
+    "percentageChange": "change_pct",
+    "updateTime": "update_time",
+    "marketStatus": "market_state",
+}
+
+_NUMERIC = ("bid", "offer", "high", "low", "change", "change_pct")
+
+
+def _quote(epic, fields, updated):
+    for name in _NUMERIC:
+        value = fields.get(name)
+        if isinstance(value, str):
+            try:
+                fields[name] = float(value)
+            except ValueError:
+                fields[name] = None
+    return Quote(epic=epic, updated=updated, **dict((f, fields.get(f)) for f in L1_FIELDS.values()))
+
+
+def quote_from_market(market, updated=None):
+    """Returns the Quote of a market details document of the REST API"""
+    snapshot = market.get("snapshot") or {}
+    fields = dict((q, snapshot.get(k)) for k, q in SNAPSHOT_FIELDS.items())
+    return _quote(market["instrument"]["epic"], fields, updated or time.time())
+
+
+class QuoteCache(object):
+    """Latest Quote of each epic, updated by the L1:<epic> (or MARKET:<epic>)
+    items it is added to with Subscription.addlistener, or with put().
+    Quotes are immutable tuples replaced on each update, so get() is a
+    single dict lookup.
+    """
+
+    def __init__(self):
+        self._quotes = {}
+        self._lock = threading.Lock()
+        self.update_count = 0
+
+    def __call__(self, item_info):
+        values = item_info["values"]
+        fields = dict((q, values.get(k)) for k, q in L1_FIELDS.items())
+        self.put(_quote(item_epic(item_info["name"]), fields, time.time()))
+
+    def put(self, quote):
+        with self._lock:
+            self._quotes[quote.epic] = quote
+            self.update_count += 1
+
+    def get(self, epic, max_age=None):
+        """Returns the Quote of an epic, None if unknown or updated more
+        than max_age seconds ago
+        """
+        quote = self._quotes.get(epic)
+        if quote is None or (max_age is not None and time.time() - quote.updated > max_age):
+            return None
+        return quote
+
+    def __contains__(self, epic):
+        return epic in self._quotes
+
+    def __len__(self):
+        return len(self._quotes)
+
+    def discard(self, epic):
+        with self._lock:
+            self._quotes.pop(epic, None)
+
+    def snapshot(self):
+        """Returns all the quotes as a DataFrame indexed by epic (a NumPy
+        record array without pandas)
+        """
+        with self._lock:
+            quotes = list(self._quotes.values())
+        if _HAS_PANDAS:
+            return pd.DataFrame.from_records(quotes, columns=Quote._fields, index="epic")
+        return np.rec.fromrecords(quotes, names=Quote._fields) if quotes else None
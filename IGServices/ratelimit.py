@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting of the requests to the IG REST API.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Default IG allowances, in requests per minute
+TRADING_REQUESTS_PER_MINUTE = 100
+NON_TRADING_REQUESTS_PER_MINUTE = 30
+
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second up to capacity:
+    requests may burst up to capacity, then proceed at rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+        self.waited = 0.0
+
+    @classmethod
+    def per_minute(cls, requests, capacity=None):
+        return cls(requests / 60.0, capacity if capacity is not None else requests)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def available(self):
+        with self._cond:
+            self._refill()
+            return self._tokens
+
+    def try_acquire(self, tokens=1):
+        """Takes the tokens if available now, returns whether it did"""
+        with self._cond:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """Waits until the tokens are available and takes them, returns
+        False if the timeout expired first
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._cond:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.waited += time.monotonic() - started
+                    return True
+                delay = (tokens - self._tokens) / self.rate
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    delay = min(delay, remaining)
+                self._cond.wait(delay)
+
+
+# Request priorities, most urgent first
+# Orders and positions: create, amend, close, deal confirmations.
+PRIORITY_DEALING = 0
+# Account, positions, working orders and history reads, session calls.
+PRIORITY_ACCOUNT = 1
+# Markets, navigation, watchlists, sentiment and application details.
+PRIORITY_REFERENCE = 2
+# Historical prices (/prices), the bulk of the backfills.
+PRIORITY_HISTORY = 3
+
+PRIORITIES = (PRIORITY_DEALING, PRIORITY_ACCOUNT, PRIORITY_REFERENCE, PRIORITY_HISTORY)
+
+
+def request_priority(method, path):
+    """Returns the priority of a REST API request, from its HTTP method
+    (or _method override) and path
+    """
+    method = method.upper()
+    path = path.lstrip("/")
+    if path.startswith("prices"):
+        return PRIORITY_HISTORY
+    if path.startswith("confirms"):
+        return PRIORITY_DEALING
+    if path.startswith(("positions", "workingorders")):
+        return PRIORITY_ACCOUNT if method == "GET" else PRIORITY_DEALING
+    if path.startswith(("accounts", "history", "session")):
+        return PRIORITY_ACCOUNT
+    return PRIORITY_REFERENCE
+
+
+class PriorityScheduler(TokenBucket):
+    """Token bucket shared by requests of different priorities.
+
+    A request waits while any more urgent one is waiting, and may only take
+    a token if the share of the capacity reserved for the more urgent
+    priorities (reserves, by priority) is left in the bucket. When the
+    budget is tight the bulk history requests are deferred first, keeping
+    tokens for the dealing requests, which are never held by the others.
+    """
+
+    def __init__(self, rate, capacity=None, reserves=(0.0, 0.1, 0.25, 0.5)):
+        super(PriorityScheduler, self).__init__(rate, capacity)
+        self.reserves = reserves
+        self._waiting = [0] * len(PRIORITIES)
+        self.granted = [0] * len(PRIORITIES)
+        self.deferred = [0] * len(PRIORITIES)
+
+    @classmethod
+    def per_minute(cls, requests, capacity=None, reserves=(0.0, 0.1, 0.25, 0.5)):
+        return cls(requests / 60.0, capacity if capacity is not None else requests, reserves)
+
+    def _floor(self, priority):
+        return self.reserves[priority] * self.capacity
+
+    def _ahead(self, priority):
+        return any(self._waiting[p] for p in range(priority))
+
+    def try_acquire(self, tokens=1, priority=PRIORITY_HISTORY):
+        with self._cond:
+            self._refill()
+            if not self._ahead(priority) and self._tokens - tokens >= self._floor(priority):
+                self._tokens -= tokens
+                self.granted[priority] += 1
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None, priority=PRIORITY_HISTORY):
+        """Waits until a request of the given priority may proceed and
+        takes its tokens, returns False if the timeout expired first
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                deferred = False
+                while True:
+                    self._refill()
+                    needed = tokens + self._floor(priority)
+                    if not self._ahead(priority) and self._tokens >= needed:
+                        self._tokens -= tokens
+                        self.granted[priority] += 1
+                        self.waited += time.monotonic() - started
+                        return True
+                    if not deferred:
+                        deferred = True
+                        self.deferred[priority] += 1
+                    # Woken early when a more urgent request is served
+                    delay = max(needed - self._tokens, tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        delay = min(delay, remaining)
+                    self._cond.wait(delay)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            self._refill()
+            return {
+                "tokens": self._tokens,
+                "waiting": list(self._waiting),
+                "granted": list(self.granted),
+                "deferred": list(self.deferred),
+            }
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only recording of the raw lines received on the Lightstreamer
+stream connection, for audits, backtests and replays.
+
+A recording is a directory of segment files. Each segment starts with a
+header (magic, wall clock and monotonic clock at creation, in ns) and
+holds length-prefixed records: record length (uint32), monotonic receive
+time in ns (uint64), then the raw line bytes. A zero length marks the
+end of the records in a segment.
+"""
+
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = b"IGSTRM01"
+SEGMENT_HEADER = struct.Struct("<8sQQ")
+RECORD_HEADER = struct.Struct("<IQ")
+SEGMENT_SUFFIX = ".seg"
+
+
+class _Segment(object):
+    """Segment file mapped in memory, with the offset of its next record"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.offset = SEGMENT_HEADER.size
+        self.file = open(path, "w+b")
+        # Sparse file: the pages are only allocated when written
+        self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        # Fault the first page in now, rather than on the first record
+        SEGMENT_HEADER.pack_into(self.mmap, 0, b"", 0, 0)
+
+    def start(self):
+        """Stamps the header with the clocks at the first use"""
+        SEGMENT_HEADER.pack_into(self.mmap, 0, SEGMENT_MAGIC, time.time_ns(), time.monotonic_ns())
+
+    def close(self, keep=True):
+        self.mmap.close()
+        # fsync rather than mmap.flush, which keeps the GIL during msync
+        os.fsync(self.file.fileno())
+        if keep:
+            # Drop the unused tail, keeping the zero length end marker
+            self.file.truncate(min(self.size, self.offset + RECORD_HEADER.size))
+        self.file.close()
+        if not keep:
+            os.remove(self.path)
+
+
+class StreamRecorder(object):
+    """Writes the raw stream lines into memory-mapped segment files,
+    rotated once segment_size bytes are used. Writing a record is a
+    copy into the mapped memory: the next segment is created in advance
+    and the full ones are flushed and closed by the RECORDER-THREAD, so
+    no system call is made on the stream thread, rotations included
+    (except for the first segment, or a line larger than a segment).
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, prefix="stream"):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._segment = None
+        # Segment created in advance, and the full ones left to close
+        self._next = None
+        self._retired = []
+        self._thread = None
+        self._running = False
+        self.path = None
+        self.record_count = 0
+        self.segment_count = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._index = self._last_index() + 1
+
+    def _last_index(self):
+        pattern = re.compile(r"%s-(\d+)%s$" % (re.escape(self.prefix), re.escape(SEGMENT_SUFFIX)))
+        indexes = [
+            int(m.group(1))
+            for m in (pattern.search(path) for path in os.listdir(self.directory))
+            if m
+        ]
+        return max(indexes) if indexes else 0
+
+    def _segment_size(self, length):
+        # Header, record, then the zero length end marker
+        return SEGMENT_HEADER.size + length + 2 * RECORD_HEADER.size
+
+    def _new_segment(self, index, min_size=0):
+        """Creates the file of the segment of the given index"""
+        size = max(self.segment_size, self._segment_size(min_size))
+        path = os.path.join(self.directory, "%s-%06d%s" % (self.prefix, index, SEGMENT_SUFFIX))
+        return _Segment(path, size)
+
+    def _start(self):
+        self._running = True
+        self._thread = threading.Thread(name="RECORDER-THREAD", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """Body of the RECORDER-THREAD: closes the full segments and keeps
+        the next one ready
+        """
+        while True:
+            with self._cond:
+                while self._running and not self._retired and self._next is not None:
+                    self._cond.wait()
+                retired, self._retired = self._retired, []
+                prepare = self._running and self._next is None
+                if prepare:
+                    index = self._index
+                    self._index += 1
+            for segment in retired:
+                segment.close()
+            if prepare:
+                segment = self._new_segment(index)
+                with self._cond:
+                    # Unless a segment was created meanwhile by _rotate
+                    if self._running and self._next is None and self._index == index + 1:
+                        self._next, segment = segment, None
+                if segment is not None:
+                    segment.close(keep=False)
+            elif not self._running and not retired:
+                break
+
+    def _rotate(self, length):
+        """Switches to the next segment, called with the lock held"""
+        segment = self._next
+        self._next = None
+        if segment is None or segment.size < self._segment_size(length):
+            # Not ready yet, or too small for this line: the segments
+            # must follow the order of their indexes
+            if segment is not None:
+                segment.close(keep=False)
+            segment = self._new_segment(self._index, length)
+            self._index += 1
+        if self._segment is not None:
+            self._retired.append(self._segment)
+        segment.start()
+        self._segment = segment
+        self.path = segment.path
+        self.segment_count += 1
+        if self._thread is None:
+            self._start()
+        self._cond.notify_all()
+        logger.debug("Recording to %s" % self.path)
+
+    def record(self, line, received=None):
+        """Append a raw line, stamped with the monotonic receive time
+        in ns (now if not given).
+        """
+        if received is None:
+            received = time.monotonic_ns()
+        length = len(line)
+        if not length:
+            return
+        with self._lock:
+            segment = self._segment
+            # Keep room for the zero length end marker
+            if segment is None or segment.offset + 2 * RECORD_HEADER.size + length > segment.size:
+                self._rotate(length)
+                segment = self._segment
+            offset = segment.offset
+            RECORD_HEADER.pack_into(segment.mmap, offset, length, received)
+            end_offset = offset + RECORD_HEADER.size + length
+            segment.mmap[offset + RECORD_HEADER.size:end_offset] = line
+            segment.offset = end_offset
+            self.record_count += 1
+
+    def flush(self):
+        """Flush the current segment to disk."""
+        with self._lock:
+            if self._segment is not None:
+                self._segment.mmap.flush()
+
+    def close(self):
+        """Flush and close the current segment, remove the unused next one."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            segments = self._retired
+            self._retired = []
+            if self._segment is not None:
+                segments.append(self._segment)
+                self._segment = None
+            unused, self._next = self._next, None
+        for segment in segments:
+            segment.close()
+        if unused is not None:
+            unused.close(keep=False)
+
+
+def segment_paths(path, prefix="stream"):
+    """Returns the segment files of a recording directory, in order,
+    or the given path itself if it is a segment file.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "%s-*%s" % (prefix, SEGMENT_SUFFIX))))
+    return [path]
+
+
+def iter_segment(path):
+    """Yields (monotonic receive time in ns, raw line bytes) for each
+    record of a segment file.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, _, _ = SEGMENT_HEADER.unpack_from(mm, 0)
+            if magic != SEGMENT_MAGIC:
+                raise IOError("%s is not a stream recording segment" % path)
+            offset = SEGMENT_HEADER.size
+            while offset + RECORD_HEADER.size <= size:
+                length, received = RECORD_HEADER.unpack_from(mm, offset)
+                if length == 0:
+                    break
+                offset += RECORD_HEADER.size
+                yield received, mm[offset:offset + length]
+                offset += length
+        finally:
+            mm.close()
+
+
+def iter_records(path, prefix="stream"):
+    """Yields (monotonic receive time in ns, raw line bytes) for each
+    record of a recording directory or segment file.
+    """
+    for segment_path in segment_paths(path, prefix):
+        for record in iter_segment(segment_path):
+            yield record
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of stream recordings into Subscriptions, for backtests and
+offline load tests of the listeners.
+"""
+
+import logging
+import time
+
+from IGServices.lightstreamer import LSClient
+from IGServices.recorder import iter_records
+
+logger = logging.getLogger(__name__)
+
+
+class StreamReplay(object):
+    """Feeds the lines of a stream recording (see recorder.py) to the
+    Subscriptions of an LSClient, through _forward_update_message as the
+    live stream thread does.
+
+    speed = 1.0 replays in real time, any other positive value scales the
+    recorded timing (2.0 is twice as fast), None replays as fast as
+    possible. Without a client, an offline LSClient is used: register the
+    Subscriptions with subscribe(), in the same order as in the recorded
+    session so that they get the same subscription keys.
+    """
+
+    def __init__(self, source, client=None, speed=1.0):
+        self.source = source
+        self.client = client if client is not None else LSClient("")
+        self.speed = speed
+        self.stats = {}
+
+    def subscribe(self, subscription):
+        """Register a Subscription on the offline client, without any
+        request to Lightstreamer Server, and return its subscription key.
+        """
+        with self.client._lock:
+            return self.client._register(subscription)
+
+    def _records(self):
+        if isinstance(self.source, str):
+            return iter_records(self.source)
+        return iter(self.source)
+
+    def run(self):
+        """Replay the whole recording and return the statistics: records
+        read, updates forwarded, elapsed seconds, update throughput reached
+        by the listeners and the worst delay behind the recorded timing.
+        """
+        dispatcher = self.client.dispatcher
+        if dispatcher is not None:
+            dispatcher.start()
+
+        records = 0
+        updates = 0
+        max_delay = 0.0
+        first_received = None
+        started = time.perf_counter()
+        for received, line in self._records():
+            records += 1
+            if self.speed:
+                if first_received is None:
+                    first_received = received
+                due = started + (received - first_received) / 1e9 / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > max_delay:
+                    max_delay = -delay
+
+            message = bytes(line).decode("utf-8").rstrip()
+            # Only the update lines ("<table>,<item>|...") reach the
+            # Subscriptions, as in LSClient._receive.
+            if message and message[0].isdigit():
+                self.client._forward_update_message(message)
+                updates += 1
+
+        if dispatcher is not None:
+            # Account for the updates still queued for the listeners
+            dispatcher.join()
+        elapsed = time.perf_counter() - started
+        self.stats = {
+            "records": records,
+            "updates": updates,
+            "elapsed": elapsed,
+            "updates_per_sec": updates / elapsed if elapsed > 0 else 0.0,
+            "max_delay": max_delay,
+        }
+        logger.info(
+            "Replayed %d updates in %.3fs (%.0f updates/s)"
+            % (updates, elapsed, self.stats["updates_per_sec"])
+        )
+        return self.stats
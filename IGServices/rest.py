@@ -11,7 +11,11 @@ import pandas as pd
 import numpy as np
 from datetime import timedelta, datetime
 from IGServices.utils import _HAS_PANDAS, _HAS_MUNCH
-from IGServices.utils import conv_resol, conv_datetime, conv_to_ms, DATE_FORMATS, munchify
+from IGServices.utils import conv_resol, conv_datetime, conv_to_ms, conv_date_columns, DATE_FORMATS, ISO_DATE_FORMAT, munchify
+from IGServices.quotes import quote_from_market
+from IGServices.planner import parse_allowance
+from IGServices.jsonstream import ColumnBuilder, iter_response_chunks, parse_columns
+from IGServices.ratelimit import request_priority
 from tenacity import Retrying
 
 
@@ -41,7 +45,8 @@ class IGService:
     IG_USERNAME = None
     IG_PASSWORD = None
 
-    def __init__(self, username, password, api_key, acc_type="live", acc_id=None, retryer: Retrying = None):
+    def __init__(self, username, password, api_key, acc_type="live", acc_id=None, retryer: Retrying = None,
+                 scheduler=None):
         """Constructor, calls the method required to connect to the API (accepts acc_type = LIVE or DEMO)"""
         self.API_KEY = api_key
         self.IG_USERNAME = username
@@ -66,6 +71,20 @@ class IGService:
 
         self.return_dataframe = True
 
+        # Optional PriorityScheduler pacing the requests by priority:
+        # dealing, then account reads, reference data and price history
+        self.scheduler = scheduler
+
+        # Details of the current session (accounts, lightstreamerEndpoint)
+        self.session = None
+
+        # Historical prices Allowance, from the last price response
+        self.allowance = None
+
+        # Optional QuoteCache fed by the stream, read before the REST API
+        self.quote_cache = None
+        self.quote_max_age = 1.0
+
         # self.create_session()
 
     ########## PARSE_RESPONSE ##########
@@ -92,27 +111,31 @@ class IGService:
 
     def fetch_accounts(self):
         """Returns a list of accounts belonging to the logged-in client"""
-        response = requests.get(self.BASE_URL + '/accounts', headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/accounts', headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['accounts'])
         return (data)
 
-    def fetch_account_activity_by_period(self, milliseconds):
-        """Returns the account activity history for the last specified period"""
-        response = requests.get(self.BASE_URL + '/history/activity/%s' % milliseconds, headers=self.LOGGED_IN_HEADERS)
+    def fetch_account_activity_by_period(self, milliseconds, stream=False):
+        """Returns the account activity history for the last specified period
+        (parsed while it is read with stream=True)"""
+        if stream and self.return_dataframe:
+            data = self._request_frames('/history/activity/%s' % milliseconds, ['activities'])
+            return (conv_date_columns(data['activities']))
+        response = self._request('get', '/history/activity/%s' % milliseconds, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
-            data = pd.DataFrame(data['activities'])
+            data = conv_date_columns(pd.DataFrame(data['activities']))
         return (data)
 
     def fetch_transaction_history_by_type_and_period(self, milliseconds, trans_type):
         """Returns the transaction history for the specified transaction type and period"""
-        response = requests.get(self.BASE_URL + '/history/transactions/%s/%s' % (trans_type, milliseconds),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/history/transactions/%s/%s' % (trans_type, milliseconds),
+                                 headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
-            data = pd.DataFrame(data['transactions'])
+            data = conv_date_columns(pd.DataFrame(data['transactions']))
         return (data)
 
     ############ END ############
@@ -121,13 +144,13 @@ class IGService:
 
     def fetch_deal_by_deal_reference(self, deal_reference):
         """Returns a deal confirmation for the given deal reference"""
-        response = requests.get(self.BASE_URL + '/confirms/%s' % deal_reference, headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/confirms/%s' % deal_reference, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
     def fetch_open_positions(self):
         """Returns all open positions for the active account"""
-        response = requests.get(self.BASE_URL + '/positions', headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/positions', headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             list = data["positions"]
@@ -175,7 +198,7 @@ class IGService:
             'size': size
         }
 
-        response = requests.post(self.BASE_URL + '/positions/otc', data=json.dumps(params), headers=self.DELETE_HEADERS)
+        response = self._request('post', '/positions/otc', data=json.dumps(params), headers=self.DELETE_HEADERS)
 
         if response.status_code == 200:
             deal_reference = json.loads(response.text)['dealReference']
@@ -204,7 +227,7 @@ class IGService:
             'stopLevel': stop_level
         }
 
-        response = requests.post(self.BASE_URL + '/positions/otc', data=json.dumps(params),
+        response = self._request('post', '/positions/otc', data=json.dumps(params),
                                  headers=self.LOGGED_IN_HEADERS)
 
         if response.status_code == 200:
@@ -220,8 +243,8 @@ class IGService:
             'stopLevel': stop_level
         }
 
-        response = requests.put(self.BASE_URL + '/positions/otc/%s' % deal_id, data=json.dumps(params),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/positions/otc/%s' % deal_id, data=json.dumps(params),
+                                 headers=self.LOGGED_IN_HEADERS)
 
         if response.status_code == 200:
             deal_reference = json.loads(response.text)['dealReference']
@@ -231,7 +254,7 @@ class IGService:
 
     def fetch_working_orders(self):
         """Returns all open working orders for the active account"""
-        response = requests.get(self.BASE_URL + '/workingorders', headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/workingorders', headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         # if self.return_dataframe:
         #     data = pd.DataFrame(data['workingOrders'])
@@ -258,7 +281,7 @@ class IGService:
             'type': order_type
         }
 
-        response = requests.post(self.BASE_URL + '/workingorders/otc', data=json.dumps(params),
+        response = self._request('post', '/workingorders/otc', data=json.dumps(params),
                                  headers=self.LOGGED_IN_HEADERS)
 
         if response.status_code == 200:
@@ -269,7 +292,7 @@ class IGService:
 
     def delete_working_order(self, deal_id):
         """Deletes an OTC working order"""
-        response = requests.post(self.BASE_URL + '/workingorders/otc/%s' % deal_id, data=json.dumps({}),
+        response = self._request('post', '/workingorders/otc/%s' % deal_id, data=json.dumps({}),
                                  headers=self.DELETE_HEADERS)
 
         if response.status_code == 200:
@@ -292,8 +315,8 @@ class IGService:
             'type': order_type
         }
 
-        response = requests.put(self.BASE_URL + '/workingorders/otc/%s' % deal_id, data=json.dumps(params),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/workingorders/otc/%s' % deal_id, data=json.dumps(params),
+                                 headers=self.LOGGED_IN_HEADERS)
 
         if response.status_code == 200:
             deal_reference = json.loads(response.text)['dealReference']
@@ -307,31 +330,37 @@ class IGService:
 
     def fetch_client_sentiment_by_instrument(self, market_id):
         """Returns the client sentiment for the given instrument's market"""
-        response = requests.get(self.BASE_URL + '/clientsentiment/%s' % market_id, headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/clientsentiment/%s' % market_id, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
     def fetch_related_client_sentiment_by_instrument(self, market_id):
         """Returns a list of related (also traded) client sentiment for the given instrument's market"""
-        response = requests.get(self.BASE_URL + '/clientsentiment/related/%s' % market_id,
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/clientsentiment/related/%s' % market_id,
+                                 headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['clientSentiments'])
         return (data)
 
-    def fetch_top_level_navigation_nodes(self):
-        """Returns all top-level nodes (market categories) in the market navigation hierarchy."""
-        response = requests.get(self.BASE_URL + '/marketnavigation', headers=self.LOGGED_IN_HEADERS)
+    def fetch_top_level_navigation_nodes(self, stream=False):
+        """Returns all top-level nodes (market categories) in the market navigation hierarchy
+        (parsed while it is read with stream=True)"""
+        if stream and self.return_dataframe:
+            return (self._request_frames('/marketnavigation', ['markets', 'nodes']))
+        response = self._request('get', '/marketnavigation', headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data['markets'] = pd.DataFrame(data['markets'])
             data['nodes'] = pd.DataFrame(data['nodes'])
         return (data)
 
-    def fetch_sub_nodes_by_node(self, node):
-        """Returns all sub-nodes of the given node in the market navigation hierarchy"""
-        response = requests.get(self.BASE_URL + '/marketnavigation/%s' % node, headers=self.LOGGED_IN_HEADERS)
+    def fetch_sub_nodes_by_node(self, node, stream=False):
+        """Returns all sub-nodes of the given node in the market navigation hierarchy
+        (parsed while it is read with stream=True)"""
+        if stream and self.return_dataframe:
+            return (self._request_frames('/marketnavigation/%s' % node, ['markets', 'nodes']))
+        response = self._request('get', '/marketnavigation/%s' % node, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data['markets'] = pd.DataFrame(data['markets'])
@@ -340,68 +369,138 @@ class IGService:
 
     def fetch_market_by_epic(self, epic):
         """Returns the details of the given market"""
-        response = requests.get(self.BASE_URL + '/markets/%s' % epic, headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/markets/%s' % epic, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
-    def search_markets(self, search_term):
-        """Returns all markets matching the search term"""
-        response = requests.get(self.BASE_URL + '/markets?searchTerm=%s' % search_term, headers=self.LOGGED_IN_HEADERS)
+    def attach_quote_cache(self, quote_cache, max_age=1.0):
+        """Serves the quote reads from the given QuoteCache when its quotes
+        are at most max_age seconds old"""
+        self.quote_cache = quote_cache
+        self.quote_max_age = max_age
+
+    def fetch_quote(self, epic, max_age=None):
+        """Returns the latest Quote of the given market, from the quote cache
+        if fresh enough, else from the market details. Returns None if IG
+        has no market of this epic"""
+        return (self.fetch_quotes([epic], max_age).get(epic))
+
+    def fetch_quotes(self, epics, max_age=None):
+        """Returns the latest Quote of each of the given markets, by epic,
+        reading the ones missing from the quote cache with a single request
+        per 50 epics. The epics IG has no market of are left out"""
+        if max_age is None:
+            max_age = self.quote_max_age
+        quotes = {}
+        missing = []
+        for epic in epics:
+            quote = self.quote_cache.get(epic, max_age) if self.quote_cache is not None else None
+            if quote is None:
+                missing.append(epic)
+            else:
+                quotes[epic] = quote
+        headers = dict(self.LOGGED_IN_HEADERS, Version='2')
+        for i in range(0, len(missing), 50):
+            response = self._request('get', '/markets?epics=%s' % ','.join(missing[i:i + 50]),
+                                     headers=headers)
+            data = self.parse_response(response.text)
+            for market in data['marketDetails']:
+                quote = quote_from_market(market)
+                quotes[quote.epic] = quote
+                if self.quote_cache is not None:
+                    self.quote_cache.put(quote)
+        return (quotes)
+
+    def search_markets(self, search_term, stream=False):
+        """Returns all markets matching the search term (parsed while it is
+        read with stream=True)"""
+        if stream and self.return_dataframe:
+            return (self._request_frames('/markets?searchTerm=%s' % search_term, ['markets'])['markets'])
+        response = self._request('get', '/markets?searchTerm=%s' % search_term, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['markets'])
         return (data)
 
-    '''
-    def fetch_historical_prices_by_epic_and_num_points(self, epic, resolution,
-                                                       numpoints, session=None,
-                                                       format=None):
-        """Returns a list of historical prices for the given epic, resolution,
-        number of points"""
-        version = "2"
+    def fetch_historical_prices_pages(self, epic, resolution, start_date=None, end_date=None,
+                                      numpoints=None, page_size=20, format=None):
+        """Yields the historical prices for the given epic, resolution and date
+        range (or last numpoints) page by page, from the version 3 API.
+        Each page is requested when the previous one has been consumed, so
+        stopping the iteration stops the requests (and the allowance use)"""
+        version = "3"
         if self.return_dataframe:
             resolution = conv_resol(resolution)
-        params = {}
-        url_params = {"epic": epic, "resolution": resolution, "numpoints": numpoints}
-        endpoint = "/prices/{epic}/{resolution}/{numpoints}".format(**url_params)
-        action = "read"
-        response = self._req(action, endpoint, params, session, version)
-        data = self.parse_response(response.text)
         if format is None:
             format = self.format_prices
-        if self.return_dataframe:
-            data["prices"] = format(data["prices"], version)
-            data['prices'] = data['prices'].fillna(value=np.nan)
-        return data
-    '''
-
-    def fetch_historical_prices_by_epic_and_date_range(self, epic, resolution, start_date, end_date):
-        """Returns a list of historical prices for the given epic, resolution, multiplier and date range"""
-        response = requests.get(
-            self.BASE_URL + "/prices/{epic}/{resolution}/?startdate={start_date}&enddate={end_date}".format(epic=epic,
-                                                                                                            resolution=resolution,
-                                                                                                            start_date=start_date,
-                                                                                                            end_date=end_date),
-            headers=self.LOGGED_IN_HEADERS)
+        params = {'resolution': resolution, 'pageSize': page_size}
+        if start_date is not None:
+            params['from'] = pd.to_datetime(start_date).strftime(ISO_DATE_FORMAT)
+        if end_date is not None:
+            params['to'] = pd.to_datetime(end_date).strftime(ISO_DATE_FORMAT)
+        if numpoints is not None:
+            params['max'] = numpoints
+        headers = dict(self.LOGGED_IN_HEADERS, Version=version)
+        page_number = 1
+        while True:
+            params['pageNumber'] = page_number
+            response = self._request('get', '/prices/%s' % epic, params=params, headers=headers)
+            data = self.parse_response(response.text)
+            self._track_allowance(data)
+            if not data['prices']:
+                return
+            if self.return_dataframe:
+                data['prices'] = format(data['prices'], version).fillna(value=np.nan)
+            yield data
+            page_data = data.get('metadata', {}).get('pageData', {})
+            if page_size == 0 or page_number >= page_data.get('totalPages', page_number):
+                return
+            page_number += 1
+
+    def fetch_historical_prices_by_epic_and_num_points(self, epic, resolution, numpoints, format=None):
+        """Returns the last numpoints historical prices for the given epic and
+        resolution"""
+        pages = list(self.fetch_historical_prices_pages(epic, resolution, numpoints=numpoints,
+                                                        page_size=0, format=format))
+        if not pages:
+            raise (Exception("Historical price data not found"))
+        return (pages[0])
+
+    def fetch_historical_prices_by_epic_and_date_range(self, epic, resolution, start_date, end_date, stream=False,
+                                                       flatten=False):
+        """Returns a list of historical prices for the given epic, resolution, multiplier and date range.
+        With stream=True the prices are parsed while they are read. With flatten=True the price dicts are
+        flattened into columns (openPrice.bid, ...), which takes less memory"""
+        path = "/prices/{epic}/{resolution}/?startdate={start_date}&enddate={end_date}".format(
+            epic=epic, resolution=resolution, start_date=start_date, end_date=end_date)
+        if stream and self.return_dataframe:
+            data = self._request_frames(path, ['prices'], flatten=flatten)
+            conv_date_columns(data['prices'])
+            self._track_allowance(data)
+            return (data)
+        response = self._request('get', path, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
+        self._track_allowance(data)
         if self.return_dataframe:
-            data['prices'] = pd.DataFrame(data['prices'])
+            prices = pd.json_normalize(data['prices']) if flatten else pd.DataFrame(data['prices'])
+            data['prices'] = conv_date_columns(prices)
         return (data)
 
     def market_prices(self, epic, resolution, num_points):
         """Returns a list of historical prices for the given epic, resolution, multiplier and date range"""
-        response = requests.get(
-            self.BASE_URL + "/prices/{epic}/{resolution}/{numPoints}".format(epic=epic, resolution=resolution,
-                                                                             numPoints=num_points),
+        response = self._request(
+            'get', "/prices/{epic}/{resolution}/{numPoints}".format(epic=epic, resolution=resolution,
+                                                                    numPoints=num_points),
             headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
+        self._track_allowance(data)
         if self.return_dataframe:
-            data['prices'] = pd.DataFrame(data['prices'])
+            data['prices'] = conv_date_columns(pd.DataFrame(data['prices']))
         return (data['prices'])
 
     def get_epic(self, identifier):
         id = identifier
-        response = requests.get(self.BASE_URL + '/markets?searchTerm=%s' % id, headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/markets?searchTerm=%s' % id, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['markets'])
@@ -421,7 +520,7 @@ class IGService:
 
     def fetch_all_watchlists(self):
         """Returns all watchlists belonging to the active account"""
-        response = requests.get(self.BASE_URL + '/watchlists', headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/watchlists', headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['watchlists'])
@@ -434,19 +533,19 @@ class IGService:
             'epics': epics
         }
 
-        response = requests.post(self.BASE_URL + '/watchlists', data=json.dumps(params), headers=self.LOGGED_IN_HEADERS)
+        response = self._request('post', '/watchlists', data=json.dumps(params), headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
     def delete_watchlist(self, watchlist_id):
         """Deletes a watchlist"""
-        response = requests.post(self.BASE_URL + '/watchlists/%s' % watchlist_id, data=json.dumps({}),
+        response = self._request('post', '/watchlists/%s' % watchlist_id, data=json.dumps({}),
                                  headers=self.DELETE_HEADERS)
         return (response.text)
 
     def fetch_watchlist_markets(self, watchlist_id):
         """Returns the given watchlist's markets"""
-        response = requests.get(self.BASE_URL + '/watchlists/%s' % watchlist_id, headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/watchlists/%s' % watchlist_id, headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         if self.return_dataframe:
             data = pd.DataFrame(data['markets'])
@@ -458,14 +557,14 @@ class IGService:
             'epic': epic
         }
 
-        response = requests.put(self.BASE_URL + '/watchlists/%s' % watchlist_id, data=json.dumps(params),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/watchlists/%s' % watchlist_id, data=json.dumps(params),
+                                 headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
     def remove_market_from_watchlist(self, watchlist_id, epic):
         """Remove an market from a watchlist"""
-        response = requests.post(self.BASE_URL + '/watchlists/%s/%s' % (watchlist_id, epic), data=json.dumps({}),
+        response = self._request('post', '/watchlists/%s/%s' % (watchlist_id, epic), data=json.dumps({}),
                                  headers=self.DELETE_HEADERS)
         return (response.text)
 
@@ -475,7 +574,8 @@ class IGService:
 
     def logout(self):
         """Log out of the current session"""
-        requests.post(self.BASE_URL + '/session', data=json.dumps({}), headers=self.DELETE_HEADERS)
+        self._request('post', '/session', data=json.dumps({}), headers=self.DELETE_HEADERS)
+        self.session = None
 
     def create_session(self):
         """Creates a trading session, obtaining session tokens for subsequent API access"""
@@ -484,9 +584,10 @@ class IGService:
             'password': self.IG_PASSWORD
         }
 
-        response = requests.post(self.BASE_URL + '/session', data=json.dumps(params), headers=self.BASIC_HEADERS)
+        response = self._request('post', '/session', data=json.dumps(params), headers=self.BASIC_HEADERS)
         self._set_headers(response.headers, True)
         data = self.parse_response(response.text)
+        self.session = data
         return (data)
 
     def switch_account(self, account_id):
@@ -496,9 +597,11 @@ class IGService:
             # 'defaultAccount': default_account
         }
 
-        response = requests.put(self.BASE_URL + '/session', data=json.dumps(params), headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/session', data=json.dumps(params), headers=self.LOGGED_IN_HEADERS)
         self._set_headers(response.headers, False)
         data = self.parse_response(response.text)
+        if self.session is not None:
+            self.session['currentAccountId'] = account_id
         return (data)
 
     ############ END ############
@@ -507,7 +610,7 @@ class IGService:
 
     def get_client_apps(self):
         """Returns a list of client-owned applications"""
-        response = requests.get(self.BASE_URL + '/operations/application', headers=self.LOGGED_IN_HEADERS)
+        response = self._request('get', '/operations/application', headers=self.LOGGED_IN_HEADERS)
 
         return self.parse_response(response.text)
 
@@ -520,16 +623,16 @@ class IGService:
             'status': status
         }
 
-        response = requests.put(self.BASE_URL + '/operations/application', data=json.dumps(params),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/operations/application', data=json.dumps(params),
+                                 headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
     def disable_client_app_key(self):
         """Disables the current application key from processing further requests.
         Disabled keys may be reenabled via the My Account section on the IG Web Dealing Platform."""
-        response = requests.put(self.BASE_URL + '/operations/application/disable', data=json.dumps({}),
-                                headers=self.LOGGED_IN_HEADERS)
+        response = self._request('put', '/operations/application/disable', data=json.dumps({}),
+                                 headers=self.LOGGED_IN_HEADERS)
         data = self.parse_response(response.text)
         return (data)
 
@@ -537,6 +640,51 @@ class IGService:
 
     ########## PRIVATE ##########
 
+    @staticmethod
+    def format_prices(prices, version):
+        """Formats a list of prices as a DataFrame indexed by time, with
+        columns bid, ask and last (Open, High, Low, Close) and Volume"""
+        if len(prices) == 0:
+            raise (Exception("Historical price data not found"))
+        df = pd.json_normalize(prices)
+        index = pd.to_datetime(df['snapshotTime'], format=DATE_FORMATS[int(version)])
+        index.name = 'DateTime'
+        columns = {'openPrice': 'Open', 'highPrice': 'High', 'lowPrice': 'Low', 'closePrice': 'Close'}
+        frames = {}
+        for typ in ('bid', 'ask', 'lastTraded'):
+            frame = df[['%s.%s' % (col, typ) for col in columns]]
+            frame.columns = list(columns.values())
+            frames['last' if typ == 'lastTraded' else typ] = frame.set_index(index)
+        data = pd.concat(frames, axis=1)
+        data['Volume'] = df['lastTradedVolume'].values
+        return (data)
+
+    def _track_allowance(self, data):
+        """Keeps the historical prices allowance of a price response"""
+        allowance = parse_allowance(data)
+        if allowance is not None:
+            self.allowance = allowance
+
+    def _request_frames(self, path, keys, flatten=False, headers=None):
+        """Returns the response of a GET request, with the arrays of the
+        given keys built into DataFrames while the body is read"""
+        builders = dict((key, ColumnBuilder(flatten)) for key in keys)
+        response = self._request('get', path, headers=headers or self.LOGGED_IN_HEADERS, stream=True)
+        with response:
+            data = parse_columns(iter_response_chunks(response), builders)
+        if 'errorCode' in data and self.parse_response == self.parse_response_with_exception:
+            raise (Exception(data['errorCode']))
+        for key, builder in builders.items():
+            data[key] = builder.frame()
+        return (data)
+
+    def _request(self, method, path, **kwargs):
+        """Sends a request to the API, once the scheduler lets its priority through"""
+        if self.scheduler is not None:
+            verb = (kwargs.get('headers') or {}).get('_method', method)
+            self.scheduler.acquire(priority=request_priority(verb, path))
+        return getattr(requests, method)(self.BASE_URL + path, **kwargs)
+
     def _set_headers(self, response_headers, update_cst):
         """Sets headers"""
         if update_cst == True:
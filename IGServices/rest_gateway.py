@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Local gateway sharing one logged-in IGService, with its allowance, between
+the processes of the machine.
+
+The gateway listens on a multiprocessing.connection Listener (a Unix
+socket by default) and runs the IGService methods requested by the
+IGServiceClient proxies of the other processes, through a global rate
+limiter, a response cache and request coalescing.
+
+The clients authenticate with the authkey of the gateway: given, or
+generated and saved next to the Unix socket (<address>.key), both readable
+by the user only.
+"""
+
+import inspect
+import logging
+import os
+import pickle
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+from IGServices.ratelimit import (
+    TokenBucket, TRADING_REQUESTS_PER_MINUTE, NON_TRADING_REQUESTS_PER_MINUTE
+)
+from IGServices.rest import IGService, IGException
+from IGServices.utils import SOCKET_MODE, authkey_path, read_authkey, save_authkey
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "/tmp/ig_rest.sock"
+
+# Methods creating, changing or closing positions and orders
+TRADING_METHODS = frozenset([
+    "create_open_position",
+    "close_open_position",
+    "update_open_position",
+    "create_working_order",
+    "delete_working_order",
+    "update_working_order",
+])
+
+# Methods whose results are cached and coalesced, with their time to live
+# in seconds when it differs from the default one
+READ_PREFIXES = ("fetch_", "search_", "get_", "market_prices")
+CACHE_TTLS = {
+    "fetch_historical_prices_by_epic_and_date_range": 3600.0,
+    "fetch_top_level_navigation_nodes": 3600.0,
+    "fetch_sub_nodes_by_node": 3600.0,
+    "get_epic": 3600.0,
+    "search_markets": 300.0,
+}
+
+# Cached results count above which the expired ones are purged
+MAX_CACHE_SIZE = 1000
+
+# Methods acting on the shared session, not available to the clients
+SESSION_METHODS = frozenset(["logout", "switch_account"])
+
+# Attributes of the IGService readable by the clients, the others hold
+# the credentials and headers of the session
+GETATTR_ALLOWED = frozenset(["session", "allowance", "return_dataframe"])
+
+
+class _Call(object):
+    """Request in flight, awaited by the identical requests coalesced
+    into it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RestGateway(object):
+    """Serves the IGService methods to the local IGServiceClients.
+
+    Cache misses of the read methods (fetch_*, search_*, get_*,
+    market_prices) and all the other methods wait for a token of the
+    trading or non-trading bucket, sized by default on the IG allowances.
+    Identical read requests arriving while one is in flight wait for its
+    result instead of calling the API again, and the results are cached for
+    cache_ttl seconds (see CACHE_TTLS). Any other method clears the cache,
+    as positions, orders or watchlists may have changed. Generator methods
+    (e.g. fetch_historical_prices_pages) are not available.
+
+    Without authkey, a random one is generated and saved to
+    authkey_path(address) for the clients.
+    """
+
+    def __init__(self, ig_service, address=DEFAULT_ADDRESS, authkey=None, cache_ttl=1.0,
+                 trading_per_minute=TRADING_REQUESTS_PER_MINUTE,
+                 non_trading_per_minute=NON_TRADING_REQUESTS_PER_MINUTE):
+        self.ig_service = ig_service
+        self.address = address
+        self.authkey = authkey
+        self.cache_ttl = cache_ttl
+        self.trading_bucket = TokenBucket.per_minute(trading_per_minute)
+        self.non_trading_bucket = TokenBucket.per_minute(non_trading_per_minute)
+        self._lock = threading.Lock()
+        # request key -> (expiry, result)
+        self._cache = {}
+        # request key -> _Call
+        self._inflight = {}
+        self._listener = None
+        self._saved_authkey = False
+        self._thread = None
+        self._running = False
+        self.call_count = 0
+        self.cache_hits = 0
+        self.coalesced_count = 0
+
+    def start(self):
+        """Log in if needed and serve the clients on a REST-GATEWAY-THREAD"""
+        if self.ig_service.session is None:
+            self.ig_service.create_session()
+        unix = isinstance(self.address, str)
+        if self.authkey is None:
+            if not unix:
+                raise ValueError("An authkey is required on %s" % (self.address,))
+            self.authkey = os.urandom(32)
+            save_authkey(self.address, self.authkey)
+            self._saved_authkey = True
+        if unix and os.path.exists(self.address):
+            os.remove(self.address)
+        self._listener = Listener(self.address, authkey=self.authkey)
+        if unix:
+            os.chmod(self.address, SOCKET_MODE)
+        self._running = True
+        self._thread = threading.Thread(name="REST-GATEWAY-THREAD", target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("REST gateway listening on %s" % (self.address,))
+
+    def stop(self):
+        self._running = False
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._saved_authkey and os.path.exists(authkey_path(self.address)):
+            os.remove(authkey_path(self.address))
+
+    def _accept(self):
+        while self._running:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError):
+                if self._running:
+                    logger.warning(traceback.format_exc())
+                    continue
+                break
+            thread = threading.Thread(
+                name="REST-GATEWAY-CLIENT", target=self._serve, args=(connection,)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    name, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    reply = ("ok", self.call(name, *args, **kwargs))
+                except Exception as e:
+                    reply = ("error", e)
+                try:
+                    connection.send(reply)
+                except (OSError, ValueError):
+                    break
+                except Exception as e:
+                    # Result or exception which cannot be pickled
+                    connection.send(("error", IGException(repr(e))))
+
+    @staticmethod
+    def _is_read(name):
+        return name.startswith(READ_PREFIXES)
+
+    def _method(self, name):
+        if name.startswith("_") or name in SESSION_METHODS:
+            raise IGException("%s is not available through the REST gateway" % name)
+        method = getattr(self.ig_service, name, None)
+        if not callable(method):
+            raise AttributeError("IGService has no method %s" % name)
+        if inspect.isgeneratorfunction(method):
+            raise IGException("%s returns a generator, not available through the REST gateway" % name)
+        return method
+
+    def call(self, name, *args, **kwargs):
+        """Runs an IGService method as requested by a client"""
+        if name == "create_session":
+            # The clients share the session of the gateway
+            return self.ig_service.session
+        if name == "getattr":
+            if args[0] not in GETATTR_ALLOWED:
+                raise AttributeError("%s is not available through the REST gateway" % args[0])
+            return getattr(self.ig_service, args[0])
+        method = self._method(name)
+        if not self._is_read(name):
+            self._throttle(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._cache.clear()
+
+        # repr, as arguments may be lists (e.g. the epics of fetch_quotes)
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.cache_hits += 1
+                return cached[1]
+            call = self._inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self._inflight[key] = _Call()
+            else:
+                self.coalesced_count += 1
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            self._throttle(name)
+            call.result = method(*args, **kwargs)
+            try:
+                pickle.dumps(call.result)
+            except Exception:
+                # Never sent whole to the clients, so not worth caching
+                return call.result
+            with self._lock:
+                now = time.monotonic()
+                if len(self._cache) >= MAX_CACHE_SIZE:
+                    for expired in [k for k, (expiry, _) in self._cache.items() if expiry <= now]:
+                        del self._cache[expired]
+                ttl = CACHE_TTLS.get(name, self.cache_ttl)
+                self._cache[key] = (now + ttl, call.result)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+
+    def _throttle(self, name):
+        bucket = self.trading_bucket if name in TRADING_METHODS else self.non_trading_bucket
+        bucket.acquire()
+        with self._lock:
+            self.call_count += 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "calls": self.call_count,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced_count,
+                "cached": len(self._cache),
+                "trading_tokens": self.trading_bucket.available(),
+                "non_trading_tokens": self.non_trading_bucket.available(),
+            }
+
+
+class IGServiceClient(object):
+    """Proxy with the interface of IGService, running the methods in the
+    RestGateway process. create_session returns the session of the
+    gateway, logout only closes the connection to it. Without authkey, the
+    one saved by the gateway next to its Unix socket is read.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        if authkey is None and not isinstance(address, str):
+            raise ValueError("An authkey is required on %s" % (address,))
+        self.address = address
+        self.authkey = authkey
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _call(self, name, *args, **kwargs):
+        with self._lock:
+            if self._connection is None:
+                if self.authkey is None:
+                    self.authkey = read_authkey(self.address)
+                self._connection = Client(self.address, authkey=self.authkey)
+            self._connection.send((name, args, kwargs))
+            status, result = self._connection.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if not callable(getattr(IGService, name, None)):
+            return self._call("getattr", name)
+
+        def method(*args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        method.__name__ = name
+        return method
+
+    def logout(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -7,50 +7,150 @@ Organisation: Quantl AI Ltd
 
 from __future__ import absolute_import, division, print_function
 
-import sys
-import traceback
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from IGServices.lightstreamer import LSClient
+from IGServices.pool import StreamPool
 
 logger = logging.getLogger(__name__)
 
 
 class IGStreamService(object):
-    def __init__(self, ig_service):
+    def __init__(self, ig_service, dispatcher=None, recorder=None, keepalive_millis=5000, stall_timeout=15.0,
+                 connections=None, max_items=40, max_subscriptions=None):
         self.ig_service = ig_service
         self.lightstreamerEndpoint = None
         self.acc_number = None
         self.ls_client = None
+        self._ls_password = None
+        # With a number of connections, the Subscriptions are spread over
+        # a StreamPool of that many sessions, split into chunks of at most
+        # max_items items and max_subscriptions Subscriptions per session.
+        # The pooled sessions are not recorded.
+        self.connections = connections
+        self.max_items = max_items
+        self.max_subscriptions = max_subscriptions
+        self.pool = None
+        # Optional Dispatcher running the listeners off the stream thread
+        self.dispatcher = dispatcher
+        # Optional StreamRecorder capturing the raw stream
+        self.recorder = recorder
+        # Server keepalive interval and silence tolerated before reconnecting
+        self.keepalive_millis = keepalive_millis
+        self.stall_timeout = stall_timeout
 
-    def create_session(self, encryption=False, version='2'):
-        ig_session = self.ig_service.create_session()
-        # if we have created a v3 session, we also need the session tokens
-        if version == '3':
-            self.ig_service.read_session(fetch_session_tokens='true')
+    def create_session(self, encryption=False, version='2', reuse_session=True, wait=True):
+        """Connects to Lightstreamer Server with the tokens of the IGService
+        session, reusing the one already opened when reuse_session is True
+        and logging in otherwise. With wait=False the connection is made on
+        a background thread and a Future is returned, done once connected.
+        The account streamed is acc_number, if set, else the session one"""
+        ig_session = self.ig_service.session
+        if not reuse_session or ig_session is None or version == '3':
+            ig_session = self.ig_service.create_session()
+            # if we have created a v3 session, we also need the session tokens
+            if version == '3':
+                self.ig_service.read_session(fetch_session_tokens='true')
+        else:
+            logger.info("Reusing the session of account %s" % ig_session.get('currentAccountId'))
         self.lightstreamerEndpoint = ig_session['lightstreamerEndpoint']
+        if self.acc_number is None:
+            self.acc_number = ig_session.get('currentAccountId') or self.ig_service.acc_id
         cst = self.ig_service.LOGGED_IN_HEADERS['CST']
         xsecuritytoken = self.ig_service.LOGGED_IN_HEADERS['X-SECURITY-TOKEN']
-        ls_password = "CST-%s|XST-%s" % (cst, xsecuritytoken)
+        self._ls_password = "CST-%s|XST-%s" % (cst, xsecuritytoken)
+
+        if not wait:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="STREAM-CONNECT")
+            future = executor.submit(self._connect)
+            executor.shutdown(wait=False)
+            return future
 
-        # Establishing a new connection to Lightstreamer Server
-        logger.info("Starting connection with %s" % self.lightstreamerEndpoint)
-        self.ls_client = LSClient(
-            self.lightstreamerEndpoint, adapter_set="", user=self.acc_number, password=ls_password
-        )
         try:
-            self.ls_client.connect()
-            return
+            self._connect()
         except Exception:
             logger.error("Unable to connect to Lightstreamer Server")
-            logger.error(traceback.format_exc())
-            sys.exit(1)
+            raise
+
+    def _connect(self):
+        # Establishing a new connection to Lightstreamer Server
+        logger.info("Starting connection with %s" % self.lightstreamerEndpoint)
+        if self.connections is not None:
+            self.pool = StreamPool(
+                self._new_client, connections=self.connections,
+                max_items=self.max_items, max_subscriptions=self.max_subscriptions
+            )
+            self.pool.connect()
+        else:
+            self.ls_client = self._new_client(self.recorder)
+            self.ls_client.connect()
+
+    def _new_client(self, recorder=None):
+        return LSClient(
+            self.lightstreamerEndpoint, adapter_set="", user=self.acc_number, password=self._ls_password,
+            dispatcher=self.dispatcher, recorder=recorder,
+            keepalive_millis=self.keepalive_millis, stall_timeout=self.stall_timeout
+        )
+
+    def subscribe(self, subscription):
+        """Subscribes on the session, or on the pool, and returns the
+        subscription key (pool key)"""
+        if self.pool is not None:
+            return self.pool.subscribe(subscription)
+        return self.ls_client.subscribe(subscription)
+
+    def subscribe_many(self, subscriptions):
+        """Subscribes all the Subscriptions in batched requests and
+        returns their subscription keys (pool keys)"""
+        if self.pool is not None:
+            return self.pool.subscribe_many(subscriptions)
+        return self.ls_client.subscribe_many(subscriptions)
+
+    def unsubscribe(self, subscription_key):
+        if self.pool is not None:
+            self.pool.unsubscribe(subscription_key)
+        else:
+            self.ls_client.unsubscribe(subscription_key)
 
     def unsubscribe_all(self):
+        if self.pool is not None:
+            self.pool.unsubscribe_all()
+            return
         # To avoid a RuntimeError: dictionary changed size during iteration
         subscriptions = self.ls_client._subscriptions.copy()
-        for subcription_key in subscriptions:
-            self.ls_client.unsubscribe(subcription_key)
+        self.ls_client.unsubscribe_many(list(subscriptions))
+
+    def stream_stats(self):
+        """Returns a snapshot of the stream metrics: message/byte rates,
+        per subscription and item update rates, PROBE intervals, bind,
+        rebind and recovery counts, dispatch latency, feed lag and the
+        dispatch queue metrics (per session when pooled)"""
+        if self.pool is not None:
+            stats = self.pool.stats()
+            stats["dispatch"] = self.dispatch_metrics()
+            return stats
+        if self.ls_client is None:
+            return {}
+        stats = self.ls_client.metrics.snapshot()
+        stats["dispatch"] = self.dispatch_metrics()
+        return stats
+
+    def dispatch_metrics(self):
+        """Returns the dispatch queue depth and dropped/conflated counts"""
+        if self.dispatcher is None:
+            return {}
+        return self.dispatcher.metrics()
 
-    def disconnect(self):
-        self.unsubscribe_all()
-        self.ls_client.disconnect()
+    def disconnect(self, drain=True, timeout=None):
+        """Unsubscribes, closes the stream, then waits for the dispatcher
+        workers to deliver the queued updates (unless drain is False)"""
+        if self.pool is not None:
+            self.pool.disconnect(drain=drain, timeout=timeout)
+        else:
+            self.unsubscribe_all()
+            self.ls_client.disconnect(drain=False)
+        if self.dispatcher is not None:
+            # Once every session is closed
+            self.dispatcher.stop(drain, timeout)
+        if self.recorder is not None:
+            self.recorder.close()
@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+"""
+Local gateway sharing the Lightstreamer session of an IGStreamService with
+the other processes of the machine, over a Unix socket.
+
+Messages are JSON documents, one per line. A client sends
+{"op": "subscribe", "id": <client id>, "mode", "items", "fields", "adapter",
+"max_frequency", "buffer_size", "snapshot"} and {"op": "unsubscribe", "id"};
+the gateway answers {"op": "subscribed" | "unsubscribed" | "error", "id"}
+and sends {"op": "update", "id", "line"} where line is the item update in
+the Lightstreamer text format ("<pos>|<value>|..." with empty unchanged
+values), so the Subscription of the client decodes it as the LSClient does.
+
+The first message of a client is {"op": "auth", "key": <hex authkey>}: the
+authkey of the gateway, given or generated and saved next to the socket
+(<path>.key), both readable by the user only.
+"""
+
+import collections
+import errno
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+
+from IGServices.dispatcher import merge_item_info, POLICY_BLOCK, POLICY_CONFLATE
+from IGServices.lightstreamer import Subscription, MODE_COMMAND, MODE_MERGE
+from IGServices.utils import SOCKET_MODE, authkey_path, read_authkey, save_authkey
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "/tmp/ig_stream.sock"
+
+
+def _encode_value(value):
+    """Encodes a field value as in the Lightstreamer text protocol"""
+    if value is None:
+        return "#"
+    value = str(value)
+    if not value:
+        return "$"
+    if value[0] in "#$":
+        return "$" + value
+    return value
+
+
+def encode_update(subscription, item_info, fields=None):
+    """Returns the item line of an update of the given Subscription, with
+    the values of the changed fields (or of the given fields) only. In
+    COMMAND mode the key and command are always sent.
+    """
+    values = item_info["values"]
+    sent = set(item_info.get("changed", ()) if fields is None else fields)
+    if subscription.mode == MODE_COMMAND:
+        sent.add(subscription.key_field)
+        sent.add(subscription.command_field)
+    tokens = [str(item_info["pos"])]
+    for field in subscription.field_names:
+        tokens.append(_encode_value(values.get(field)) if field in sent else "")
+    return "|".join(tokens)
+
+
+class _Upstream(object):
+    """Subscription to Lightstreamer Server shared by identical client
+    subscriptions.
+    """
+
+    def __init__(self, identity, subscription):
+        self.identity = identity
+        self.subscription = subscription
+        self.key = None
+        # Set once the subscribe request has returned (key None if it failed)
+        self.subscribed = threading.Event()
+        # (client connection, client subscription id)
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def on_item_update(self, item_info):
+        with self.lock:
+            clients = list(self.clients)
+        for connection, client_id in clients:
+            connection.put(client_id, self.subscription, item_info)
+
+    def snapshot(self):
+        """Returns the item infos rebuilding the current state of the items
+        for a client joining after the initial snapshot.
+        """
+        fields = self.subscription.field_names
+        return [
+            {"pos": pos, "values": values, "changed": fields}
+            for pos, values in self.subscription.getstate()
+        ]
+
+
+class _ClientConnection(object):
+    """Connection of a local client, with its bounded queue of updates sent
+    by a dedicated writer thread. With POLICY_CONFLATE, pending updates of
+    the same item (row in COMMAND mode) are merged when the client falls
+    behind, other updates are dropped once the queue is full; POLICY_BLOCK
+    holds the fan-out until the client catches up.
+    """
+
+    def __init__(self, gateway, sock, index, maxsize, policy):
+        self.gateway = gateway
+        self.sock = sock
+        self.index = index
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue = collections.deque()
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._running = True
+        self._sequence = 0
+        # client subscription id -> _Upstream
+        self.subscriptions = {}
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.conflated_count = 0
+        self._writer = threading.Thread(
+            name="STREAM-GATEWAY-WRITER-{0}".format(index), target=self._write
+        )
+        self._writer.daemon = True
+        self._reader = threading.Thread(
+            name="STREAM-GATEWAY-READER-{0}".format(index), target=self._read
+        )
+        self._reader.daemon = True
+
+    def start(self):
+        self._writer.start()
+        self._reader.start()
+
+    def _conflation_key(self, client_id, subscription, item_info):
+        if self.policy != POLICY_CONFLATE:
+            return None
+        if subscription.mode == MODE_MERGE:
+            return (client_id, item_info["pos"])
+        if subscription.mode == MODE_COMMAND:
+            return (client_id, item_info["pos"], item_info["values"].get(subscription.key_field))
+        return None
+
+    def put(self, client_id, subscription, item_info):
+        """Queue an update for the client"""
+        key = self._conflation_key(client_id, subscription, item_info)
+        with self._cond:
+            if not self._running:
+                return
+            if key is not None and key in self._pending:
+                _, _, pending = self._pending[key]
+                self._pending[key] = (client_id, subscription, merge_item_info(pending, item_info))
+                self.conflated_count += 1
+                return
+            while self._running and len(self._queue) >= self.maxsize:
+                if self.policy != POLICY_BLOCK:
+                    self.dropped_count += 1
+                    return
+                self._cond.wait()
+            self._append(key, (client_id, subscription, item_info))
+
+    def replay(self, client_id, subscription, item_infos):
+        """Queue the snapshot of a subscription joined late, without
+        waiting: the queue may go over maxsize by the size of the snapshot
+        (conflated with the pending updates with POLICY_CONFLATE)
+        """
+        with self._cond:
+            if not self._running:
+                return
+            for item_info in item_infos:
+                key = self._conflation_key(client_id, subscription, item_info)
+                if key is not None and key in self._pending:
+                    _, _, pending = self._pending[key]
+                    self._pending[key] = (client_id, subscription, merge_item_info(pending, item_info))
+                    self.conflated_count += 1
+                else:
+                    self._append(key, (client_id, subscription, item_info))
+
+    def _append(self, key, entry):
+        if key is None:
+            # Entries never merged get a key of their own
+            self._sequence += 1
+            key = self._sequence
+        self._pending[key] = entry
+        self._queue.append(key)
+        self._cond.notify_all()
+
+    def send(self, message):
+        """Queue a control message for the client"""
+        with self._cond:
+            self._sequence += 1
+            self._pending[self._sequence] = message
+            self._queue.append(self._sequence)
+            self._cond.notify_all()
+
+    def _write(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                entries = [self._pending.pop(key) for key in self._queue]
+                self._queue.clear()
+                self._cond.notify_all()
+
+            lines = []
+            for entry in entries:
+                if isinstance(entry, dict):
+                    message = entry
+                else:
+                    client_id, subscription, item_info = entry
+                    message = {
+                        "op": "update",
+                        "id": client_id,
+                        "line": encode_update(subscription, item_info),
+                    }
+                lines.append(json.dumps(message, separators=(",", ":")))
+            try:
+                self.sock.sendall(("\n".join(lines) + "\n").encode("utf-8"))
+                self.sent_count += len(lines)
+            except (OSError, ValueError):
+                logger.info("Gateway client %d gone" % self.index)
+                self.close()
+                break
+
+    def _authenticate(self, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+            key = bytes.fromhex(request["key"]) if request.get("op") == "auth" else b""
+        except (ValueError, KeyError, TypeError, AttributeError):
+            key = b""
+        return hmac.compare_digest(key, self.gateway.authkey)
+
+    def _read(self):
+        try:
+            stream = self.sock.makefile("rb")
+            authenticated = False
+            for line in stream:
+                line = line.strip()
+                if not line:
+                    continue
+                if not authenticated:
+                    authenticated = self._authenticate(line)
+                    if not authenticated:
+                        logger.warning("Gateway client %d not authenticated" % self.index)
+                        break
+                    continue
+                request = {}
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    self.gateway._handle(self, request)
+                except Exception as e:
+                    logger.warning("Invalid gateway request %r: %s" % (line, e))
+                    self.send({"op": "error", "id": request.get("id"), "message": str(e)})
+        except (OSError, ValueError):
+            pass
+        self.close()
+
+    def close(self):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._queue.clear()
+            self._pending.clear()
+            self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.gateway._release_client(self)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "subscriptions": len(self.subscriptions),
+                "depth": len(self._queue),
+                "sent": self.sent_count,
+                "dropped": self.dropped_count,
+                "conflated": self.conflated_count,
+            }
+
+
+class StreamGateway(object):
+    """Serves the subscriptions of local clients (see GatewayClient) on a
+    Unix socket from the session of an already connected IGStreamService.
+
+    Identical subscriptions (same mode, items, fields, adapter, frequency,
+    buffer size and snapshot) of any number of clients share a single
+    upstream subscription, subscribed on the first request and removed
+    with the last client; a client joining later gets the current state of
+    the items as its snapshot. Each client has its own bounded queue, so a
+    slow client never holds up the others (see _ClientConnection).
+
+    Without authkey, a random one is generated and saved to
+    authkey_path(path) for the clients.
+    """
+
+    def __init__(self, stream_service, path=DEFAULT_PATH, client_queue_size=10000,
+                 policy=POLICY_CONFLATE, authkey=None):
+        if policy not in (POLICY_CONFLATE, POLICY_BLOCK):
+            raise ValueError("Invalid gateway policy %r" % policy)
+        self.stream_service = stream_service
+        self.path = path
+        self.authkey = authkey
+        self._saved_authkey = False
+        self.client_queue_size = client_queue_size
+        self.policy = policy
+        self._lock = threading.RLock()
+        # identity -> _Upstream
+        self._upstreams = {}
+        self._clients = []
+        self._client_counter = 0
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Listen on the Unix socket and serve the clients on a
+        STREAM-GATEWAY-THREAD.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # Left by a gateway no longer running
+                os.remove(self.path)
+            else:
+                raise OSError(errno.EADDRINUSE, "A gateway is already listening on %s" % self.path)
+            finally:
+                probe.close()
+        if self.authkey is None:
+            self.authkey = os.urandom(32)
+            save_authkey(self.path, self.authkey)
+            self._saved_authkey = True
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        os.chmod(self.path, SOCKET_MODE)
+        self._server.listen(64)
+        self._thread = threading.Thread(name="STREAM-GATEWAY-THREAD", target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Stream gateway listening on %s" % self.path)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._client_counter += 1
+                connection = _ClientConnection(
+                    self, sock, self._client_counter, self.client_queue_size, self.policy
+                )
+                self._clients.append(connection)
+            connection.start()
+            logger.info("Gateway client %d connected" % connection.index)
+
+    @staticmethod
+    def _identity(request):
+        return (
+            request.get("mode", MODE_MERGE),
+            tuple(request["items"]),
+            tuple(request["fields"]),
+            request.get("adapter", ""),
+            request.get("max_frequency"),
+            request.get("buffer_size"),
+            request.get("snapshot"),
+        )
+
+    def _handle(self, connection, request):
+        op = request.get("op")
+        client_id = request.get("id")
+        if op == "subscribe":
+            self._subscribe(connection, client_id, request)
+            connection.send({"op": "subscribed", "id": client_id})
+        elif op == "unsubscribe":
+            self._unsubscribe(connection, client_id)
+            connection.send({"op": "unsubscribed", "id": client_id})
+        else:
+            raise ValueError("Unknown op %r" % op)
+
+    def _subscribe(self, connection, client_id, request):
+        identity = self._identity(request)
+        with self._lock:
+            if client_id in connection.subscriptions:
+                raise ValueError("Subscription id %r already used" % client_id)
+            upstream = self._upstreams.get(identity)
+            created = upstream is None
+            if created:
+                mode, items, fields, adapter, max_frequency, buffer_size, snapshot = identity
+                # "true", "false", a DISTINCT snapshot length or None (RAW)
+                subscription = Subscription(
+                    mode=mode, items=list(items), fields=list(fields), adapter=adapter,
+                    max_frequency=max_frequency, buffer_size=buffer_size,
+                    snapshot=None if snapshot is None else snapshot != "false",
+                    snapshot_length=None if snapshot in (None, "true", "false") else int(snapshot),
+                )
+                upstream = _Upstream(identity, subscription)
+                subscription.addlistener(upstream.on_item_update)
+                upstream.clients.add((connection, client_id))
+                self._upstreams[identity] = upstream
+            else:
+                with upstream.lock:
+                    # Never waits for the client, the locks being held
+                    if upstream.subscription.snapshot not in (None, "false"):
+                        connection.replay(client_id, upstream.subscription, upstream.snapshot())
+                    upstream.clients.add((connection, client_id))
+            connection.subscriptions[client_id] = upstream
+        if not created:
+            return
+        # Subscribed outside of the lock, the other requests going on;
+        # identical ones join the upstream meanwhile
+        try:
+            upstream.key = self.stream_service.subscribe(upstream.subscription)
+        except Exception as e:
+            with self._lock:
+                if self._upstreams.get(identity) is upstream:
+                    del self._upstreams[identity]
+                with upstream.lock:
+                    clients = list(upstream.clients)
+                    upstream.clients.clear()
+                for other, other_id in clients:
+                    other.subscriptions.pop(other_id, None)
+            for other, other_id in clients:
+                if (other, other_id) != (connection, client_id):
+                    other.send({"op": "error", "id": other_id, "message": str(e)})
+            raise
+        finally:
+            upstream.subscribed.set()
+        logger.info("Gateway subscribed %s" % (upstream.subscription.item_names,))
+
+    def _unsubscribe(self, connection, client_id):
+        with self._lock:
+            upstream = self._remove_client(connection, client_id)
+        if upstream is not None:
+            self._close_upstream(upstream)
+
+    def _remove_client(self, connection, client_id):
+        """Removes a client subscription, returns its _Upstream if it was
+        the last one"""
+        upstream = connection.subscriptions.pop(client_id, None)
+        if upstream is None:
+            raise ValueError("No subscription id %r" % client_id)
+        with upstream.lock:
+            upstream.clients.discard((connection, client_id))
+            remaining = len(upstream.clients)
+        if remaining or self._upstreams.get(upstream.identity) is not upstream:
+            return None
+        del self._upstreams[upstream.identity]
+        return upstream
+
+    def _close_upstream(self, upstream):
+        """Unsubscribes an upstream subscription, once subscribed, outside
+        of the lock"""
+        upstream.subscribed.wait()
+        if upstream.key is None:
+            return
+        try:
+            self.stream_service.unsubscribe(upstream.key)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def _release_client(self, connection):
+        """Drop the subscriptions of a closed client connection"""
+        with self._lock:
+            upstreams = [
+                self._remove_client(connection, client_id) for client_id in list(connection.subscriptions)
+            ]
+            if connection in self._clients:
+                self._clients.remove(connection)
+        for upstream in upstreams:
+            if upstream is not None:
+                self._close_upstream(upstream)
+        logger.info("Gateway client %d disconnected" % connection.index)
+
+    def metrics(self):
+        """Returns the upstream subscription count and the per client
+        queue metrics.
+        """
+        with self._lock:
+            clients = list(self._clients)
+            upstreams = len(self._upstreams)
+        return {
+            "upstream_subscriptions": upstreams,
+            "clients": dict((c.index, c.metrics()) for c in clients),
+        }
+
+    def stop(self):
+        """Close the socket, the client connections and the upstream
+        subscriptions.
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        with self._lock:
+            clients = list(self._clients)
+        for connection in clients:
+            connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self._saved_authkey and os.path.exists(authkey_path(self.path)):
+            os.remove(authkey_path(self.path))
+
+
+class GatewayClient(object):
+    """Client of a StreamGateway: Subscriptions subscribed here receive the
+    updates of the shared upstream subscriptions, decoded, converted and
+    delivered to their listeners as with an LSClient. Without authkey, the
+    one saved by the gateway next to its socket is read.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, authkey=None):
+        self.path = path
+        self.authkey = authkey
+        self._sock = None
+        self._thread = None
+        self._send_lock = threading.Lock()
+        self._subscriptions = {}
+        self._current_id = 0
+
+    def connect(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        if self.authkey is None:
+            self.authkey = read_authkey(self.path)
+        self._send({"op": "auth", "key": self.authkey.hex()})
+        self._thread = threading.Thread(name="STREAM-GATEWAY-CLIENT", target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def subscribe(self, subscription):
+        """Subscribe a Subscription through the gateway and return its id"""
+        self._current_id += 1
+        subscription_id = self._current_id
+        self._subscriptions[subscription_id] = subscription
+        self._send({
+            "op": "subscribe",
+            "id": subscription_id,
+            "mode": subscription.mode,
+            "items": subscription.item_names,
+            "fields": subscription.field_names,
+            "adapter": subscription.adapter,
+            "max_frequency": subscription.max_frequency,
+            "buffer_size": subscription.buffer_size,
+            "snapshot": subscription.snapshot,
+        })
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        self._send({"op": "unsubscribe", "id": subscription_id})
+
+    def _receive(self):
+        try:
+            for line in self._sock.makefile("rb"):
+                message = json.loads(line.decode("utf-8"))
+                op = message.get("op")
+                if op == "update":
+                    subscription = self._subscriptions.get(message["id"])
+                    if subscription is not None:
+                        subscription.notifyupdate(message["line"])
+                elif op == "unsubscribed":
+                    subscription = self._subscriptions.pop(message["id"], None)
+                    if subscription is not None:
+                        subscription.close()
+                elif op == "error":
+                    logger.error("Gateway error on %s: %s" % (message.get("id"), message.get("message")))
+                else:
+                    logger.debug("Gateway %s %s" % (op, message.get("id")))
+        except (OSError, ValueError):
+            pass
+        logger.info("Disconnected from the stream gateway")
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        for subscription in self._subscriptions.values():
+            subscription.close()
+        self._subscriptions.clear()
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from IGServices.candles import CandleAggregator, resolution_seconds
+from IGServices.utils import conv_resol
+
+
+@pytest.mark.parametrize("resolution, expected", [
+    ("1s", "SECOND"),
+    ("5min", "MINUTE_5"),
+    ("5Min", "MINUTE_5"),
+    ("15T", "MINUTE_15"),
+    ("1h", "HOUR"),
+    ("1H", "HOUR"),
+    ("4H", "HOUR_4"),
+    ("D", "DAY"),
+    ("W", "WEEK"),
+    ("ME", "MONTH"),
+    ("M", "MONTH"),
+    ("MINUTE_30", "MINUTE_30"),
+    (pd.offsets.Hour(2), "HOUR_2"),
+    (pd.offsets.MonthEnd(), "MONTH"),
+])
+def test_conv_resol(resolution, expected):
+    assert conv_resol(resolution) == expected
+
+
+def test_conv_resol_returns_unknown_frequencies():
+    assert conv_resol("7min") == "7min"
+
+
+def test_resolution_seconds():
+    assert resolution_seconds("1H") == ("HOUR", 3600)
+    assert resolution_seconds("5min") == ("MINUTE_5", 300)
+    assert resolution_seconds("DAY") == ("DAY", 86400)
+    with pytest.raises(ValueError):
+        resolution_seconds("7min")
+
+
+def update(changed, bid="1.1", offer="1.2", utm="1700000000000"):
+    return {"name": "L1:CS.D.EURUSD.CFD.IP", "changed": changed,
+            "values": {"BID": bid, "OFFER": offer, "UTM": utm, "MARKET_STATE": "TRADEABLE"}}
+
+
+def test_only_price_updates_are_ticks():
+    aggregator = CandleAggregator(["MINUTE"])
+    aggregator(update(["BID", "OFFER", "UTM", "MARKET_STATE"]))
+    # MERGE repeats the unchanged prices
+    aggregator(update(["UTM"], utm="1700000001000"))
+    aggregator(update(["MARKET_STATE"]))
+    aggregator(update(["OFFER", "UTM"], offer="1.3", utm="1700000002000"))
+    bar = aggregator.current("CS.D.EURUSD.CFD.IP", "MINUTE")
+    assert aggregator.tick_count == bar.ticks == 2
+    assert bar.ask_high == 1.3
+
+
+def test_chart_tick_offer_field():
+    aggregator = CandleAggregator(["SECOND"])
+    aggregator({"name": "CHART:CS.D.EURUSD.CFD.IP:TICK", "changed": ["OFR"],
+                "values": {"BID": "1.1", "OFR": "1.2", "UTM": "1700000000000"}})
+    assert aggregator.tick_count == 1
@@ -0,0 +1,54 @@
+import pandas as pd
+
+from IGServices.utils import conv_date_columns, conv_datetimes, DATE_FORMATS, UTC_DATE_FORMATS
+
+
+def test_conv_datetimes_tries_each_format():
+    values = pd.Series(["2024/01/02 10:00:00", "2024:01:02-11:30:00", "not a date", None])
+    dates = conv_datetimes(values, (DATE_FORMATS[2], DATE_FORMATS[1]))
+    assert str(dates.dtype) == "datetime64[ns]"
+    assert list(dates[:2]) == [pd.Timestamp("2024-01-02 10:00"), pd.Timestamp("2024-01-02 11:30")]
+    assert dates[2:].isna().all()
+
+
+def test_conv_datetimes_logs_the_values_not_parsed(caplog):
+    conv_datetimes(pd.Series(["2024/01/02 10:00:00", None]), DATE_FORMATS[2])
+    assert not caplog.records
+    conv_datetimes(pd.Series(["2024/01/02 10:00:00", "02-01-2024", None]), DATE_FORMATS[2])
+    assert len(caplog.records) == 1
+    assert "1 values" in caplog.text and "02-01-2024" in caplog.text
+
+
+def test_conv_datetimes_utc():
+    values = pd.Series(["2024-01-02T10:00:00", "2024-01-02T10:00:00.250"])
+    dates = conv_datetimes(values, UTC_DATE_FORMATS, utc=True)
+    assert str(dates.dtype) == "datetime64[ns, UTC]"
+    assert dates[1] == pd.Timestamp("2024-01-02 10:00:00.250", tz="UTC")
+
+
+def test_conv_datetimes_single_format():
+    dates = conv_datetimes(pd.Series(["02/01/24"]), "%d/%m/%y")
+    assert dates[0] == pd.Timestamp("2024-01-02")
+
+
+def test_conv_date_columns():
+    df = pd.DataFrame({
+        "snapshotTime": ["2024/01/02 10:00:00", "2024:01:02-11:00:00"],
+        "snapshotTimeUTC": ["2024-01-02T10:00:00", "bad"],
+        "date": ["02/01/24", "2024-01-02T10:00:00"],
+        "epic": ["CS.D.EURUSD.CFD.IP", "CS.D.GBPUSD.CFD.IP"],
+    })
+    assert conv_date_columns(df) is df
+    assert str(df["snapshotTime"].dtype) == "datetime64[ns]"
+    assert df["snapshotTime"].notna().all()
+    assert str(df["snapshotTimeUTC"].dtype) == "datetime64[ns, UTC]"
+    assert df["snapshotTimeUTC"].isna().tolist() == [False, True]
+    assert df["date"].tolist() == [pd.Timestamp("2024-01-02"), pd.Timestamp("2024-01-02 10:00")]
+    assert not pd.api.types.is_datetime64_any_dtype(df["epic"])
+
+
+def test_conv_date_columns_keeps_converted_columns():
+    dates = pd.Series(pd.to_datetime(["2024-01-02 10:00"])).dt.as_unit("s")
+    df = conv_date_columns(pd.DataFrame({"snapshotTime": dates}))
+    assert str(df["snapshotTime"].dtype) == "datetime64[s]"
+    assert conv_date_columns(pd.DataFrame()).empty
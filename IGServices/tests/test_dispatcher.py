@@ -0,0 +1,200 @@
+import threading
+
+from IGServices.dispatcher import (
+    Dispatcher, Conflator, merge_item_info,
+    POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_CONFLATE,
+)
+from IGServices.lightstreamer import Subscription, MODE_MERGE
+
+
+def item(pos, bid, changed=("BID",)):
+    return {"pos": pos, "name": "L1:E%d" % pos, "values": {"BID": bid}, "changed": list(changed),
+            "received": 0.0}
+
+
+class Gate(object):
+    """Listener recording the updates, held until opened"""
+
+    def __init__(self):
+        self.opened = threading.Event()
+        self.entered = threading.Event()
+        self.updates = []
+
+    def __call__(self, item_info):
+        self.entered.set()
+        self.opened.wait(5)
+        self.updates.append((item_info["name"], item_info["values"]["BID"]))
+
+
+def subscription(listener, items=10):
+    sub = Subscription(MODE_MERGE, ["L1:E%d" % i for i in range(1, items + 1)], ["BID"])
+    sub.addlistener(listener)
+    return sub
+
+
+def put_in_thread(dispatcher, sub, item_info):
+    thread = threading.Thread(target=dispatcher.put, args=(sub, item_info))
+    thread.daemon = True
+    thread.start()
+    thread.join(0.5)
+    return thread
+
+
+def test_drop_oldest_discards_the_oldest_updates():
+    gate = Gate()
+    sub = subscription(gate)
+    dispatcher = Dispatcher(maxsize=2, policy=POLICY_DROP_OLDEST)
+    dispatcher.start()
+    dispatcher.put(sub, item(1, 0))
+    assert gate.entered.wait(5)
+    for bid in range(1, 5):
+        dispatcher.put(sub, item(1, bid))
+    gate.opened.set()
+    assert dispatcher.join(5)
+    dispatcher.stop()
+    assert gate.updates == [("L1:E1", 0), ("L1:E1", 3), ("L1:E1", 4)]
+    assert dispatcher.metrics()["dropped"] == 2
+
+
+def test_block_waits_for_a_free_slot():
+    gate = Gate()
+    sub = subscription(gate)
+    dispatcher = Dispatcher(maxsize=1, policy=POLICY_BLOCK)
+    dispatcher.start()
+    dispatcher.put(sub, item(1, 0))
+    assert gate.entered.wait(5)
+    dispatcher.put(sub, item(1, 1))
+    blocked = put_in_thread(dispatcher, sub, item(1, 2))
+    assert blocked.is_alive()
+    gate.opened.set()
+    blocked.join(5)
+    assert dispatcher.join(5)
+    dispatcher.stop()
+    assert [bid for _, bid in gate.updates] == [0, 1, 2]
+    assert dispatcher.metrics()["dropped"] == 0
+
+
+def test_conflate_never_blocks_and_merges_per_item():
+    gate = Gate()
+    sub = subscription(gate)
+    dispatcher = Dispatcher(maxsize=4, policy=POLICY_CONFLATE, workers=2)
+    dispatcher.start()
+    for pos in range(1, 11):
+        dispatcher.put(sub, item(pos, 0))
+    # Every shard holds more distinct items than its maxsize // workers
+    late = put_in_thread(dispatcher, sub, item(3, 1, changed=("OFFER",)))
+    assert not late.is_alive()
+    gate.opened.set()
+    assert dispatcher.join(5)
+    dispatcher.stop()
+    assert set(name for name, _ in gate.updates) == set("L1:E%d" % pos for pos in range(1, 11))
+    assert ("L1:E3", 1) in gate.updates
+    assert dispatcher.metrics()["dropped"] == 0
+
+
+def test_conflated_update_keeps_all_changed_fields():
+    merged = merge_item_info(item(1, 0, changed=("BID",)), item(1, 1, changed=("OFFER", "BID")))
+    assert merged["values"]["BID"] == 1
+    assert merged["changed"] == ["BID", "OFFER"]
+
+
+def test_shards_keep_the_order_of_each_item():
+    received = []
+    lock = threading.Lock()
+
+    def listener(item_info):
+        with lock:
+            received.append((item_info["pos"], item_info["values"]["BID"]))
+    sub = subscription(listener, items=4)
+    dispatcher = Dispatcher(maxsize=100, workers=3)
+    dispatcher.start()
+    for bid in range(50):
+        for pos in range(1, 5):
+            dispatcher.put(sub, item(pos, bid))
+    assert dispatcher.join(5)
+    dispatcher.stop()
+    for pos in range(1, 5):
+        assert [bid for p, bid in received if p == pos] == list(range(50))
+
+
+def test_conflator_delivers_the_latest_values():
+    gate = Gate()
+    sub = subscription(gate)
+    conflator = Conflator(sub, interval=0)
+    conflator.put(item(1, 0))
+    assert gate.entered.wait(5)
+    for bid in range(1, 5):
+        conflator.put(item(1, bid))
+    gate.opened.set()
+    conflator.stop(drain=True, timeout=5)
+    assert gate.updates == [("L1:E1", 0), ("L1:E1", 4)]
+    assert conflator.metrics()["conflated"] == 3
+
+
+class CountingListener(object):
+    """Picklable listener appending its running count to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def __call__(self, item_info):
+        self.count += 1
+        with open(self.path, "a") as f:
+            f.write("%s %d %s\n" % (item_info["name"], self.count, item_info["values"]["BID"]))
+
+
+def test_process_executor_keeps_listener_state(tmp_path):
+    from IGServices.metrics import StreamMetrics
+    from IGServices.dispatcher import EXECUTOR_PROCESS
+    path = str(tmp_path / "updates.txt")
+    sub = subscription(CountingListener(path), items=2)
+    sub._metrics = StreamMetrics()
+    dispatcher = Dispatcher(maxsize=100, workers=2, executor=EXECUTOR_PROCESS)
+    dispatcher.start()
+    for bid in range(20):
+        dispatcher.put(sub, item(1, bid))
+    assert dispatcher.join(30)
+    dispatcher.stop()
+    with open(path) as f:
+        lines = [line.split() for line in f]
+    # One listener instance, installed once, saw every update in order
+    assert [int(count) for _, count, _ in lines] == list(range(1, 21))
+    assert [int(bid) for _, _, bid in lines] == list(range(20))
+    assert sub._metrics.dispatch_latency.count == 20
+    assert dispatcher.metrics()["dispatched"] == 20
+
+
+def test_updates_put_once_stopped_are_dropped():
+    for policy in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_CONFLATE):
+        gate = Gate()
+        gate.opened.set()
+        sub = subscription(gate)
+        dispatcher = Dispatcher(maxsize=2, policy=policy)
+        dispatcher.start()
+        dispatcher.stop()
+        for bid in range(3):
+            dispatcher.put(sub, item(1, bid))
+        assert dispatcher.metrics()["depth"] == 0
+        assert dispatcher.metrics()["dropped"] == 3
+        assert gate.updates == []
+
+
+def test_stop_releases_a_blocked_put_as_dropped():
+    gate = Gate()
+    sub = subscription(gate)
+    dispatcher = Dispatcher(maxsize=1, policy=POLICY_BLOCK)
+    dispatcher.start()
+    dispatcher.put(sub, item(1, 0))
+    assert gate.entered.wait(5)
+    dispatcher.put(sub, item(1, 1))
+    blocked = put_in_thread(dispatcher, sub, item(1, 2))
+    assert blocked.is_alive()
+    stopper = threading.Thread(target=dispatcher.stop, kwargs={"drain": False})
+    stopper.start()
+    blocked.join(5)
+    gate.opened.set()
+    stopper.join(5)
+    assert not blocked.is_alive()
+    assert gate.updates == [("L1:E1", 0)]
+    assert dispatcher.metrics()["dropped"] == 2
@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from IGServices.fields import compile_schema, to_float, to_int, to_millis, to_bool, to_json
+from IGServices.lightstreamer import Subscription, MODE_MERGE
+
+
+def test_chart_schema_converters():
+    fields = ["BID", "OFR", "UTM", "CONS_END", "CONS_TICK_COUNT", "UNKNOWN"]
+    assert compile_schema(fields, "chart") == [to_float, to_float, to_millis, to_bool, to_int, None]
+
+
+def test_unknown_fields_and_strings_are_passed_through():
+    assert compile_schema(["MARKET_STATE", "NOT_IN_SCHEMA"], "L1") == [None, None]
+    assert compile_schema(["BID", "OFFER"], None) == [None, None]
+
+
+def test_custom_schema():
+    upper = str.upper
+    assert compile_schema(["A", "B", "C"], {"A": "int", "B": upper}) == [to_int, upper, None]
+    with pytest.raises(ValueError):
+        compile_schema(["A"], {"A": "decimal"})
+    with pytest.raises(ValueError):
+        compile_schema(["A"], "PRICES")
+
+
+def test_converters():
+    assert to_int("12") == 12
+    assert to_int("12.0") == 12
+    assert to_millis("1700000000000") == datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+    assert (to_bool("1"), to_bool("true"), to_bool("0")) == (True, True, False)
+    assert to_json('{"dealId": "D1"}') == {"dealId": "D1"}
+
+
+def test_subscription_converts_the_chart_prices_once():
+    sub = Subscription(MODE_MERGE, ["CHART:CS.D.EURUSD.CFD.IP:TICK"], ["BID", "OFR", "UTM", "OTHER"],
+                       schema="CHART")
+    received = []
+    sub.addlistener(lambda item: received.append(item["values"]))
+    sub.notifyupdate("1|1.1|1.2|1700000000000|x")
+    # Unchanged fields keep their converted value, null ones are None
+    sub.notifyupdate("1|1.15|#||")
+    sub.notifyupdate("1|bad|||")
+    assert received[0] == {"BID": 1.1, "OFR": 1.2, "UTM": to_millis("1700000000000"), "OTHER": "x"}
+    assert received[1] == {"BID": 1.15, "OFR": None, "UTM": to_millis("1700000000000"), "OTHER": "x"}
+    # A value which cannot be converted is kept as a string
+    assert received[2]["BID"] == "bad"
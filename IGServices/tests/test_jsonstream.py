@@ -0,0 +1,133 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+
+from IGServices.jsonstream import ColumnBuilder, JSONStreamParser, parse_columns
+from IGServices.rest import IGService
+
+PRICES = {
+    "prices": [
+        {"snapshotTime": "2024/01/02 10:00:00", "openPrice": {"bid": 1.1, "ask": 1.2, "lastTraded": None},
+         "lastTradedVolume": 12345678901234},
+        {"snapshotTime": "2024/01/02 11:00:00", "openPrice": {"bid": -2.5e-3, "ask": 1e3, "lastTraded": None},
+         "lastTradedVolume": 7},
+    ],
+    "instrumentType": "CURRENCIES",
+    "allowance": {"remainingAllowance": 9998, "totalAllowance": 10000, "allowanceExpiry": 600},
+    "note": "café € [\"quoted\"], {}",
+}
+
+
+def split(data, sizes):
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(data[start:start + size])
+        start += size
+    return chunks
+
+
+def parse(chunks):
+    parser = JSONStreamParser(chunks, ["prices"])
+    elements = [element for _, element in parser]
+    return elements, parser.fields
+
+
+def test_any_chunk_boundaries():
+    data = json.dumps(PRICES, ensure_ascii=False).encode("utf-8")
+    expected = PRICES["prices"], dict((k, v) for k, v in PRICES.items() if k != "prices")
+    # Every single split, multi-byte characters included, then random ones
+    for i in range(len(data) + 1):
+        assert parse([data[:i], data[i:]]) == expected
+    rng = random.Random(0)
+    for _ in range(200):
+        sizes = [rng.randint(1, 16) for _ in range(len(data))]
+        assert parse(split(data, sizes)) == expected
+        assert parse(split(data.decode("utf-8"), sizes)) == expected
+
+
+def test_number_split_across_chunks():
+    elements, fields = parse(['{"prices": [12', '34, 5', '.5e', '1], "n": 6', '7}'])
+    assert elements == [1234, 55.0]
+    assert fields == {"n": 67}
+
+
+def test_empty_arrays_and_objects():
+    assert parse(["{}"]) == ([], {})
+    assert parse(['{"prices": [], "metadata": {}}']) == ([], {"metadata": {}})
+
+
+def test_invalid_json():
+    with pytest.raises(ValueError):
+        parse(['{"prices": [1, 2'])
+
+
+def test_column_builder_missing_keys():
+    builder = ColumnBuilder()
+    for element in ({"a": 1}, {"b": 2}, {"a": 3, "c": 4}):
+        builder.append(element)
+    assert len(builder) == 3
+    frame = builder.frame()
+    expected = pd.DataFrame([{"a": 1}, {"b": 2}, {"a": 3, "c": 4}])
+    assert list(frame.columns) == list(expected.columns)
+    assert frame.isna().equals(expected.isna())
+
+
+def test_column_builder_flatten():
+    builder = ColumnBuilder(flatten=True)
+    for element in PRICES["prices"]:
+        builder.append(element)
+    frame = builder.frame()
+    assert list(frame["openPrice.bid"]) == [1.1, -2.5e-3]
+
+
+class StreamResponse(object):
+    def __init__(self, data, chunk_size=7):
+        self.text = json.dumps(data)
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        data = self.text.encode("utf-8")
+        return (data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size))
+
+
+def make_service(data):
+    service = IGService("username", "password", "api_key", "demo")
+    service.LOGGED_IN_HEADERS = dict(service.BASIC_HEADERS)
+    service._request = lambda method, path, **kwargs: StreamResponse(data)
+    return service
+
+
+@pytest.mark.parametrize("flatten", [False, True])
+def test_stream_and_text_prices_have_the_same_layout(flatten):
+    service = make_service(PRICES)
+    frames = [
+        service.fetch_historical_prices_by_epic_and_date_range(
+            "CS.D.EURUSD.CFD.IP", "HOUR", "2024:01:02-00:00:00", "2024:01:03-00:00:00",
+            stream=stream, flatten=flatten)["prices"]
+        for stream in (False, True)
+    ]
+    assert sorted(frames[0].columns) == sorted(frames[1].columns)
+    pd.testing.assert_frame_equal(frames[0], frames[1][frames[0].columns], check_dtype=False)
+    assert service.allowance.remaining == 9998
+
+
+def test_stream_error_code():
+    service = make_service({"errorCode": "error.security.invalid-details"})
+    with pytest.raises(Exception, match="invalid-details"):
+        service.fetch_historical_prices_by_epic_and_date_range(
+            "CS.D.EURUSD.CFD.IP", "HOUR", "2024:01:02-00:00:00", "2024:01:03-00:00:00", stream=True)
+
+
+def test_parse_columns():
+    builders = {"prices": ColumnBuilder()}
+    fields = parse_columns([json.dumps(PRICES)], builders)
+    assert fields["instrumentType"] == "CURRENCIES"
+    assert list(builders["prices"].frame()["lastTradedVolume"]) == [12345678901234, 7]
@@ -0,0 +1,438 @@
+import http.server
+import io
+import queue
+import threading
+import time
+
+import pytest
+
+from IGServices.dispatcher import Dispatcher
+from IGServices.lightstreamer import (
+    LSClient, Subscription, MODE_COMMAND, MODE_DISTINCT, MODE_MERGE, CONTROL_URL_PATH, OK_CMD
+)
+
+
+def make_client(responses):
+    """LSClient with an open session whose control requests are recorded
+    and answered with the given bodies, in turn
+    """
+    client = LSClient("http://localhost:8080", "DEMO")
+    client._session["SessionId"] = "S1"
+    client._control_url = client._base_url
+    calls = []
+
+    def call(base_url, url, body):
+        calls.append((url, body))
+        return io.BytesIO(responses.pop(0))
+    client._call = call
+    return client, calls
+
+
+def subscription(*items):
+    return Subscription(MODE_MERGE, list(items), ["BID", "OFFER"])
+
+
+def test_subscribe_many_sends_one_control_request():
+    client, calls = make_client([b"OK\r\nOK\r\nOK\r\n"])
+    keys = client.subscribe_many([subscription("L1:A"), subscription("L1:B"), subscription("L1:C")])
+    assert keys == [1, 2, 3]
+    assert len(calls) == 1
+    url, body = calls[0]
+    assert url == CONTROL_URL_PATH
+    lines = body.split(b"\r\n")
+    assert len(lines) == 3
+    for key, line in zip(keys, lines):
+        assert b"LS_Table=%d" % key in line
+        assert b"LS_op=add" in line
+        assert b"LS_session=S1" in line
+
+
+def test_control_many_parses_errors_in_order():
+    client, _ = make_client([b"OK\r\nERROR\r\n19\r\nSpecified table can't be removed\r\nOK\r\n"])
+    responses = client._control_many([{"LS_op": "add"}] * 3)
+    assert responses == [OK_CMD, "ERROR 19 Specified table can't be removed", OK_CMD]
+
+
+def test_unsubscribe_many_keeps_failed_tables():
+    client, calls = make_client([b"OK\r\nOK\r\n", b"OK\r\nERROR\r\n17\r\nbad\r\n"])
+    keys = client.subscribe_many([subscription("L1:A"), subscription("L1:B")])
+    client.unsubscribe_many(keys + [99])
+    assert len(calls) == 2
+    assert calls[1][1].count(b"LS_op=delete") == 2
+    assert list(client._subscriptions) == [keys[1]]
+
+
+def test_subscribe_many_empty_sends_nothing():
+    client, calls = make_client([])
+    assert client.subscribe_many([]) == []
+    assert calls == []
+
+
+class FakeStream(object):
+    """Stream Connection returning the given lines, then blocking until
+    closed when hold is set (an empty read otherwise)
+    """
+
+    def __init__(self, lines, hold=False):
+        self.lines = list(lines)
+        self.hold = hold
+        self.closed = threading.Event()
+
+    def readline(self):
+        if self.lines:
+            return self.lines.pop(0)
+        if self.hold:
+            self.closed.wait(5)
+            if self.lines:
+                return self.lines.pop(0)
+        return b""
+
+    def readlines(self):
+        lines, self.lines = self.lines, []
+        return lines
+
+    def close(self):
+        self.closed.set()
+
+
+def session_lines(session_id, *updates):
+    return [b"OK\r\n", b"SessionId:%s\r\n" % session_id, b"\r\n"] + list(updates)
+
+
+def make_streaming_client(streams, **kwargs):
+    """LSClient getting its Stream Connections from streams, in turn, and
+    answering OK to every control request
+    """
+    client = LSClient("http://localhost:8080", "DEMO", reconnect_delay=0.001, **kwargs)
+    controls = []
+
+    def call(base_url, url, body):
+        if url == CONTROL_URL_PATH:
+            if not isinstance(body, bytes):
+                body = client._encode_params(body)
+            controls.append(body)
+            return io.BytesIO(b"OK\r\n" * (body.count(b"\r\n") + 1))
+        return streams.pop(0)
+    client._call = call
+    return client, controls
+
+
+def test_recovers_and_resubscribes_with_the_same_keys():
+    statuses = []
+    recovered = threading.Event()
+    second = FakeStream(session_lines(b"S2", b"1,1|2|3\r\n"), hold=True)
+    client, controls = make_streaming_client([
+        FakeStream(session_lines(b"S1", b"1,1|1|2\r\n", b"SYNC ERROR\r\n")),
+        second,
+    ])
+    client.addconnectionlistener(statuses.append)
+    client.addconnectionlistener(lambda status: status == "RECOVERED" and recovered.set())
+    updates = []
+    sub = subscription("L1:A")
+    sub.addlistener(lambda item: updates.append(dict(item["values"])))
+
+    client.connect()
+    key = client.subscribe(sub)
+    assert recovered.wait(5)
+    client.disconnect()
+
+    assert key == 1
+    assert client.recovery_counter == 1
+    # The replayed table keeps its key, on the new session
+    assert b"LS_Table=1" in controls[-1] and b"LS_session=S2" in controls[-1]
+    assert statuses[:3] == ["CONNECTED", "RECOVERING", "RECOVERED"]
+    assert statuses[-1] == "DISCONNECTED"
+    assert second.closed.is_set()
+
+
+def test_end_after_destroy_does_not_reconnect():
+    stream = FakeStream(session_lines(b"S1"), hold=True)
+    client, controls = make_streaming_client([stream])
+    statuses = []
+    client.addconnectionlistener(statuses.append)
+    client.connect()
+
+    def control(params):
+        # The server closes the session right after answering
+        stream.lines.append(b"END 31 destroyed\r\n")
+        stream.close()
+        # Let the stream thread read the END before destroy goes on
+        time.sleep(0.2)
+        return OK_CMD
+    client._control = control
+    client.destroy()
+
+    assert client._stream_connection_thread is None
+    assert client.recovery_counter == 0
+    assert "RECOVERING" not in statuses
+    assert statuses[-1] == "DISCONNECTED"
+
+
+def test_disconnect_unblocks_a_pending_read():
+    stream = FakeStream(session_lines(b"S1"), hold=True)
+    client, _ = make_streaming_client([stream])
+    client.connect()
+    thread = client._stream_connection_thread
+    started = time.monotonic()
+    client.disconnect()
+    assert time.monotonic() - started < 1.0
+    assert stream.closed.is_set()
+    assert not thread.is_alive()
+
+
+def test_snapshot_parameters_by_mode():
+    import pytest
+    from IGServices.lightstreamer import MODE_RAW, MODE_DISTINCT, MODE_COMMAND
+    client = LSClient("http://localhost:8080", "DEMO")
+
+    raw = client._subscription_params(1, Subscription(MODE_RAW, ["TRADE:X"], ["OPU"]))
+    assert "LS_snapshot" not in raw
+    merge = client._subscription_params(1, subscription("L1:A"))
+    assert merge["LS_snapshot"] == "true"
+    no_snapshot = Subscription(MODE_MERGE, ["L1:A"], ["BID"], snapshot=False)
+    assert client._subscription_params(1, no_snapshot)["LS_snapshot"] == "false"
+    distinct = Subscription(MODE_DISTINCT, ["CHART:X:TICK"], ["BID"], snapshot_length=20)
+    assert client._subscription_params(1, distinct)["LS_snapshot"] == "20"
+
+    with pytest.raises(ValueError):
+        Subscription(MODE_RAW, ["TRADE:X"], ["OPU"], snapshot=True)
+    with pytest.raises(ValueError):
+        Subscription(MODE_RAW, ["TRADE:X"], ["OPU"], snapshot_length=5)
+    with pytest.raises(ValueError):
+        Subscription(MODE_MERGE, ["L1:A"], ["BID"], snapshot_length=5)
+    with pytest.raises(ValueError):
+        Subscription(MODE_COMMAND, ["X"], ["key", "command"], snapshot_length=5)
+    with pytest.raises(ValueError):
+        Subscription(MODE_DISTINCT, ["X"], ["BID"], snapshot=False, snapshot_length=5)
+
+
+class LiveStream(object):
+    """Stream Connection returning the lines fed to it, until closed"""
+
+    def __init__(self, lines):
+        self.lines = queue.Queue()
+        for line in lines:
+            self.lines.put(line)
+
+    def feed(self, line):
+        self.lines.put(line)
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=5)
+        except queue.Empty:
+            return b""
+
+    def close(self):
+        self.lines.put(b"")
+
+
+def test_disconnect_leaves_a_shared_dispatcher_running():
+    dispatcher = Dispatcher()
+    first_stream, second_stream = LiveStream(session_lines(b"S1")), LiveStream(session_lines(b"S2"))
+    first, _ = make_streaming_client([first_stream], dispatcher=dispatcher)
+    second, _ = make_streaming_client([second_stream], dispatcher=dispatcher)
+    received = threading.Event()
+    sub = subscription("L1:A")
+    sub.addlistener(lambda item: received.set())
+    first.connect()
+    second.connect()
+    second.subscribe(sub)
+    first.disconnect()
+
+    second_stream.feed(b"1,1|1|2\r\n")
+    assert received.wait(5)
+    second.disconnect()
+    dispatcher.stop()
+    assert dispatcher.metrics()["dropped"] == 0
+
+
+def test_command_mode_keeps_a_table_of_rows_by_key():
+    sub = Subscription(MODE_COMMAND, ["TRADE:A", "TRADE:B"], ["key", "command", "V", "W"])
+    received = []
+    sub.addlistener(received.append)
+    sub.notifyupdate("1|k1|ADD|10|a")
+    sub.notifyupdate("1|k2|ADD|20|b")
+    # The unchanged fields come from the row of the same key
+    sub.notifyupdate("1|k1|UPDATE|11|")
+    assert sub.getcommandtable("TRADE:A") == {
+        "k1": {"key": "k1", "command": "UPDATE", "V": "11", "W": "a"},
+        "k2": {"key": "k2", "command": "ADD", "V": "20", "W": "b"},
+    }
+    assert sub.getcommandvalue(1, "k1", "W") == "a"
+    assert (received[-1]["key"], received[-1]["command"], received[-1]["changed"]) == (
+        "k1", "UPDATE", ["key", "command", "V"])
+    sub.notifyupdate("1|k2|DELETE||")
+    assert list(sub.getcommandtable(1)) == ["k1"]
+    assert sub.getcommandvalue("TRADE:A", "k2") is None
+    assert sub.getcommandvalue("TRADE:A", "k2", "V") is None
+    # Each item has its own table
+    sub.notifyupdate("2|k1|ADD|30|c")
+    assert sub.getcommandvalue("TRADE:B", "k1") == {"key": "k1", "command": "ADD", "V": "30", "W": "c"}
+    assert sub.getcommandvalue("TRADE:A", "k1", "V") == "11"
+    # A copy: changing it leaves the table alone
+    sub.getcommandtable(1).clear()
+    assert len(sub.getcommandtable(1)) == 1
+
+
+def test_command_mode_requires_the_key_and_command_fields():
+    with pytest.raises(ValueError):
+        Subscription(MODE_COMMAND, ["TRADE:A"], ["key", "V"])
+
+
+def test_distinct_mode_keeps_the_last_events():
+    sub = Subscription(MODE_DISTINCT, ["TRADE:A", "TRADE:B"], ["E", "F"], distinct_length=3)
+    for i in range(5):
+        sub.notifyupdate("1|e%d|f" % i)
+    sub.notifyupdate("2|x|")
+    # The oldest events are evicted, the unchanged fields repeated
+    assert sub.getevents("TRADE:A") == [{"E": "e2", "F": "f"}, {"E": "e3", "F": "f"}, {"E": "e4", "F": "f"}]
+    assert sub.getevents(2) == [{"E": "x", "F": None}]
+    assert [values for _, values in sub.getstate()] == sub.getevents(1) + sub.getevents(2)
+
+
+def test_recovery_rebuilds_command_tables_and_distinct_events():
+    recovered = threading.Event()
+    first = LiveStream(session_lines(b"S1"))
+    # k2 was deleted during the outage
+    second = LiveStream(session_lines(b"S2", b"1,1|k1|ADD|11\r\n", b"2,1|e1\r\n", b"2,1|e2\r\n"))
+    client, _ = make_streaming_client([first, second])
+    client.addconnectionlistener(lambda status: status == "RECOVERED" and recovered.set())
+    table = Subscription(MODE_COMMAND, ["TRADE:A"], ["key", "command", "V"])
+    events = Subscription(MODE_DISTINCT, ["TRADE:B"], ["E"])
+    received = []
+    events.addlistener(lambda item: received.append(item["values"]["E"]))
+    client.connect()
+    client.subscribe_many([table, events])
+    for line in (b"1,1|k1|ADD|10\r\n", b"1,1|k2|ADD|20\r\n", b"2,1|e1\r\n", b"2,1|e2\r\n"):
+        first.feed(line)
+    first.feed(b"SYNC ERROR\r\n")
+    assert recovered.wait(5)
+    deadline = time.monotonic() + 5
+    while len(received) < 4:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    client.disconnect()
+
+    assert table.getcommandtable(1) == {"k1": {"key": "k1", "command": "ADD", "V": "11"}}
+    assert events.getevents(1) == [{"E": "e1"}, {"E": "e2"}]
+
+
+class StallingServer(object):
+    """Local Lightstreamer Server whose sessions send a PROBE and then
+    nothing, until released
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.sessions = []
+        self.controls = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(200)
+                self.end_headers()
+                if self.path.endswith(CONTROL_URL_PATH):
+                    server.controls.append(body)
+                    self.wfile.write(b"OK\r\n" * (body.count(b"\r\n") + 1))
+                    return
+                server.sessions.append(body)
+                session_id = b"S%d" % len(server.sessions)
+                self.wfile.write(b"OK\r\nSessionId:%s\r\n\r\nPROBE\r\n" % session_id)
+                self.wfile.flush()
+                server.release.wait(10)
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_watchdog_aborts_a_stalled_stream_and_recovers():
+    server = StallingServer()
+    client = LSClient(server.url, "DEMO", reconnect_delay=0.01, stall_timeout=0.3)
+    statuses = []
+    recovered = threading.Event()
+    client.addconnectionlistener(statuses.append)
+    client.addconnectionlistener(lambda status: status == "RECOVERED" and recovered.set())
+    try:
+        client.connect()
+        key = client.subscribe(subscription("L1:A"))
+        assert recovered.wait(5)
+        started = time.monotonic()
+        client.disconnect()
+        # The read blocked on the live stream is aborted too
+        assert time.monotonic() - started < 2
+    finally:
+        server.close()
+    assert client.metrics.stalls >= 1
+    assert statuses[:3] == ["CONNECTED", "RECOVERING", "RECOVERED"]
+    # The Subscription is replayed with its key on the new session
+    replay = [body for body in server.controls if b"LS_session=S2" in body]
+    assert b"LS_Table=%d" % key in replay[0] and b"LS_op=add" in replay[0]
+
+
+def test_reconnect_backoff_is_jittered_and_capped():
+    client = LSClient("http://localhost:8080", "DEMO", reconnect_delay=1.0, max_reconnect_delay=8.0)
+    for attempt, delay in ((0, 1.0), (2, 4.0), (3, 8.0), (10, 8.0)):
+        for _ in range(20):
+            assert delay / 2.0 <= client._reconnect_backoff(attempt) <= delay
+
+
+def failing_recovery_client(**kwargs):
+    """Streaming client whose session breaks, every new one failing"""
+    first = LiveStream(session_lines(b"S1"))
+    client, _ = make_streaming_client([first], **kwargs)
+    creates = []
+    call = client._call
+
+    def failing_call(base_url, url, body):
+        if url == CONTROL_URL_PATH or client.metrics.sessions == 0:
+            return call(base_url, url, body)
+        creates.append(time.monotonic())
+        raise IOError("Connection refused")
+    client._call = failing_call
+    return client, first, creates
+
+
+def test_recovery_gives_up_after_max_attempts():
+    client, first, creates = failing_recovery_client(max_reconnect_attempts=3)
+    statuses = []
+    client.addconnectionlistener(statuses.append)
+    client.connect()
+    first.feed(b"SYNC ERROR\r\n")
+    deadline = time.monotonic() + 5
+    while "DISCONNECTED" not in statuses:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert len(creates) == 3
+    assert "RECOVERED" not in statuses
+    assert client.recovery_counter == 0
+
+
+def test_no_recovery_after_disconnect():
+    client, first, creates = failing_recovery_client()
+    client.reconnect_delay = client.max_reconnect_delay = 0.05
+    client.connect()
+    first.feed(b"SYNC ERROR\r\n")
+    deadline = time.monotonic() + 5
+    while len(creates) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    client.disconnect()
+    attempts = len(creates)
+    time.sleep(0.3)
+    assert len(creates) == attempts
+    assert client._stream_connection_thread is None
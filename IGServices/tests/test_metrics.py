@@ -0,0 +1,70 @@
+import pytest
+
+from IGServices import metrics
+from IGServices.metrics import Meter, Histogram
+
+
+class Clock(object):
+    """Monotonic clock moved by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(metrics, "time", clock)
+    return clock
+
+
+def test_meter_rate_over_the_completed_seconds(clock):
+    meter = Meter(window=10)
+    assert meter.rate() == 0.0
+    for second in range(5):
+        meter.mark(10 * (second + 1))
+        clock.now += 1
+    # The current second is not counted until it is over
+    meter.mark(1000)
+    assert meter.rate() == pytest.approx((10 + 20 + 30 + 40 + 50) / 5.0)
+    assert meter.snapshot()["count"] == 1150
+
+
+def test_meter_forgets_the_seconds_out_of_the_window(clock):
+    meter = Meter(window=10)
+    meter.mark(90)
+    clock.now += 9
+    assert meter.rate() == pytest.approx(10)
+    clock.now += 1
+    assert meter.rate() == 0.0
+    # A bucket reused for a new second starts again from zero
+    meter.mark(5)
+    clock.now += 1
+    assert meter.rate() == pytest.approx(5 / 9.0)
+    assert meter.count == 95
+
+
+def test_histogram_percentiles_within_the_bucket_precision():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.update(value / 1000.0)
+    for q in (0.5, 0.9, 0.99):
+        assert histogram.percentile(q) == pytest.approx(q, rel=0.125)
+    snapshot = histogram.snapshot()
+    assert (snapshot["count"], snapshot["min"], snapshot["max"]) == (1000, 0.001, 1.0)
+    assert snapshot["mean"] == pytest.approx(0.5005)
+    assert histogram.percentile(1.0) <= 1.0
+
+
+def test_histogram_zero_and_negative_values():
+    histogram = Histogram()
+    assert histogram.percentile(0.5) is None
+    assert histogram.snapshot()["mean"] is None
+    for value in (-1.0, 0.0, 0.0, 5.0):
+        histogram.update(value)
+    assert histogram.min == 0.0
+    assert histogram.percentile(0.5) == 0.0
+    assert histogram.percentile(0.99) == 5.0
@@ -0,0 +1,78 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from IGServices.planner import (
+    Allowance, DownloadPlanner, TRADING_WEEK, estimate_points, parse_allowance
+)
+
+HOUR = timedelta(hours=1)
+
+
+class FakeService(object):
+    """Returns one price per estimated point and spends the allowance"""
+
+    def __init__(self, remaining, total=10000):
+        self.allowance = Allowance(remaining, total, time.time() + 3600, time.time())
+        self.requests = []
+
+    def fetch_historical_prices_by_epic_and_date_range(self, epic, resolution, start, end):
+        self.requests.append((epic, resolution, start, end))
+        # Hourly bars, both ends included
+        points = estimate_points(resolution, datetime.strptime(start, "%Y:%m:%d-%H:%M:%S"),
+                                 datetime.strptime(end, "%Y:%m:%d-%H:%M:%S") + HOUR)
+        self.allowance = self.allowance._replace(remaining=self.allowance.remaining - points)
+        return {"prices": [{}] * points}
+
+
+def test_parse_allowance():
+    block = {"remainingAllowance": 9000, "totalAllowance": 10000, "allowanceExpiry": 600}
+    assert parse_allowance({"allowance": block}, updated=100) == Allowance(9000, 10000, 700, 100)
+    assert parse_allowance({"metadata": {"allowance": block}}, updated=100).remaining == 9000
+    assert parse_allowance({"prices": []}) is None
+
+
+def test_estimate_points():
+    assert estimate_points("HOUR", "2024-01-01", "2024-01-08") == round(168 * TRADING_WEEK)
+    assert estimate_points("1h", "2024/01/01 00:00:00", "2024/01/01 10:00:00") == 8
+    assert estimate_points("WEEK", "2024-01-01", "2024-03-25") == 12
+    assert estimate_points("DAY", "2024-01-02", "2024-01-01") == 0
+
+
+def test_plan_splits_the_jobs_across_the_allowance_windows():
+    service = FakeService(remaining=500, total=1000)
+    planner = DownloadPlanner(service, [("CS.D.EURUSD.CFD.IP", "HOUR", "2024-01-01", "2024-03-01")],
+                              max_points=700)
+    chunks = planner.chunks()
+    # Inclusive ranges, neither overlapping nor leaving a gap
+    assert chunks[0].start == datetime(2024, 1, 1)
+    assert [c.start for c in chunks[1:]] == [c.end + HOUR for c in chunks[:-1]]
+    assert chunks[-1].end == datetime(2024, 3, 1)
+    assert [c.end - c.start for c in chunks[:-1]] == [699 * HOUR] * 2
+    assert [c.points for c in chunks] == [500, 500, 30]
+    windows = planner.plan()
+    assert [window for _, window in windows] == [chunks[:1], chunks[1:]]
+    assert windows[1][0] == datetime.fromtimestamp(service.allowance.expiry)
+
+
+def test_run_stops_on_the_allowance_and_resumes(tmp_path):
+    path = str(tmp_path / "progress.json")
+    job = ("CS.D.EURUSD.CFD.IP", "HOUR", "2024-01-01", "2024-02-01")
+    fresh = DownloadPlanner(None, [job], max_points=100)
+    service = FakeService(remaining=300)
+    planner = DownloadPlanner(service, [job], path=path, max_points=100)
+    assert not planner.run()
+    done = len(service.requests)
+    assert done and json.load(open(path))["points_downloaded"] == planner.points_downloaded
+
+    # A new planner skips the downloaded requests
+    service.allowance = service.allowance._replace(remaining=10000)
+    resumed = DownloadPlanner(service, [job], path=path, max_points=100)
+    assert len(resumed.chunks()) == len(fresh.chunks()) - done
+    assert resumed.run()
+    assert resumed.chunks() == []
+    assert resumed.points_downloaded == fresh.cost()
+    # Across the stop, each bar is requested once
+    ranges = [(datetime.strptime(r[2], "%Y:%m:%d-%H:%M:%S"), datetime.strptime(r[3], "%Y:%m:%d-%H:%M:%S"))
+              for r in service.requests]
+    assert [start for start, _ in ranges[1:]] == [end + HOUR for _, end in ranges[:-1]]
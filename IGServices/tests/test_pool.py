@@ -0,0 +1,127 @@
+import time
+
+from IGServices.lightstreamer import Subscription, MODE_MERGE, STATUS_DISCONNECTED, STATUS_RECOVERED
+from IGServices.pool import StreamPool, split_subscription
+
+
+class FakeMetrics(object):
+    def snapshot(self):
+        return {}
+
+
+class FakeClient(object):
+    """LSClient recording its subscriptions"""
+
+    def __init__(self, dispatcher=None, log=None):
+        self.dispatcher = dispatcher
+        self.log = log if log is not None else []
+        self.listeners = []
+        self.subscriptions = {}
+        self.metrics = FakeMetrics()
+        self._current_key = 0
+
+    def addconnectionlistener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, status):
+        for listener in self.listeners:
+            listener(status)
+
+    def connect(self):
+        pass
+
+    def subscribe_many(self, subscriptions):
+        keys = []
+        for subscription in subscriptions:
+            self._current_key += 1
+            self.subscriptions[self._current_key] = subscription
+            keys.append(self._current_key)
+        return keys
+
+    def unsubscribe_many(self, keys):
+        for key in keys:
+            del self.subscriptions[key]
+
+    def disconnect(self, drain=True, timeout=None):
+        self.log.append(("disconnect", self, drain))
+
+
+class FakeDispatcher(object):
+    def __init__(self, log):
+        self.log = log
+
+    def stop(self, drain=True, timeout=None):
+        self.log.append(("stop", self, drain))
+
+
+def items(*names):
+    return Subscription(MODE_MERGE, list(names), ["BID"])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def make_pool(connections=2, max_items=2, **kwargs):
+    clients = []
+
+    def factory():
+        clients.append(FakeClient(**kwargs))
+        return clients[-1]
+    pool = StreamPool(factory, connections=connections, max_items=max_items)
+    pool.connect()
+    return pool, clients
+
+
+def test_split_subscription_forwards_with_the_parent_positions():
+    parent = items("L1:A", "L1:B", "L1:C", "L1:D", "L1:E")
+    updates = []
+    parent.addlistener(lambda item: updates.append((item["pos"], item["name"], item["values"]["BID"])))
+    chunks = split_subscription(parent, 2)
+    assert [chunk.item_names for chunk in chunks] == [["L1:A", "L1:B"], ["L1:C", "L1:D"], ["L1:E"]]
+    chunks[1].notifyupdate("2|1.5")
+    chunks[2].notifyupdate("1|2.5")
+    assert updates == [(4, "L1:D", "1.5"), (5, "L1:E", "2.5")]
+    assert split_subscription(parent, 5) == [parent]
+
+
+def test_chunks_are_spread_over_the_sessions():
+    pool, clients = make_pool()
+    key = pool.subscribe(items("L1:A", "L1:B", "L1:C", "L1:D"))
+    assert [len(client.subscriptions) for client in clients] == [1, 1]
+    assert len(pool.chunks(key)) == 2
+    pool.unsubscribe(key)
+    assert [len(client.subscriptions) for client in clients] == [0, 0]
+
+
+def test_lost_session_chunks_move_to_the_live_ones():
+    pool, clients = make_pool()
+    pool.subscribe_many([items("L1:A"), items("L1:B"), items("L1:C")])
+    clients[0].notify(STATUS_DISCONNECTED)
+    wait_for(lambda: pool.rebalance_counter == 1)
+    assert len(clients[1].subscriptions) == 3
+    assert pool.stats()["live"] == 1
+
+
+def test_recovered_session_rebalances_the_busiest():
+    pool, clients = make_pool()
+    keys = pool.subscribe_many([items("L1:A", "L1:B") for _ in range(4)])
+    # The remaining chunks are all on the first session
+    pool.unsubscribe_many(keys[1::2])
+    assert [len(client.subscriptions) for client in clients] == [2, 0]
+    clients[1].notify(STATUS_RECOVERED)
+    wait_for(lambda: pool.rebalance_counter == 1)
+    assert [len(client.subscriptions) for client in clients] == [1, 1]
+
+
+def test_disconnect_stops_the_shared_dispatcher_once_every_session_is_closed():
+    log = []
+    dispatcher = FakeDispatcher(log)
+    pool, clients = make_pool(connections=3, dispatcher=dispatcher, log=log)
+    pool.subscribe(items("L1:A"))
+    pool.disconnect(drain=True)
+    assert log == [("disconnect", client, False) for client in clients] + [("stop", dispatcher, True)]
+    assert all(not client.subscriptions for client in clients)
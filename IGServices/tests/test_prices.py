@@ -0,0 +1,79 @@
+import json
+
+import pandas as pd
+
+from IGServices.rest import IGService
+
+
+class Response(object):
+    def __init__(self, data):
+        self.text = json.dumps(data)
+
+
+def price(hour, bid, last=None):
+    prices = {"bid": bid, "ask": bid + 0.0002, "lastTraded": last}
+    return {
+        "snapshotTime": "2024/01/02 %02d:00:00" % hour,
+        "snapshotTimeUTC": "2024-01-02T%02d:00:00" % hour,
+        "openPrice": dict(prices), "highPrice": dict(prices),
+        "lowPrice": dict(prices), "closePrice": dict(prices),
+        "lastTradedVolume": 100 + hour,
+    }
+
+
+def make_service(pages):
+    """Serves the pages in turn, with their metadata"""
+    service = IGService("username", "password", "api_key", "demo")
+    service.LOGGED_IN_HEADERS = dict(service.BASIC_HEADERS)
+    service.requests = []
+
+    def request(method, path, params=None, **kwargs):
+        service.requests.append((path, dict(params)))
+        number = params["pageNumber"]
+        return Response({
+            "prices": pages[number - 1],
+            "metadata": {"pageData": {"pageSize": params["pageSize"], "pageNumber": number,
+                                      "totalPages": len(pages)}},
+            "allowance": {"remainingAllowance": 9000 - number, "totalAllowance": 10000,
+                          "allowanceExpiry": 600},
+        })
+    service._request = request
+    return service
+
+
+def test_prices_pages_stop_at_the_last_page():
+    pages = [[price(0, 1.1), price(1, 1.2)], [price(2, 1.3), price(3, 1.4)], [price(4, 1.5)]]
+    service = make_service(pages)
+    data = list(service.fetch_historical_prices_pages(
+        "CS.D.EURUSD.CFD.IP", "1h", start_date="2024-01-02", end_date="2024-01-03", page_size=2))
+    assert [params["pageNumber"] for _, params in service.requests] == [1, 2, 3]
+    path, params = service.requests[0]
+    assert path == "/prices/CS.D.EURUSD.CFD.IP"
+    assert params["resolution"] == "HOUR"
+    assert (params["from"], params["to"], params["pageSize"]) == ("2024-01-02T00:00:00", "2024-01-03T00:00:00", 2)
+    assert [len(page["prices"]) for page in data] == [2, 2, 1]
+    for page in data:
+        assert isinstance(page["prices"], pd.DataFrame)
+        assert page["prices"].index.name == "DateTime"
+    assert list(data[1]["prices"][("bid", "Close")]) == [1.3, 1.4]
+    assert list(data[2]["prices"]["Volume"]) == [104]
+    assert service.allowance.remaining == 8997
+
+
+def test_prices_pages_are_requested_as_they_are_consumed():
+    service = make_service([[price(0, 1.1)], [price(1, 1.2)]])
+    pages = service.fetch_historical_prices_pages("CS.D.EURUSD.CFD.IP", "HOUR", numpoints=2, page_size=1)
+    next(pages)
+    assert len(service.requests) == 1
+    assert service.requests[0][1]["max"] == 2
+
+
+def test_prices_pages_have_the_same_format_as_num_points():
+    service = make_service([[price(0, 1.1), price(1, 1.2)]])
+    page = next(service.fetch_historical_prices_pages("CS.D.EURUSD.CFD.IP", "HOUR", numpoints=2))
+    data = service.fetch_historical_prices_by_epic_and_num_points("CS.D.EURUSD.CFD.IP", "HOUR", 2)
+    pd.testing.assert_frame_equal(page["prices"], data["prices"])
+    # No lastTraded prices on a CFD: missing values are NaN, not None
+    last = page["prices"]["last"]
+    assert last.isna().all().all()
+    assert not (last.map(lambda value: value is None)).any().any()
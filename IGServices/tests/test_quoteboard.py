@@ -0,0 +1,143 @@
+import math
+import multiprocessing
+import threading
+import uuid
+
+import pytest
+
+from IGServices import quoteboard
+from IGServices.quoteboard import QuoteBoardPublisher, QuoteBoardReader
+
+
+@pytest.fixture
+def publisher():
+    publisher = QuoteBoardPublisher("ig_test_%s" % uuid.uuid4().hex[:12], capacity=4)
+    yield publisher
+    publisher.close()
+
+
+def read_quotes(name, epics, results):
+    reader = QuoteBoardReader(name)
+    try:
+        results.put(dict((epic, reader.get(epic)) for epic in epics))
+    finally:
+        reader.close()
+
+
+def read_in_process(name, epics):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=read_quotes, args=(name, epics, results))
+    process.start()
+    quotes = results.get(timeout=30)
+    process.join(30)
+    assert process.exitcode == 0
+    return quotes
+
+
+def test_quotes_are_read_from_another_process(publisher):
+    publisher.publish("CS.D.EURUSD.CFD.IP", 1700000000.0, bid=1.1, offer=1.2)
+    publisher({"name": "CHART:CS.D.GBPUSD.CFD.IP:TICK",
+               "values": {"BID": "1.3", "OFR": "1.4", "UTM": "1700000001000", "DAY_HIGH": ""}})
+    quotes = read_in_process(publisher.name, ["CS.D.EURUSD.CFD.IP", "CS.D.GBPUSD.CFD.IP", "CS.D.UNKNOWN.CFD.IP"])
+    eurusd = quotes["CS.D.EURUSD.CFD.IP"]
+    assert (eurusd["epic"], eurusd["bid"], eurusd["offer"], eurusd["timestamp"]) == (
+        "CS.D.EURUSD.CFD.IP", 1.1, 1.2, 1700000000.0)
+    # Never published
+    assert math.isnan(eurusd["high"])
+    gbpusd = quotes["CS.D.GBPUSD.CFD.IP"]
+    assert (gbpusd["bid"], gbpusd["offer"], gbpusd["timestamp"]) == (1.3, 1.4, 1700000001.0)
+    assert math.isnan(gbpusd["high"])
+    assert quotes["CS.D.UNKNOWN.CFD.IP"] is None
+
+
+def test_publish_keeps_the_fields_not_given(publisher):
+    publisher.publish("CS.D.EURUSD.CFD.IP", 1.0, bid=1.1, offer=1.2, high=1.5)
+    publisher.publish("CS.D.EURUSD.CFD.IP", 2.0, bid=1.15)
+    quote = read_in_process(publisher.name, ["CS.D.EURUSD.CFD.IP"])["CS.D.EURUSD.CFD.IP"]
+    assert (quote["bid"], quote["offer"], quote["high"], quote["timestamp"]) == (1.15, 1.2, 1.5, 2.0)
+    assert publisher._rows["seq"][0] == 4
+
+
+def test_epics_over_capacity_are_dropped(publisher):
+    for i in range(6):
+        publisher.publish("CS.D.E%d.CFD.IP" % i, bid=float(i))
+    assert publisher.update_count == 4
+    assert publisher.dropped_count == 2
+    quotes = read_in_process(publisher.name, ["CS.D.E3.CFD.IP", "CS.D.E4.CFD.IP"])
+    assert quotes["CS.D.E3.CFD.IP"]["bid"] == 3.0
+    assert quotes["CS.D.E4.CFD.IP"] is None
+
+
+class SameProcessReader(QuoteBoardReader):
+    """Reader sharing the publisher block, left to the publisher to remove"""
+
+    def __init__(self, publisher):
+        self.name = publisher.name
+        self._shm = publisher._shm
+        self.capacity = publisher.capacity
+        self._rows = publisher._rows
+        self._index = {}
+
+    def close(self):
+        self._rows = None
+
+
+def test_unknown_epic_is_found_once_published(publisher):
+    reader = SameProcessReader(publisher)
+    assert reader.get("CS.D.EURUSD.CFD.IP") is None
+    assert reader.epics() == []
+    publisher.publish("CS.D.EURUSD.CFD.IP", bid=1.1)
+    assert reader.get("CS.D.EURUSD.CFD.IP")["bid"] == 1.1
+    assert reader.epics() == ["CS.D.EURUSD.CFD.IP"]
+    assert len(reader) == 1
+
+
+def test_reader_retries_a_row_being_written(publisher):
+    publisher.publish("CS.D.EURUSD.CFD.IP", bid=1.1)
+    reader = SameProcessReader(publisher)
+    rows = publisher._rows
+    # The publisher is in the middle of a write
+    rows["seq"][0] += 1
+    rows["bid"][0] = 1.2
+    quotes = []
+    thread = threading.Thread(target=lambda: quotes.append(reader.get("CS.D.EURUSD.CFD.IP")))
+    thread.daemon = True
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    rows["offer"][0] = 1.3
+    rows["seq"][0] += 1
+    thread.join(5)
+    assert (quotes[0]["bid"], quotes[0]["offer"]) == (1.2, 1.3)
+
+
+def test_snapshot_reads_again_a_row_being_written(publisher, monkeypatch):
+    publisher.publish("CS.D.EURUSD.CFD.IP", bid=1.1)
+    publisher.publish("CS.D.GBPUSD.CFD.IP", bid=1.3)
+    reader = SameProcessReader(publisher)
+    rows = publisher._rows
+    rows["seq"][1] += 1
+    read_rows = []
+
+    def read_row(row):
+        # The write completes while the reader waits for it
+        read_rows.append(row)
+        rows["bid"][row] = 1.35
+        rows["seq"][row] += 1
+        return QuoteBoardReader._read_row(reader, row)
+    monkeypatch.setattr(reader, "_read_row", read_row)
+    frame = reader.snapshot()
+    assert read_rows == [1]
+    assert list(frame.index) == ["CS.D.EURUSD.CFD.IP", "CS.D.GBPUSD.CFD.IP"]
+    assert list(frame["bid"]) == [1.1, 1.35]
+
+
+def test_reader_gives_up_on_a_row_left_odd(publisher, monkeypatch):
+    monkeypatch.setattr(quoteboard, "READ_TIMEOUT", 0.05)
+    publisher.publish("CS.D.EURUSD.CFD.IP", bid=1.1)
+    publisher._rows["seq"][0] += 1
+    reader = SameProcessReader(publisher)
+    with pytest.raises(IOError):
+        reader.get("CS.D.EURUSD.CFD.IP")
+
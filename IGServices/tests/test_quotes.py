@@ -0,0 +1,45 @@
+import json
+
+from IGServices.quotes import QuoteCache
+from IGServices.rest import IGService
+
+
+class Response(object):
+    def __init__(self, data):
+        self.text = json.dumps(data)
+
+
+def market(epic, bid, offer):
+    return {"instrument": {"epic": epic}, "snapshot": {"bid": bid, "offer": offer}}
+
+
+def make_service(markets):
+    service = IGService("username", "password", "api_key", "demo")
+    service.LOGGED_IN_HEADERS = dict(service.BASIC_HEADERS)
+    service.requests = []
+
+    def request(method, path, **kwargs):
+        service.requests.append(path)
+        return Response({"marketDetails": markets})
+    service._request = request
+    return service
+
+
+def test_fetch_quote():
+    service = make_service([market("CS.D.EURUSD.CFD.IP", 1.1, 1.2)])
+    quote = service.fetch_quote("CS.D.EURUSD.CFD.IP")
+    assert (quote.epic, quote.bid, quote.offer) == ("CS.D.EURUSD.CFD.IP", 1.1, 1.2)
+
+
+def test_fetch_quote_of_an_unknown_epic_returns_none():
+    service = make_service([])
+    assert service.fetch_quote("CS.D.UNKNOWN.CFD.IP") is None
+
+
+def test_fetch_quotes_reads_the_cache_first():
+    service = make_service([market("CS.D.GBPUSD.CFD.IP", 1.3, 1.4)])
+    service.quote_cache = QuoteCache()
+    service.fetch_quotes(["CS.D.GBPUSD.CFD.IP"])
+    quotes = service.fetch_quotes(["CS.D.GBPUSD.CFD.IP", "CS.D.UNKNOWN.CFD.IP"])
+    assert list(quotes) == ["CS.D.GBPUSD.CFD.IP"]
+    assert service.requests == ["/markets?epics=CS.D.GBPUSD.CFD.IP", "/markets?epics=CS.D.UNKNOWN.CFD.IP"]
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from IGServices import ratelimit, rest
+from IGServices.ratelimit import (
+    TokenBucket, PriorityScheduler, request_priority,
+    PRIORITY_DEALING, PRIORITY_ACCOUNT, PRIORITY_REFERENCE, PRIORITY_HISTORY,
+)
+from IGServices.rest import IGService
+
+
+class Clock(object):
+    """Monotonic clock moved by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+def test_bucket_bursts_to_capacity_then_refills_at_rate(clock):
+    bucket = TokenBucket(2, capacity=4)
+    assert [bucket.try_acquire() for _ in range(5)] == [True] * 4 + [False]
+    clock.now += 0.5
+    assert bucket.available() == pytest.approx(1)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    clock.now += 60
+    assert bucket.available() == 4
+
+
+def test_per_minute_bucket(clock):
+    bucket = TokenBucket.per_minute(30)
+    assert bucket.rate == 0.5
+    assert bucket.capacity == 30
+
+
+def test_acquire_times_out_on_an_empty_bucket():
+    bucket = TokenBucket(0.01, capacity=1)
+    assert bucket.acquire()
+    assert not bucket.acquire(timeout=0.05)
+
+
+def test_history_keeps_the_reserve_for_urgent_requests(clock):
+    scheduler = PriorityScheduler(1, capacity=10)
+    granted = 0
+    while scheduler.try_acquire(priority=PRIORITY_HISTORY):
+        granted += 1
+    # Half the capacity is reserved for the more urgent priorities
+    assert granted == 5
+    assert [scheduler.try_acquire(priority=PRIORITY_REFERENCE) for _ in range(3)] == [True, True, False]
+    assert [scheduler.try_acquire(priority=PRIORITY_ACCOUNT) for _ in range(3)] == [True, True, False]
+    assert [scheduler.try_acquire(priority=PRIORITY_DEALING) for _ in range(2)] == [True, False]
+    assert scheduler.metrics()["granted"] == [1, 2, 2, 5]
+
+
+def test_waiting_dealing_request_holds_the_others(clock):
+    scheduler = PriorityScheduler(1, capacity=10)
+    scheduler._waiting[PRIORITY_DEALING] = 1
+    assert not scheduler.try_acquire(priority=PRIORITY_HISTORY)
+    assert not scheduler.try_acquire(priority=PRIORITY_ACCOUNT)
+    assert scheduler.try_acquire(priority=PRIORITY_DEALING)
+
+
+def test_dealing_request_is_served_before_an_earlier_history_request():
+    scheduler = PriorityScheduler(4, capacity=1, reserves=(0.0, 0.0, 0.0, 0.0))
+    assert scheduler.try_acquire(priority=PRIORITY_HISTORY)
+    served = []
+
+    def request(priority):
+        scheduler.acquire(priority=priority, timeout=5)
+        served.append(priority)
+
+    threads = []
+    for priority in (PRIORITY_HISTORY, PRIORITY_DEALING):
+        thread = threading.Thread(target=request, args=(priority,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        while not scheduler.metrics()["waiting"][priority] and thread.is_alive():
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    assert served == [PRIORITY_DEALING, PRIORITY_HISTORY]
+    assert scheduler.metrics()["deferred"][PRIORITY_HISTORY] == 1
+
+
+@pytest.mark.parametrize("method, path, priority", [
+    ("post", "/positions/otc", PRIORITY_DEALING),
+    ("PUT", "/positions/otc/DIAAAA", PRIORITY_DEALING),
+    ("DELETE", "/positions/otc", PRIORITY_DEALING),
+    ("post", "/workingorders/otc", PRIORITY_DEALING),
+    ("get", "/confirms/REF", PRIORITY_DEALING),
+    ("get", "/positions", PRIORITY_ACCOUNT),
+    ("get", "/workingorders", PRIORITY_ACCOUNT),
+    ("get", "/accounts", PRIORITY_ACCOUNT),
+    ("get", "/history/activity", PRIORITY_ACCOUNT),
+    ("post", "/session", PRIORITY_ACCOUNT),
+    ("get", "/markets/CS.D.EURUSD.CFD.IP", PRIORITY_REFERENCE),
+    ("get", "/watchlists", PRIORITY_REFERENCE),
+    ("get", "/prices/CS.D.EURUSD.CFD.IP", PRIORITY_HISTORY),
+    ("get", "prices/CS.D.EURUSD.CFD.IP/HOUR/10", PRIORITY_HISTORY),
+])
+def test_request_priority(method, path, priority):
+    assert request_priority(method, path) == priority
+
+
+class RecordingScheduler(object):
+
+    def __init__(self):
+        self.priorities = []
+
+    def acquire(self, tokens=1, timeout=None, priority=PRIORITY_HISTORY):
+        self.priorities.append(priority)
+        return True
+
+
+def test_delete_via_post_is_scheduled_as_dealing(monkeypatch):
+    scheduler = RecordingScheduler()
+    service = IGService("username", "password", "api_key", "demo", scheduler=scheduler)
+    service._set_headers({"CST": "cst", "X-SECURITY-TOKEN": "token"}, True)
+    monkeypatch.setattr(rest.requests, "post", lambda url, **kwargs: None)
+    monkeypatch.setattr(rest.requests, "get", lambda url, **kwargs: None)
+    service._request("get", "/positions", headers=service.LOGGED_IN_HEADERS)
+    service._request("post", "/positions/otc", data="{}", headers=service.DELETE_HEADERS)
+    service._request("post", "/watchlists", data="{}", headers=service.LOGGED_IN_HEADERS)
+    service._request("post", "/watchlists/W1", data="{}", headers=service.DELETE_HEADERS)
+    assert scheduler.priorities == [PRIORITY_ACCOUNT, PRIORITY_DEALING, PRIORITY_REFERENCE, PRIORITY_REFERENCE]
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+from IGServices.recorder import StreamRecorder, iter_records, segment_paths
+
+
+def wait_for_next_segment(recorder, timeout=5):
+    deadline = time.monotonic() + timeout
+    while recorder._next is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_rotation_keeps_every_record_in_order(tmp_path):
+    recorder = StreamRecorder(str(tmp_path), segment_size=4096)
+    lines = [b"1,1|%d|%d\r\n" % (i, i + 1) for i in range(2000)]
+    for i, line in enumerate(lines):
+        recorder.record(line, received=i)
+    recorder.close()
+    assert [(received, bytes(line)) for received, line in iter_records(str(tmp_path))] == list(
+        enumerate(lines))
+    assert len(segment_paths(str(tmp_path))) == recorder.segment_count > 1
+
+
+def test_segments_are_created_and_closed_off_the_stream_thread(tmp_path):
+    recorder = StreamRecorder(str(tmp_path), segment_size=4096)
+    creators = []
+    new_segment = recorder._new_segment
+
+    def tracked(*args):
+        creators.append(threading.current_thread().name)
+        return new_segment(*args)
+    recorder._new_segment = tracked
+    line = b"1,1|1.2345|1.2346\r\n"
+    for _ in range(5):
+        # Fill the current segment, once the next one is ready
+        recorder.record(line)
+        wait_for_next_segment(recorder)
+        count = recorder.segment_count
+        while recorder.segment_count == count:
+            recorder.record(line)
+    recorder.close()
+    # Only the first segment is created on the calling thread
+    assert creators[0] == threading.current_thread().name
+    assert set(creators[1:]) == {"RECORDER-THREAD"}
+    assert sum(1 for _ in iter_records(str(tmp_path))) == recorder.record_count
+
+
+def test_close_removes_the_unused_next_segment(tmp_path):
+    recorder = StreamRecorder(str(tmp_path), segment_size=4096)
+    recorder.record(b"1,1|1|2\r\n")
+    wait_for_next_segment(recorder)
+    recorder.close()
+    assert len(os.listdir(str(tmp_path))) == 1
+    # A new recorder goes on after the last segment
+    assert StreamRecorder(str(tmp_path))._index == 2
+
+
+def test_line_larger_than_a_segment(tmp_path):
+    recorder = StreamRecorder(str(tmp_path), segment_size=1024)
+    big = b"x" * 5000
+    recorder.record(b"small\r\n", received=1)
+    recorder.record(big, received=2)
+    recorder.record(b"after\r\n", received=3)
+    recorder.close()
+    assert [bytes(line) for _, line in iter_records(str(tmp_path))] == [b"small\r\n", big, b"after\r\n"]
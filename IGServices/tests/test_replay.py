@@ -0,0 +1,52 @@
+import time
+
+from IGServices.lightstreamer import Subscription, MODE_MERGE, MODE_DISTINCT
+from IGServices.recorder import StreamRecorder
+from IGServices.replay import StreamReplay
+
+
+def record_segment(directory, lines, interval=10 ** 9):
+    """Records the lines one interval (nanoseconds) apart"""
+    recorder = StreamRecorder(directory, segment_size=4096)
+    for i, line in enumerate(lines):
+        recorder.record(line, received=i * interval)
+    recorder.close()
+
+
+def test_replay_a_recorded_segment_with_the_schema(tmp_path):
+    record_segment(str(tmp_path), [
+        b"PROBE\r\n",
+        b"1,1|1.1|1.2|1700000000000\r\n",
+        b"2,1|{\"dealId\": \"D1\"}\r\n",
+        b"1,1|1.15||1700000001000\r\n",
+        b"LOOP\r\n",
+    ])
+    chart = Subscription(MODE_MERGE, ["CHART:CS.D.EURUSD.CFD.IP:TICK"], ["BID", "OFR", "UTM"], schema="CHART")
+    trade = Subscription(MODE_DISTINCT, ["TRADE:ABC123"], ["CONFIRMS"], schema="TRADE")
+    prices, confirms = [], []
+    chart.addlistener(lambda item: prices.append(item["values"]))
+    trade.addlistener(lambda item: confirms.append(item["values"]["CONFIRMS"]))
+    # Recorded one second apart, replayed without waiting
+    replay = StreamReplay(str(tmp_path), speed=0)
+    assert [replay.subscribe(chart), replay.subscribe(trade)] == [1, 2]
+    stats = replay.run()
+
+    assert [(values["BID"], values["OFR"], values["UTM"].timestamp()) for values in prices] == [
+        (1.1, 1.2, 1700000000.0), (1.15, 1.2, 1700000001.0)]
+    assert confirms == [{"dealId": "D1"}]
+    assert (stats["records"], stats["updates"]) == (5, 3)
+    assert stats["elapsed"] < 1
+    assert stats["max_delay"] == 0.0
+
+
+def test_replay_scales_the_recorded_timing():
+    sub = Subscription(MODE_MERGE, ["L1:A"], ["BID"])
+    received = []
+    sub.addlistener(lambda item: received.append(time.perf_counter()))
+    # 0.2 seconds apart, replayed 4 times faster
+    records = [(i * 2 * 10 ** 8, b"1,1|%d\r\n" % i) for i in range(3)]
+    replay = StreamReplay(records, speed=4)
+    replay.subscribe(sub)
+    replay.run()
+    assert len(received) == 3
+    assert received[2] - received[0] >= 0.09
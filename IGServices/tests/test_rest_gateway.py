@@ -0,0 +1,60 @@
+import os
+import stat
+import threading
+
+import pytest
+
+from IGServices.rest import IGService, IGException
+from IGServices.rest_gateway import RestGateway, IGServiceClient, authkey_path
+
+
+def make_service():
+    service = IGService("username", "password", "api_key", "demo")
+    service.session = {"currentAccountId": "ABC123"}
+    return service
+
+
+def test_getattr_is_limited_to_the_session_state():
+    gateway = RestGateway(make_service())
+    assert gateway.call("getattr", "session") == {"currentAccountId": "ABC123"}
+    for name in ("IG_PASSWORD", "API_KEY", "BASIC_HEADERS", "_retryer"):
+        with pytest.raises(AttributeError):
+            gateway.call("getattr", name)
+
+
+def test_generator_methods_are_rejected():
+    gateway = RestGateway(make_service())
+    with pytest.raises(IGException):
+        gateway.call("fetch_historical_prices_pages", "CS.D.EURUSD.CFD.IP", "HOUR")
+
+
+def test_unpicklable_results_are_not_cached():
+    service = make_service()
+    service.fetch_accounts = lambda: threading.Lock()
+    service.fetch_account_activity = lambda: {"activities": []}
+    gateway = RestGateway(service)
+    for _ in range(2):
+        gateway.call("fetch_accounts")
+        gateway.call("fetch_account_activity")
+    assert gateway.metrics()["calls"] == 3
+    assert gateway.metrics()["cache_hits"] == 1
+
+
+def test_generated_authkey_and_socket_are_private(tmp_path):
+    address = str(tmp_path / "rest.sock")
+    gateway = RestGateway(make_service(), address=address)
+    gateway.start()
+    try:
+        for path in (address, authkey_path(address)):
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        client = IGServiceClient(address)
+        assert client.session == {"currentAccountId": "ABC123"}
+        client.logout()
+    finally:
+        gateway.stop()
+    assert not os.path.exists(authkey_path(address))
+
+
+def test_tcp_address_requires_an_authkey():
+    with pytest.raises(ValueError):
+        RestGateway(make_service(), address=("localhost", 0)).start()
@@ -0,0 +1,70 @@
+import pytest
+
+from IGServices.stream import IGStreamService
+
+
+class FakeService(object):
+    """IGService with an open session, counting the logins"""
+
+    def __init__(self, session=None):
+        self.session = session
+        self.acc_id = "DEFAULT"
+        self.logins = 0
+        self.LOGGED_IN_HEADERS = {"CST": "cst", "X-SECURITY-TOKEN": "xst"}
+
+    def create_session(self):
+        self.logins += 1
+        self.session = {"lightstreamerEndpoint": "https://apd.marketdatasystems.com",
+                        "currentAccountId": "LOGGED_IN"}
+        return self.session
+
+
+def make_stream(service, fail=False):
+    stream = IGStreamService(service)
+    stream.connects = 0
+
+    def connect():
+        stream.connects += 1
+        if fail:
+            raise IOError("Connection refused")
+    stream._connect = connect
+    return stream
+
+
+def test_reused_rest_session_is_not_logged_in_again():
+    service = FakeService({"lightstreamerEndpoint": "https://apd.marketdatasystems.com",
+                           "currentAccountId": "ABC123"})
+    stream = make_stream(service)
+    stream.create_session()
+    stream.create_session()
+    assert (service.logins, stream.connects) == (0, 2)
+    assert stream.acc_number == "ABC123"
+    assert stream._ls_password == "CST-cst|XST-xst"
+
+
+def test_logs_in_without_a_session_to_reuse():
+    service = FakeService()
+    stream = make_stream(service)
+    stream.create_session()
+    assert service.logins == 1
+    assert stream.acc_number == "LOGGED_IN"
+    stream.create_session(reuse_session=False)
+    assert service.logins == 2
+
+
+def test_given_account_is_kept():
+    service = FakeService({"lightstreamerEndpoint": "https://apd.marketdatasystems.com",
+                           "currentAccountId": "ABC123"})
+    stream = make_stream(service)
+    stream.acc_number = "XYZ789"
+    stream.create_session()
+    assert stream.acc_number == "XYZ789"
+
+
+def test_connection_error_is_raised():
+    stream = make_stream(FakeService(), fail=True)
+    with pytest.raises(IOError):
+        stream.create_session()
+    future = stream.create_session(wait=False)
+    with pytest.raises(IOError):
+        future.result(5)
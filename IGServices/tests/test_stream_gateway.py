@@ -0,0 +1,209 @@
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from IGServices.dispatcher import POLICY_BLOCK
+from IGServices.stream_gateway import GatewayClient, StreamGateway, _ClientConnection, _Upstream
+from IGServices.lightstreamer import Subscription
+from IGServices.utils import authkey_path
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.subscriptions = {}
+        self.updates = []
+        self.messages = []
+
+    def put(self, client_id, subscription, item_info):
+        self.updates.append((client_id, item_info))
+
+    def replay(self, client_id, subscription, item_infos):
+        for item_info in item_infos:
+            self.put(client_id, subscription, item_info)
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+class BlockingService(object):
+    """Stream service whose subscribe waits for release"""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def subscribe(self, subscription):
+        self.entered.set()
+        assert self.release.wait(5)
+        self.subscribed.append(subscription)
+        return len(self.subscribed)
+
+    def unsubscribe(self, key):
+        self.unsubscribed.append(key)
+
+
+def request(op="subscribe", client_id=1):
+    return {"op": op, "id": client_id, "mode": "MERGE", "items": ["L1:A"], "fields": ["BID"],
+            "snapshot": "true"}
+
+
+def test_subscribe_request_is_sent_outside_of_the_lock():
+    service = BlockingService()
+    gateway = StreamGateway(service, path=None)
+    first, second = FakeConnection(), FakeConnection()
+    thread = threading.Thread(target=gateway._handle, args=(first, request()))
+    thread.start()
+    assert service.entered.wait(5)
+    # The gateway goes on while the upstream subscription is pending
+    gateway._handle(second, request())
+    assert gateway.metrics()["upstream_subscriptions"] == 1
+    service.release.set()
+    thread.join(5)
+    assert len(service.subscribed) == 1
+    assert first.messages == second.messages == [{"op": "subscribed", "id": 1}]
+    gateway._handle(first, request("unsubscribe"))
+    gateway._handle(second, request("unsubscribe"))
+    assert service.unsubscribed == [1]
+    assert gateway.metrics()["upstream_subscriptions"] == 0
+
+
+def test_failed_subscribe_releases_the_joined_clients():
+    class FailingService(BlockingService):
+        def subscribe(self, subscription):
+            BlockingService.subscribe(self, subscription)
+            raise IOError("Stream closed")
+
+    service = FailingService()
+    gateway = StreamGateway(service, path=None)
+    first, second = FakeConnection(), FakeConnection()
+    errors = []
+
+    def handle():
+        try:
+            gateway._handle(first, request())
+        except IOError as e:
+            errors.append(e)
+    thread = threading.Thread(target=handle)
+    thread.start()
+    assert service.entered.wait(5)
+    gateway._handle(second, request())
+    service.release.set()
+    thread.join(5)
+    assert len(errors) == 1
+    assert second.messages[-1]["op"] == "error"
+    assert first.subscriptions == second.subscriptions == {}
+    assert gateway.metrics()["upstream_subscriptions"] == 0
+
+
+def test_snapshot_while_the_stream_updates_the_items():
+    subscription = Subscription("COMMAND", ["TRADE:A"], ["key", "command", "V"])
+    upstream = _Upstream(None, subscription)
+    stop = threading.Event()
+
+    def stream():
+        i = 0
+        while not stop.is_set():
+            subscription.notifyupdate("1|k%d|ADD|%d" % (i % 100, i))
+            subscription.notifyupdate("1|k%d|DELETE|" % ((i + 50) % 100))
+            i += 1
+    thread = threading.Thread(target=stream)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            for info in upstream.snapshot():
+                assert info["values"]["command"] == "ADD"
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+class InstantService(BlockingService):
+    def __init__(self):
+        BlockingService.__init__(self)
+        self.release.set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_clients_authenticate_on_a_private_socket(tmp_path):
+    path = str(tmp_path / "stream.sock")
+    service = InstantService()
+    gateway = StreamGateway(service, path=path)
+    gateway.start()
+    try:
+        for name in (path, authkey_path(path)):
+            assert stat.S_IMODE(os.stat(name).st_mode) == 0o600
+        intruder = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        intruder.connect(path)
+        # Sent at once: the gateway may close the connection after the first line
+        lines = [json.dumps({"op": "auth", "key": "00" * 32}), json.dumps(request())]
+        intruder.sendall(("\n".join(lines) + "\n").encode("utf-8"))
+        # The gateway closes the connection without subscribing
+        try:
+            closed = intruder.recv(1024) == b""
+        except ConnectionResetError:
+            closed = True
+        assert closed
+        intruder.close()
+        assert service.subscribed == []
+
+        client = GatewayClient(path)
+        client.connect()
+        client.subscribe(Subscription("MERGE", ["L1:A"], ["BID"]))
+        wait_for(lambda: service.subscribed)
+        client.close()
+    finally:
+        gateway.stop()
+    assert not os.path.exists(authkey_path(path))
+
+
+def test_start_refuses_a_live_socket(tmp_path):
+    path = str(tmp_path / "stream.sock")
+    gateway = StreamGateway(InstantService(), path=path)
+    gateway.start()
+    try:
+        with pytest.raises(OSError):
+            StreamGateway(InstantService(), path=path).start()
+        assert os.path.exists(path)
+    finally:
+        gateway.stop()
+    # A socket file left by a gateway no longer running is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    gateway = StreamGateway(InstantService(), path=path)
+    gateway.start()
+    gateway.stop()
+
+
+def test_joining_a_full_blocking_client_does_not_hold_the_gateway():
+    gateway = StreamGateway(InstantService(), path=None, policy=POLICY_BLOCK)
+    gateway._handle(FakeConnection(), request())
+    upstream = list(gateway._upstreams.values())[0]
+    upstream.subscription.notifyupdate("1|1.5")
+    local, remote = socket.socketpair()
+    # Writer not started: the queue of one update stays full
+    connection = _ClientConnection(gateway, local, 2, 1, POLICY_BLOCK)
+    connection.put(9, upstream.subscription, {"pos": 1, "values": {"BID": 1.4}, "changed": ["BID"]})
+    thread = threading.Thread(target=gateway._handle, args=(connection, request()))
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    # The full update, the snapshot and the subscribed message
+    assert connection.metrics()["depth"] == 3
+    connection.close()
+    remote.close()
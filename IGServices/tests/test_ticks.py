@@ -0,0 +1,26 @@
+from IGServices.ticks import TickBuffer, TickStore
+
+
+def update(changed, bid="1.1", offer="1.2", utm="1700000000000"):
+    return {"name": "MARKET:CS.D.EURUSD.CFD.IP", "changed": changed,
+            "values": {"BID": bid, "OFFER": offer, "UTM": utm, "UPDATE_TIME": "10:00:00"}}
+
+
+def test_only_price_updates_are_stored():
+    store = TickStore(capacity=8)
+    store(update(["BID", "OFFER", "UTM", "UPDATE_TIME"]))
+    # MERGE repeats the unchanged prices
+    store(update(["UPDATE_TIME", "UTM"], utm="1700000001000"))
+    store(update(["BID", "UTM"], bid="1.15", utm="1700000002000"))
+    window = store.last("CS.D.EURUSD.CFD.IP")
+    assert list(window.bid) == [1.1, 1.15]
+    assert list(window.timestamp) == [1700000000.0, 1700000002.0]
+
+
+def test_buffer_wraps_around():
+    buffer = TickBuffer(4)
+    for i in range(10):
+        buffer.append(i, i, i + 1)
+    assert list(buffer.last().timestamp) == [6, 7, 8, 9]
+    assert list(buffer.last(2).offer) == [9, 10]
+    assert list(buffer.since(2, now=9).bid) == [7, 8, 9]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-capacity tick buffers per epic, backed by preallocated NumPy arrays.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+from IGServices.utils import is_price_update, item_epic, tick_timestamp
+
+logger = logging.getLogger(__name__)
+
+TickWindow = collections.namedtuple("TickWindow", ["timestamp", "bid", "offer", "volume"])
+
+
+class TickBuffer(object):
+    """Ring buffer of the last capacity ticks of an epic: timestamp (epoch
+    seconds), bid, offer and volume, as float64 arrays.
+
+    Each tick is written twice, at its slot and capacity slots further,
+    so that the last n ticks are always a contiguous slice: last() and
+    since() return read-only views without copying. A view is overwritten
+    by the ticks appended after it, capacity ticks later; copy it to keep
+    it longer.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._timestamp = np.full(2 * capacity, np.nan)
+        self._bid = np.full(2 * capacity, np.nan)
+        self._offer = np.full(2 * capacity, np.nan)
+        self._volume = np.full(2 * capacity, np.nan)
+        self._lock = threading.Lock()
+        # Slot following the last tick written
+        self._end = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, bid, offer, volume=np.nan):
+        with self._lock:
+            slot = self._end
+            mirror = slot + self.capacity
+            self._timestamp[slot] = self._timestamp[mirror] = timestamp
+            self._bid[slot] = self._bid[mirror] = bid
+            self._offer[slot] = self._offer[mirror] = offer
+            self._volume[slot] = self._volume[mirror] = volume
+            self._end = slot + 1 if slot + 1 < self.capacity else 0
+            self.count += 1
+
+    def _window(self, start, stop):
+        arrays = []
+        for array in (self._timestamp, self._bid, self._offer, self._volume):
+            view = array[start:stop]
+            view.flags.writeable = False
+            arrays.append(view)
+        return TickWindow(*arrays)
+
+    def last(self, n=None):
+        """Returns the views of the last n ticks (all the buffered ones
+        by default), oldest first
+        """
+        with self._lock:
+            size = len(self)
+            n = size if n is None else min(n, size)
+            stop = self._end + self.capacity
+            return self._window(stop - n, stop)
+
+    def since(self, seconds, now=None):
+        """Returns the views of the ticks of the last seconds before now
+        (the local clock by default)
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            stop = self._end + self.capacity
+            start = stop - len(self)
+            timestamps = self._timestamp[start:stop]
+            start += int(np.searchsorted(timestamps, now - seconds, side="left"))
+            return self._window(start, stop)
+
+
+class TickStore(object):
+    """Listener keeping a TickBuffer for each epic of the L1:<epic>,
+    MARKET:<epic> and CHART:<epic>:TICK items it is added to, with
+    Subscription.addlistener. The volume is the LTV field of CHART items.
+    Updates changing no price are not stored.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def buffer(self, epic):
+        """Returns the TickBuffer of an epic, created empty if needed"""
+        tick_buffer = self._buffers.get(epic)
+        if tick_buffer is None:
+            with self._lock:
+                tick_buffer = self._buffers.setdefault(epic, TickBuffer(self.capacity))
+        return tick_buffer
+
+    def epics(self):
+        return list(self._buffers)
+
+    def __call__(self, item_info):
+        if not is_price_update(item_info):
+            return
+        values = item_info["values"]
+        offer = values.get("OFFER")
+        if offer is None:
+            offer = values.get("OFR")
+        bid = values.get("BID")
+        if bid is None or offer is None:
+            return
+        volume = values.get("LTV")
+        try:
+            self.buffer(item_epic(item_info["name"])).append(
+                tick_timestamp(values), float(bid), float(offer),
+                float(volume) if volume not in (None, "") else np.nan,
+            )
+        except ValueError:
+            logger.warning("Invalid tick on %s: %s" % (item_info["name"], values))
+
+    def last(self, epic, n=None):
+        """Returns the views of the last n ticks of an epic"""
+        return self.buffer(epic).last(n)
+
+    def since(self, epic, seconds, now=None):
+        """Returns the views of the ticks of an epic in the last seconds"""
+        return self.buffer(epic).since(seconds, now)
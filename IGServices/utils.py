@@ -1,6 +1,9 @@
 import os
+import re
+import time
 import logging
 import traceback
+from datetime import datetime
 import six
 
 logger = logging.getLogger(__name__)
@@ -23,40 +26,110 @@ else:
 
 
 DATE_FORMATS = {1: "%Y:%m:%d-%H:%M:%S", 2: "%Y/%m/%d %H:%M:%S", 3: "%Y/%m/%d %H:%M:%S"}
+# Dates of the version 3 query parameters (from, to)
+ISO_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Dates of the UTC fields (snapshotTimeUTC, dateUtc...), with or without
+# milliseconds
+UTC_DATE_FORMATS = (ISO_DATE_FORMAT, ISO_DATE_FORMAT + ".%f")
+
+# Date columns of the frames -> (formats, UTC). The other dates are in the
+# time zone of the account: they are parsed without one.
+DATE_COLUMNS = {
+    "snapshotTime": ((DATE_FORMATS[2], DATE_FORMATS[1]), False),
+    "snapshotTimeUTC": (UTC_DATE_FORMATS, True),
+    # Version 1 history (dd/mm/yy) or version 3 activity
+    "date": (("%d/%m/%y",) + UTC_DATE_FORMATS, False),
+    "dateUtc": (UTC_DATE_FORMATS, True),
+    "dateUTC": (UTC_DATE_FORMATS, True),
+    "openDateUtc": (UTC_DATE_FORMATS, True),
+}
+
+
+# IG resolutions by length in seconds
+RESOLUTIONS = {
+    1: "SECOND",
+    60: "MINUTE",
+    120: "MINUTE_2",
+    180: "MINUTE_3",
+    300: "MINUTE_5",
+    600: "MINUTE_10",
+    900: "MINUTE_15",
+    1800: "MINUTE_30",
+    3600: "HOUR",
+    7200: "HOUR_2",
+    10800: "HOUR_3",
+    14400: "HOUR_4",
+    86400: "DAY",
+    604800: "WEEK",
+}
+
+# Units of the pandas frequencies, old aliases ("T", "Min", "H") included:
+# pandas >= 2.2 renamed them and pandas 3 rejects them
+_FREQ_UNITS = {
+    "s": 1, "S": 1,
+    "min": 60, "Min": 60, "T": 60,
+    "h": 3600, "H": 3600,
+    "d": 86400, "D": 86400,
+    "W": 604800,
+}
+_MONTH_FREQS = ("M", "ME", "MS")
+
+_FREQ = re.compile(r"^\s*(\d*)\s*([A-Za-z]+)(-[A-Za-z]+)?\s*$")
 
 
 def conv_resol(resolution):
-    """Returns a string for resolution (from a Pandas)
+    """Returns the IG resolution of a pandas frequency ("5min", "1h", "D"
+    or an offset), the old aliases ("5Min", "1H") included. IG names are
+    returned as they are.
     """
-    if _HAS_PANDAS:
+    if resolution in RESOLUTIONS.values() or resolution == "MONTH":
+        return resolution
+    freq = resolution
+    if not isinstance(freq, six.string_types) and _HAS_PANDAS:
         from pandas.tseries.frequencies import to_offset
 
-        d = {
-            to_offset("1s"): "SECOND",
-            to_offset("1Min"): "MINUTE",
-            to_offset("2Min"): "MINUTE_2",
-            to_offset("3Min"): "MINUTE_3",
-            to_offset("5Min"): "MINUTE_5",
-            to_offset("10Min"): "MINUTE_10",
-            to_offset("15Min"): "MINUTE_15",
-            to_offset("30Min"): "MINUTE_30",
-            to_offset("1H"): "HOUR",
-            to_offset("2H"): "HOUR_2",
-            to_offset("3H"): "HOUR_3",
-            to_offset("4H"): "HOUR_4",
-            to_offset("D"): "DAY",
-            to_offset("W"): "WEEK",
-            to_offset("M"): "MONTH",
-        }
-        offset = to_offset(resolution)
-        if offset in d:
-            return d[offset]
-        else:
-            logger.error(traceback.format_exc())
-            logger.warning("conv_resol returns '%s'" % resolution)
-            return resolution
-    else:
-        return resolution
+        freq = to_offset(freq).freqstr
+    match = _FREQ.match(freq) if isinstance(freq, six.string_types) else None
+    if match:
+        count = int(match.group(1) or 1)
+        unit = match.group(2)
+        if unit in _MONTH_FREQS and count == 1:
+            return "MONTH"
+        if unit in _FREQ_UNITS and count * _FREQ_UNITS[unit] in RESOLUTIONS:
+            return RESOLUTIONS[count * _FREQ_UNITS[unit]]
+    logger.warning("conv_resol returns '%s'" % resolution)
+    return resolution
+
+
+def item_epic(item_name):
+    """Returns the epic of an L1:, MARKET: or CHART: item name"""
+    parts = item_name.split(":")
+    return parts[1] if len(parts) > 1 else item_name
+
+
+def tick_timestamp(values):
+    """Returns the time of an update in epoch seconds: UTM when present,
+    else the local clock
+    """
+    utm = values.get("UTM")
+    if utm:
+        if isinstance(utm, datetime):
+            return utm.timestamp()
+        return int(utm) / 1000.0
+    return time.time()
+
+
+# Price fields of the L1/MARKET (OFFER) and CHART (OFR) items
+PRICE_FIELDS = frozenset(["BID", "OFFER", "OFR"])
+
+
+def is_price_update(item_info):
+    """Returns True if an update changed a price field: in MERGE mode the
+    values of an update unchanged since the last one are repeated
+    """
+    changed = item_info.get("changed")
+    return changed is None or not PRICE_FIELDS.isdisjoint(changed)
 
 
 def conv_datetime(dt, version=2):
@@ -77,6 +150,36 @@ def conv_datetime(dt, version=2):
         return dt
 
 
+def conv_datetimes(values, formats, utc=False):
+    """Converts a Series of dates in the given formats (tried in turn for
+    the values not matched yet) to datetime64[ns], or datetime64[ns, UTC]
+    with utc=True. Values matching none of them are NaT, and logged.
+    """
+    if isinstance(formats, six.string_types):
+        formats = (formats,)
+    dates = None
+    for fmt in formats:
+        parsed = pd.to_datetime(values, format=fmt, utc=utc, errors="coerce")
+        dates = parsed if dates is None else dates.where(dates.notna(), parsed)
+        if not dates.isna().any():
+            break
+    unparsed = dates.isna() & values.notna()
+    if unparsed.any():
+        logger.warning("conv_datetimes could not parse %d values, e.g. %r, with %s"
+                       % (unparsed.sum(), values[unparsed].iloc[0], formats))
+    return dates.dt.as_unit("ns")
+
+
+def conv_date_columns(df, columns=None):
+    """Converts in place the date columns of a frame (see DATE_COLUMNS)
+    still holding strings, returns the frame
+    """
+    for column, (formats, utc) in (columns or DATE_COLUMNS).items():
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = conv_datetimes(df[column], formats, utc)
+    return df
+
+
 def conv_to_ms(td):
     """Converts td to integer number of milliseconds"""
     try:
@@ -90,6 +193,31 @@ def conv_to_ms(td):
         return td
 
 
+# Mode of the Unix sockets of the local gateways and of their authkey files
+SOCKET_MODE = 0o600
+
+
+def authkey_path(address):
+    """Returns the path of the authkey file of a Unix socket address"""
+    return address + ".key"
+
+
+def save_authkey(address, authkey):
+    """Saves the authkey of a Unix socket address, readable by the user only"""
+    path = authkey_path(address)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, SOCKET_MODE)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+
+
+def read_authkey(address):
+    """Returns the authkey saved for a Unix socket address"""
+    with open(authkey_path(address), "rb") as f:
+        return f.read()
+
+
 def remove(cache):
     """Remove cache"""
     try: